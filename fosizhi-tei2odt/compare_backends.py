@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+""" Render a fixed set of TEI documents (a synthetic one, which uses every
+    kind of element the renderer handles, and any sample gazetteers) through
+    each of the writer backends, check that they all produce the same text
+    and styles, and time them.
+
+    Backends:
+      uno       -- OpenOffice, through sw_uno.OOWriter (if pyUno is here)
+      bulk      -- OpenOffice, with each top-level div inserted as a flat
+                   ODF fragment (working.py --bulk)
+      odf       -- ODF XML written directly, through sw_odf.ODFWriter
+      recorded  -- the calls recorded (sw_oplog), then replayed onto an
+                   ODFWriter
+
+    Exits with status 1 if any output differs from the first backend's, or
+    if any backend is slower than in the `--baseline` file by more than the
+    `--threshold`.
+"""
+
+import os
+import copy
+import time
+import json
+import pprint
+import difflib
+import logging
+from lxml import etree
+from sw_misc import prep_logging, get_parser, make_temp_dir
+from sw_odf import ODFWriter, get_known_styles
+from sw_oplog import RecordingWriter, replay
+from sw_openoffice_xml import OOWriterXML, normalize_odt, qualify
+from tei_source import load_tei, get_wrapper_divs, save_snapshot, \
+                       load_snapshot, tei_dependencies
+from gaiji import build_glyph_index, load_glyph_index
+from style_prepass import collect_styles, div_events
+from patch_odt import patch_odt
+import render
+from render import load_settings, render_elm, PROCESSED_TAGS
+
+import settings
+
+try:
+    import uno
+    UNO_AVAILABLE = True
+except ImportError:
+    UNO_AVAILABLE = False
+
+BACKENDS = ('uno', 'bulk', 'odf', 'recorded')
+
+# the backends which need pyUno
+UNO_BACKENDS = ('uno', 'bulk')
+
+# the default styles template
+STYLES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'styles_sober.odt')
+
+SYNTHETIC_CHAPTER = u'''
+<div id="synthetic_{n:02d}">
+  <head id="h{n}">卷{n}</head>
+  <p id="p{n}a">某<persName key="A{n}">張<g ref="#G1"/>三</persName>於
+    <date when="16{n:02d}">萬曆某年</date>至
+    <placeName key="P{n}">某山</placeName>，<roleName>知縣</roleName>
+    <c>〇</c><seg rend="big">大</seg>字<pb n="{n}"/>
+    <note>注文<persName key="A0">某</persName><seg rend="small">小</seg>
+    </note>。
+  </p>
+  <p id="p{n}b"><choice><sic>甲</sic><corr>乙</corr></choice>
+    <choice><orig>丙</orig><reg>丁</reg></choice><gap reason="illegible"
+    extent="3"/><unclear>字</unclear><space quantity="2"/>句<lb/>下行
+    <date notBefore="1600" notAfter="1610">某年間</date><g ref="#G2"/>
+    <g ref="#G3">外</g></p>
+  <list><item>一</item><item>二<seg rend="big">大</seg></item></list>
+  <lg><l>詩句</l><l>詩句  二</l></lg>
+  <byline>某撰</byline>
+  <closer>終</closer>
+</div>'''
+
+SYNTHETIC_HEADER = u'''<teiHeader><encodingDesc><charDecl>
+  <glyph id="G1"><mapping type="unicode">一</mapping></glyph>
+  <glyph id="G2"><mapping type="normalized">二</mapping></glyph>
+  <glyph id="G3"/>
+</charDecl></encodingDesc></teiHeader>'''
+
+
+def synthetic_tei(chapters=3):
+    """ Returns a (namespace-stripped) TEI tree which uses every kind of
+        element the renderer handles.
+    """
+    text = u'<TEI>{0}<text><body><div type="wrapper">{1}</div></body>' \
+           u'</text></TEI>'.format(SYNTHETIC_HEADER, u''.join(
+                    SYNTHETIC_CHAPTER.format(n=n)
+                            for n in range(1, chapters + 1)))
+    return etree.fromstring(text.encode('utf-8')).getroottree()
+
+
+def count_elements(divs):
+    """ Returns the number of elements in the divs. """
+    return sum(1 for div in divs for elm in div.iter(tag=etree.Element))
+
+
+def render_uno(divs, needed_styles, styles_file, output_file, opts):
+    """ Renders through OpenOffice. """
+    from working import new_writer
+    writer = new_writer({'headless': opts.headless, 'new_document': True},
+                        styles_file, needed_styles)
+    for div in divs:
+        render_elm(writer, div, [])
+    writer.save_copy(output_file)
+    writer.close()
+
+
+def render_bulk(divs, needed_styles, styles_file, output_file, opts):
+    """ Renders through OpenOffice, a top-level div at a time. """
+    from working import new_writer, insert_div
+    writer = new_writer({'headless': opts.headless, 'new_document': True},
+                        styles_file, needed_styles)
+    bulk_dir = make_temp_dir(cleanup=True)
+    for position, div in enumerate(divs):
+        insert_div(writer, div, position, bulk_dir)
+    writer.save_copy(output_file)
+    writer.close()
+
+
+def render_odf(divs, needed_styles, styles_file, output_file, opts):
+    """ Renders straight to ODF XML. """
+    writer = ODFWriter(get_known_styles(
+                            OOWriterXML(styles_file).get_style_index()))
+    writer.create_styles(needed_styles)
+    for div in divs:
+        render_elm(writer, div, [])
+    writer.save_odt(output_file, styles_file)
+
+
+def render_recorded(divs, needed_styles, styles_file, output_file, opts):
+    """ Renders to a log of operations, then replays it to ODF XML. """
+    recorder = RecordingWriter()
+    recorder.create_styles(needed_styles)
+    for div in divs:
+        render_elm(recorder, div, [])
+
+    writer = ODFWriter(get_known_styles(
+                            OOWriterXML(styles_file).get_style_index()))
+    replay(recorder.ops, writer)
+    writer.save_odt(output_file, styles_file)
+
+
+RENDERERS = {
+    'uno': render_uno,
+    'bulk': render_bulk,
+    'odf': render_odf,
+    'recorded': render_recorded,
+}
+
+
+def check_patching(divs, needed_styles, styles_file, output_file):
+    """ Renders the divs (with bookmarks), then patches a changed paragraph
+        with a footnote into the ODT, then another (see patch_odt.py).
+        Returns the note ids which occur more than once afterwards (there
+        should be none).
+    """
+    render.BOOKMARK_IDS = True
+    try:
+        del PROCESSED_TAGS[:]
+        render_odf(divs, needed_styles, styles_file, output_file, None)
+        save_snapshot(divs, output_file)
+        # (a different paragraph each time, so the first patch's notes are
+        #  still there when the second is rendered)
+        for number in range(2):
+            divs = copy.deepcopy(divs)
+            paras = [elm for div in divs for elm in div.iter('p')
+                                        if elm.find('.//note') is not None]
+            paras[number].text = u'改'
+            if not patch_odt(output_file, divs, load_snapshot(output_file)):
+                return ['(the patch failed)']
+            save_snapshot(divs, output_file)
+    finally:
+        render.BOOKMARK_IDS = False
+
+    ids = [elm.get(qualify('text:id'))
+                for elm in OOWriterXML(output_file).get_content_xml().iter(
+                                                    qualify('text:note'))]
+    return sorted(set(note_id for note_id in ids if ids.count(note_id) > 1))
+
+
+def describe_difference(expected, actual, names):
+    """ Returns a diff of two normalized documents (or of their styles). """
+    for part in ('content', 'styles'):
+        if expected[part] != actual[part]:
+            return part, ''.join(difflib.unified_diff(
+                pprint.pformat(expected[part]).splitlines(True),
+                pprint.pformat(actual[part]).splitlines(True),
+                names[0], names[1], n=2))
+    return None, ''
+
+
+def main():
+    """ Compare the writer backends. """
+
+    load_settings(settings)
+
+    parser = get_parser()
+
+    parser.add_option('-g', '--gazetteer', dest='gazetteers', action='append',
+                        default=[],
+                        help='sample gazetteer to render as well as the '
+                                    'synthetic document (may be given more '
+                                    'than once)')
+
+    parser.add_option('--teiBase', dest='teiBase', action='store',
+                        default=settings.TEI_BASE,
+                        help='path to TEI files (eXist dump) ({0})'\
+                                            .format(settings.TEI_BASE))
+
+    parser.add_option('--cacheDir', dest='cacheDir', action='store',
+                        default=settings.TEI_CACHE,
+                        help='folder to cache the prepared TEI in ({0})'\
+                                            .format(settings.TEI_CACHE))
+
+    parser.add_option('-s', '--styles', dest='stylesFile', action='store',
+                        default=STYLES_FILE,
+                        help='ODT file to take the styles from [%default]')
+
+    parser.add_option('-b', '--backend', dest='backends', action='append',
+                        type='choice', choices=BACKENDS,
+                        help='backend to run (may be given more than once; '
+                                    'the first is the reference) [all of '
+                                    'those available]')
+
+    parser.add_option('--chapters', dest='chapters', action='store',
+                        type='int', default=20,
+                        help='chapters in the synthetic document [%default]')
+
+    parser.add_option('-r', '--repeat', dest='repeat', action='store',
+                        type='int', default=3,
+                        help='renders per backend (the fastest counts) '
+                                    '[%default]')
+
+    parser.add_option('--baseline', dest='baseline', action='store',
+                        help='JSON file of earlier timings to compare with')
+
+    parser.add_option('--saveBaseline', dest='saveBaseline',
+                        action='store_true', default=False,
+                        help='(over-)write the --baseline file with these '
+                                    'timings')
+
+    parser.add_option('--threshold', dest='threshold', action='store',
+                        type='float', default=0.2,
+                        help='fail if a backend is slower than the baseline '
+                                    'by more than this fraction [%default]')
+
+    parser.add_option('-H', '--headless', dest='headless', action='store_true',
+                        default=False, help='Headless Operation (uno)')
+
+    parser.add_option('-k', '--keep', dest='keepDir', action='store',
+                        help='keep the rendered ODTs in this folder')
+
+    opts = parser.parse_args()[0]
+
+    prep_logging(opts.verbose, opts.quiet)
+
+    backends = opts.backends or [backend for backend in BACKENDS
+                            if backend not in UNO_BACKENDS or UNO_AVAILABLE]
+    if set(backends) & set(UNO_BACKENDS) and not UNO_AVAILABLE:
+        parser.error('pyUno is not available')
+
+    output_dir = opts.keepDir or make_temp_dir(cleanup=True)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    styles_file = os.path.abspath(opts.stylesFile)
+
+    # (index entries aren't compared -- the page numbers differ by backend)
+    settings.personIndex = settings.placeIndex = open(os.devnull, 'w')
+
+    documents = []
+    tei = synthetic_tei(opts.chapters)
+    documents.append(('synthetic', get_wrapper_divs(tei),
+                      build_glyph_index(tei.find('.//charDecl'))))
+    for gaz in opts.gazetteers:
+        tei = load_tei(opts.teiBase, gaz, opts.cacheDir)
+        documents.append((gaz, get_wrapper_divs(tei),
+                          load_glyph_index(tei, opts.cacheDir,
+                                tei_dependencies(opts.teiBase, gaz,
+                                                 opts.cacheDir))))
+
+    failed = False
+    timings = {}
+    for name, divs, glyphs in documents:
+        settings.GLYPHS.clear()
+        settings.GLYPHS.update(glyphs)
+        needed_styles = collect_styles(div_events(divs))
+        elements = count_elements(divs)
+        timings[name] = {}
+        reference = None
+
+        for backend in backends:
+            output_file = os.path.join(output_dir,
+                                       '{0}.{1}.odt'.format(name, backend))
+            best = None
+            for attempt in range(opts.repeat):
+                del PROCESSED_TAGS[:]
+                start = time.time()
+                RENDERERS[backend](divs, needed_styles, styles_file,
+                                   output_file, opts)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name][backend] = round(elements / max(best, 0.001), 1)
+            logging.info('%s (%s): %d elements in %.3fs (%.0f elements/s)',
+                         name, backend, elements, best,
+                         timings[name][backend])
+
+            normalized = normalize_odt(output_file)
+            if reference is None:
+                reference = (backend, normalized)
+                continue
+            part, diff = describe_difference(reference[1], normalized,
+                                             (reference[0], backend))
+            if part is not None:
+                failed = True
+                logging.error('%s: the %s from %s differs from %s:\n%s',
+                              name, part, backend, reference[0], diff)
+
+    # (patching is checked on the synthetic document, which has notes in
+    #  paragraphs with ids)
+    name, divs, glyphs = documents[0]
+    settings.GLYPHS.clear()
+    settings.GLYPHS.update(glyphs)
+    duplicates = check_patching(divs, collect_styles(div_events(divs)),
+                    styles_file, os.path.join(output_dir,
+                                              '{0}.patched.odt'.format(name)))
+    if duplicates:
+        failed = True
+        logging.error('Patching twice left duplicate note ids: %s',
+                      ', '.join(duplicates))
+
+    if opts.baseline is not None and os.path.exists(opts.baseline) and \
+       not opts.saveBaseline:
+        with open(opts.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        for name in timings:
+            for backend, rate in timings[name].items():
+                expected = baseline.get(name, {}).get(backend)
+                if expected and rate < expected * (1 - opts.threshold):
+                    failed = True
+                    logging.error('%s (%s) has slowed down: %.0f elements/s '
+                                  '(was %.0f)', name, backend, rate, expected)
+
+    if opts.baseline is not None and opts.saveBaseline:
+        with open(opts.baseline, 'w') as baseline_file:
+            json.dump(timings, baseline_file, indent=2, sort_keys=True)
+        logging.info('Saved the timings to %s', opts.baseline)
+
+    if failed:
+        raise SystemExit(1)
+    logging.info('All of the backends agree')
+
+
+if __name__ == '__main__':
+    main()
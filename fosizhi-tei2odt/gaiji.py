@@ -0,0 +1,77 @@
+#-*- coding:utf-8 -*-
+
+""" Lookup index for the gaiji (non-standard characters) declared in the
+    TEI charDecl, so that each <g ref="#..."> is rendered with a dict
+    lookup rather than a search of the header.
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+# bump this if the layout of the index changes
+INDEX_FORMAT = 3
+
+
+def build_glyph_index(char_decl):
+    """ Returns {id: {'unicode': ..., 'normalized': ..., 'image': ...}} for
+        the <glyph>s and <char>s of a (namespace-stripped) charDecl.
+    """
+    index = {}
+    for glyph in char_decl.iter():
+        if glyph.tag not in ('glyph', 'char'):
+            continue
+        entry = {}
+        for mapping in glyph.iter('mapping'):
+            mapping_type = (mapping.get('type') or '').lower()
+            if mapping_type in ('unicode', 'normalized') and mapping.text:
+                entry[mapping_type] = mapping.text
+        graphic = glyph.find('.//graphic')
+        if graphic is not None:
+            entry['image'] = graphic.get('url')
+        index[glyph.get('id')] = entry
+    return index
+
+
+def get_glyph_index_path(cache_dir, dependencies):
+    """ Returns the path of the cached index for a TEI document, by the
+        files it was built from and their stamps (see
+        tei_source.tei_dependencies) -- so it is found without serializing
+        the charDecl.
+    """
+    digest = hashlib.sha1(str(INDEX_FORMAT))
+    digest.update(json.dumps(sorted(dependencies.items())))
+    return os.path.join(cache_dir, '{0}.glyphs.json'.format(
+                                                        digest.hexdigest()))
+
+
+def load_glyph_index(tei, cache_dir=None, dependencies=None):
+    """ Returns the glyph index for a (namespace-stripped) TEI document.  If
+        a `cache_dir` and the `dependencies` of the TEI are given, the index
+        is cached there, and re-used for as long as none of those files
+        changes.
+    """
+    char_decl = tei.find('.//charDecl')
+    if char_decl is None:
+        return {}
+
+    if cache_dir is None or dependencies is None:
+        return build_glyph_index(char_decl)
+
+    index_path = get_glyph_index_path(cache_dir, dependencies)
+    if os.path.exists(index_path):
+        with open(index_path) as index_file:
+            logging.debug('Loaded the glyph index from the cache')
+            return json.load(index_file)
+
+    index = build_glyph_index(char_decl)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    temp_path = '{0}.{1}.tmp'.format(index_path, os.getpid())
+    with open(temp_path, 'w') as index_file:
+        json.dump(index, index_file)
+    os.rename(temp_path, index_path)
+
+    return index
@@ -0,0 +1,183 @@
+#-*- coding:utf-8 -*-
+
+""" Records memory use at named stage boundaries (parse, xinclude, render,
+    ...), so that a growth in memory can be put down to a stage: the RSS
+    (and the high-water mark) of this process, optionally of OpenOffice,
+    and -- where tracemalloc is available (Python 3, or the pytracemalloc
+    backport) -- the top Python allocation sites of each stage.
+
+    Stages are marked in library code with `stage(name)` (or the `staged`
+    decorator), which do nothing unless a profile has been `enable`d.
+"""
+
+__program_name__ = 'sw_memprofile'
+__version__ = '0.1'
+__author__ = 'Simon Wiles'
+__email__ = 'simonjwiles@gmail.com'
+__copyright__ = 'Copyright (c) 2010-2011, Simon Wiles'
+__license__ = 'GPL http://www.gnu.org/licenses/gpl.txt'
+__date__ = 'April, 2011'
+
+import json
+import time
+import resource
+import threading
+import functools
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# the active profile (see `enable`)
+PROFILE = None
+
+
+def _status_kb(field, pid='self'):
+    """ Returns a memory figure (in KB) from /proc/PID/status, or None. """
+    try:
+        with open('/proc/{0}/status'.format(pid)) as status_file:
+            for line in status_file:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def rss_kb(pid='self'):
+    """ Returns the resident set size of a process, in KB (or None). """
+    return _status_kb('VmRSS', pid)
+
+
+def peak_rss_kb():
+    """ Returns the peak resident set size of this process, in KB. """
+    peak = _status_kb('VmHWM')
+    if peak is None:
+        # (KB on Linux, but bytes on OS X)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak
+
+
+class MemoryProfile():
+    """ The memory use recorded at each stage.  `office_pids()` (optional)
+        returns the pids of OpenOffice processes to include; `top` is the
+        number of allocation sites to keep for each stage.
+    """
+
+    def __init__(self, top=10, office_pids=None, frames=1):
+        self.top = top
+        self.office_pids = office_pids or (lambda: ())
+        self.stages = []
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def office_kb(self):
+        """ Returns the total RSS of the OpenOffice processes (or None). """
+        sizes = [rss_kb(pid) for pid in self.office_pids() if pid is not None]
+        sizes = [size for size in sizes if size is not None]
+        return sum(sizes) if sizes else None
+
+    def begin(self, name):
+        """ Records the start of a stage, and returns its record. """
+        return {
+            'name': name,
+            'thread': threading.current_thread().name,
+            'start': time.time(),
+            'rss_before_kb': rss_kb(),
+            'peak_before_kb': peak_rss_kb(),
+            'snapshot': tracemalloc.take_snapshot()
+                            if tracemalloc is not None else None,
+        }
+
+    def end(self, record):
+        """ Records the end of a stage. """
+        record['seconds'] = round(time.time() - record['start'], 3)
+        record['start'] = round(record['start'] - self.start_time, 3)
+        record['rss_after_kb'] = rss_kb()
+        record['peak_after_kb'] = peak_rss_kb()
+        record['office_kb'] = self.office_kb()
+
+        snapshot = record.pop('snapshot')
+        record['sites'] = []
+        if snapshot is not None:
+            for stat in tracemalloc.take_snapshot().compare_to(
+                                        snapshot, 'lineno')[:self.top]:
+                frame = stat.traceback[0]
+                record['sites'].append(('{0}:{1}'.format(frame.filename,
+                                                         frame.lineno),
+                                        stat.size_diff // 1024,
+                                        stat.count_diff))
+        with self.lock:
+            self.stages.append(record)
+
+    def report(self):
+        """ Returns the report, as text. """
+        lines = ['{0:<32} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10}'
+                    .format('stage', 'seconds', 'rss_kb', 'delta_kb',
+                            'peak_kb', '+peak_kb', 'soffice_kb')]
+        for record in sorted(self.stages, key=lambda record: record['start']):
+            delta = None
+            if None not in (record['rss_before_kb'], record['rss_after_kb']):
+                delta = record['rss_after_kb'] - record['rss_before_kb']
+            figures = [record['rss_after_kb'], delta,
+                       record['peak_after_kb'],
+                       record['peak_after_kb'] - record['peak_before_kb'],
+                       record['office_kb']]
+            lines.append(
+                '{0:<32} {1:>8.3f} {2:>10} {3:>10} {4:>10} {5:>10} {6:>10}'
+                    .format(record['name'][:32], record['seconds'],
+                            *['-' if figure is None else str(figure)
+                                    for figure in figures]))
+            for site, size_kb, count in record['sites']:
+                lines.append('    {0:+9d} KB {1:+8d}  {2}'.format(size_kb,
+                                                              count, site))
+        if tracemalloc is None:
+            lines.append('(tracemalloc isn\'t available here, so only the RSS '
+                         'was recorded)')
+        return '\n'.join(lines) + '\n'
+
+    def save(self, file_path):
+        """ Writes the report to a file, and the stages (for comparing with
+            later runs) to FILE.json.
+        """
+        with open(file_path, 'w') as report_file:
+            report_file.write(self.report())
+        with open('{0}.json'.format(file_path), 'w') as json_file:
+            json.dump(sorted(self.stages, key=lambda record: record['start']),
+                      json_file, indent=2)
+
+
+def enable(top=10, office_pids=None):
+    """ Starts profiling (in this process), and returns the profile. """
+    global PROFILE
+    PROFILE = MemoryProfile(top, office_pids)
+    return PROFILE
+
+
+@contextmanager
+def stage(name):
+    """ Marks a stage (if profiling is enabled). """
+    if PROFILE is None:
+        yield
+        return
+    profile = PROFILE
+    record = profile.begin(name)
+    try:
+        yield
+    finally:
+        profile.end(record)
+
+
+def staged(name):
+    """ Decorator which marks a whole function as a stage. """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
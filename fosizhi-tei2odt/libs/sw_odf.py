@@ -0,0 +1,339 @@
+#-*- coding:utf-8 -*-
+
+""" Builds OpenOffice Writer (ODF) text directly with lxml, through the same
+    interface as sw_uno.OOWriter, so that text can be rendered without
+    OpenOffice.
+"""
+
+__program_name__ = 'sw_odf'
+__version__ = '0.1'
+__author__ = 'Simon Wiles'
+__email__ = 'simonjwiles@gmail.com'
+__copyright__ = 'Copyright (c) 2010-2011, Simon Wiles'
+__license__ = 'GPL http://www.gnu.org/licenses/gpl.txt'
+__date__ = 'April, 2011'
+
+import re
+import copy
+from lxml import etree
+from sw_openoffice_xml import OOWriterXML, NS_MAP, qualify, renumber_notes
+
+# ODF style families, by OpenOffice style type
+STYLE_FAMILIES = {
+    'Paragraph': 'paragraph',
+    'Character': 'text',
+}
+
+# OpenOffice's display names which differ from the names in the ODF
+STYLE_NAMES = {
+    'Default': 'Standard',
+}
+
+# styles which exist in every document
+DEFAULT_STYLES = (
+    ('Paragraph', 'Default'),
+    ('Paragraph', 'Footnote'),
+    ('Character', 'Default'),
+)
+
+# the elements of a document's body text (which `save_odt` replaces)
+BODY_TAGS = set(qualify(tag) for tag in ('text:p', 'text:h', 'text:list',
+                        'text:section', 'table:table', 'text:soft-page-break'))
+
+# runs of characters which need their own ODF elements
+SPECIAL_TEXT = re.compile(u'(  +|\t|\n)')
+
+ODF_NSMAP = dict((prefix, NS_MAP[prefix])
+                    for prefix in ('office', 'style', 'text', 'fo'))
+
+# names of the bookmarks which stand in for page numbers (see `mark_pages`)
+PAGE_MARK = 'sw_page_{0}_{1}'
+PAGE_MARKS = re.compile(r'sw_page_\w+?_\d+')
+
+
+def odf_style_name(style_name):
+    """ Returns the name used in the ODF for an OpenOffice style name. """
+    style_name = STYLE_NAMES.get(style_name, style_name)
+    return style_name.replace(' ', '_20_')
+
+
+def _append_text(parent, text):
+    """ Appends text to an element (after any children), converting spaces,
+        tabs and newlines to their ODF elements.
+    """
+    for index, part in enumerate(SPECIAL_TEXT.split(text)):
+        if not part:
+            continue
+        if index % 2:
+            if part == '\t':
+                etree.SubElement(parent, qualify('text:tab'))
+                continue
+            elif part == '\n':
+                etree.SubElement(parent, qualify('text:line-break'))
+                continue
+            # (the first space is kept as text, the rest are counted)
+            _append_text(parent, u' ')
+            spaces = etree.SubElement(parent, qualify('text:s'))
+            if len(part) > 2:
+                spaces.set(qualify('text:c'), str(len(part) - 1))
+        elif len(parent):
+            parent[-1].tail = (parent[-1].tail or u'') + part
+        else:
+            parent.text = (parent.text or u'') + part
+
+
+def get_known_styles(style_index):
+    """ Returns the (style_type, style_name) of the styles in a StyleIndex,
+        with OpenOffice's names.
+    """
+    odf_names = dict((odf_name, style_name)
+                        for style_name, odf_name in STYLE_NAMES.items())
+    known_styles = set()
+    for style_type, family in STYLE_FAMILIES.items():
+        for name in style_index.names(family):
+            style_name = style_index.get(family, name).get(
+                            qualify('style:display-name')) or name
+            known_styles.add((style_type,
+                              odf_names.get(style_name, style_name)))
+    return known_styles
+
+
+def add_styles(styles, new_styles):
+    """ Adds style definitions to a `styles.xml` tree, for the styles
+        created by an ODFWriter (`new_styles` is
+        {(style_type, style_name): parent_style_name}).
+    """
+    office_styles = styles.find('.//' + qualify('office:styles'))
+    for (style_type, style_name), parent_style_name in \
+                                                sorted(new_styles.items()):
+        style = etree.SubElement(office_styles, qualify('style:style'))
+        style.set(qualify('style:name'), odf_style_name(style_name))
+        if odf_style_name(style_name) != style_name:
+            style.set(qualify('style:display-name'), style_name)
+        style.set(qualify('style:family'), STYLE_FAMILIES[style_type])
+        if parent_style_name is None and style_type == 'Paragraph':
+            parent_style_name = 'Default'
+        if parent_style_name is not None:
+            style.set(qualify('style:parent-style-name'),
+                      odf_style_name(parent_style_name))
+
+
+class ODFWriter():
+    """ Class to write ODF text (an <office:text> tree) with lxml. """
+
+    def __init__(self, known_styles=None, note_id_prefix='ftn',
+                 mark_pages=False):
+        self.body = etree.Element(qualify('office:text'), nsmap=ODF_NSMAP)
+
+        # if `mark_pages`, `current_page` inserts a bookmark, and returns
+        #  its name (matching PAGE_MARKS) -- the page number can be looked
+        #  up once the text has been laid out
+        self.mark_pages = mark_pages
+        self.page_marks = 0
+
+        # (style_type, style_name) of the styles known to exist, and of
+        #  those which this writer has had to create
+        self.known_styles = set(DEFAULT_STYLES)
+        self.known_styles.update(known_styles or ())
+        self.new_styles = {}
+
+        self.note_id_prefix = note_id_prefix
+        self.note_count = 0
+
+        self.contexts = [self.body]
+        self.paras = {0: self._new_para(self.body, 'Default')}
+        self.char_styles = {0: []}
+        self.current_char_styles = {0: 'Default'}
+        self.context = None
+        self.context_index = None
+        self.para = None
+        self.char_style_stack = None
+        self.set_context()
+
+    def _new_para(self, container, style_name):
+        """ Appends a new paragraph to a context. """
+        para = etree.SubElement(container, qualify('text:p'))
+        para.set(qualify('text:style-name'), odf_style_name(style_name))
+        return para
+
+    def set_context(self, context=None):
+        """ Set the document context (the main text, or a footnote). """
+        if context is None:
+            self.context = self.body
+        else:
+            self.context = context
+
+        if self.context in self.contexts:
+            index = self.contexts.index(self.context)
+        else:
+            self.contexts.append(self.context)
+            index = self.contexts.index(self.context)
+            self.paras[index] = self._new_para(self.context, 'Footnote')
+            self.char_styles[index] = []
+            self.current_char_styles[index] = 'Default'
+
+        self.context_index = index
+        self.para = self.paras[index]
+        self.char_style_stack = self.char_styles[index]
+
+    def check_style_name(self, style_name, style_type, parent_style_name=None):
+        """ Records a style which will have to be created (see
+            `add_styles`), if it isn't already known.
+        """
+        if (style_type, style_name) in self.known_styles:
+            return
+        if parent_style_name is not None:
+            self.check_style_name(parent_style_name, style_type)
+        self.new_styles[(style_type, style_name)] = parent_style_name
+        self.known_styles.add((style_type, style_name))
+
+    def create_styles(self, needed_styles):
+        """ Records all of the styles in `needed_styles`
+            ({style_type: {style_name: parent_style_name}}).
+        """
+        for style_type, names in needed_styles.items():
+            for style_name in sorted(names):
+                self.check_style_name(style_name, style_type,
+                                      names[style_name])
+
+    def open_para(self, style_name='Default', parent_style_name=None):
+        """ Begins a new paragraph, with specified style. """
+        self.check_style_name(style_name, 'Paragraph', parent_style_name)
+        self.para.set(qualify('text:style-name'), odf_style_name(style_name))
+
+    def close_para(self):
+        """ Closes the current paragraph (the new one keeps its style). """
+        style_name = self.para.get(qualify('text:style-name'))
+        self.para = etree.SubElement(self.context, qualify('text:p'))
+        self.para.set(qualify('text:style-name'), style_name)
+        self.paras[self.context_index] = self.para
+
+    def write_para(self, text, style_name='Default', parent_style_name=None):
+        """ Writes an entire paragraph in one go. """
+        self.open_para(style_name, parent_style_name)
+        self.write_string(text)
+        self.close_para()
+
+    def write_string(self, text, style_name=None):
+        """ Writes a simple string in the current Context, with the specified
+            Character Style.
+        """
+        if style_name is not None:
+            self.open_char_style(style_name)
+
+        char_style = self.current_char_styles[self.context_index]
+        if char_style in ('', 'Default'):
+            _append_text(self.para, text)
+        else:
+            span_style = odf_style_name(char_style)
+            span = self.para[-1] if len(self.para) else None
+            if span is None or span.tag != qualify('text:span') or \
+               span.get(qualify('text:style-name')) != span_style or \
+               span.tail:
+                span = etree.SubElement(self.para, qualify('text:span'))
+                span.set(qualify('text:style-name'), span_style)
+            _append_text(span, text)
+
+        if style_name is not None:
+            self.close_char_style()
+
+    def open_char_style(self, style_name='Default'):
+        """ Begins a new Character Style (styles are kept on a stack, and
+            closed in reverse order).
+        """
+        self.check_style_name(style_name, 'Character')
+        self.char_style_stack.append(
+                            self.current_char_styles[self.context_index])
+        self.current_char_styles[self.context_index] = style_name
+
+    def close_char_style(self):
+        """ Ends the current Character Style, restoring the previous one. """
+        self.current_char_styles[self.context_index] = \
+                                                self.char_style_stack.pop()
+
+    def insert_footnote(self, text):
+        """ quick convenience function """
+        note_body = self.create_footnote()
+        para = self._new_para(note_body, 'Footnote')
+        _append_text(para, text)
+
+    def create_footnote(self):
+        """ Returns a new footnote (its note-body, which can be used as a
+            context) anchored at the current position.
+        """
+        self.note_count += 1
+        note = etree.SubElement(self.para, qualify('text:note'))
+        note.set(qualify('text:id'), '{0}{1}'.format(self.note_id_prefix,
+                                                     self.note_count))
+        note.set(qualify('text:note-class'), 'footnote')
+        citation = etree.SubElement(note, qualify('text:note-citation'))
+        citation.text = str(self.note_count)
+        return etree.SubElement(note, qualify('text:note-body'))
+
+    def insert_bookmark(self, name):
+        """ Inserts a (point) bookmark at the current position. """
+        bookmark = etree.SubElement(self.para, qualify('text:bookmark'))
+        bookmark.set(qualify('text:name'), name)
+
+    def current_page(self):
+        """ Page numbers aren't known without a layout (but see
+            `mark_pages`).
+        """
+        if not self.mark_pages:
+            return ''
+        self.page_marks += 1
+        name = PAGE_MARK.format(self.note_id_prefix, self.page_marks)
+        self.insert_bookmark(name)
+        return name
+
+    def save_odt(self, file_path, template_file):
+        """ Saves the text as an ODT, with the styles (and any other
+            settings) of a template ODT, replacing the template's own text.
+        """
+        odt = OOWriterXML(template_file)
+
+        content = odt.get_content_xml()
+        text = content.find('.//' + qualify('office:text'))
+        for elm in list(text):
+            if elm.tag in BODY_TAGS:
+                text.remove(elm)
+        for para in self.get_paragraphs():
+            text.append(copy.deepcopy(para))
+        renumber_notes(text)
+        odt.save_content(content)
+
+        if self.new_styles:
+            styles = odt.get_styles_xml()
+            add_styles(styles, self.new_styles)
+            odt.save_styles(styles)
+
+        odt.save(file_path)
+
+    def save_fodt(self, file_path):
+        """ Saves the text as a flat ODF document (for inserting into
+            another document), with definitions of any new styles.  The
+            last paragraph is kept even if it's empty, so that whatever is
+            written after the insertion starts a new paragraph.
+        """
+        root = etree.Element(qualify('office:document'), nsmap=ODF_NSMAP)
+        root.set(qualify('office:version'), '1.2')
+        root.set(qualify('office:mimetype'),
+                 'application/vnd.oasis.opendocument.text')
+        etree.SubElement(root, qualify('office:styles'))
+        add_styles(root, self.new_styles)
+        body = etree.SubElement(root, qualify('office:body'))
+        text = etree.SubElement(body, qualify('office:text'))
+        for para in self.body:
+            text.append(copy.deepcopy(para))
+        etree.ElementTree(root).write(file_path, encoding='utf-8',
+                                      xml_declaration=True)
+
+    def get_paragraphs(self):
+        """ Returns the paragraphs written to the main text (without the
+            empty one left open after the last paragraph break).
+        """
+        paras = list(self.body)
+        if paras and paras[-1] is self.para and not len(self.para) and \
+           not self.para.text:
+            paras = paras[:-1]
+        return paras
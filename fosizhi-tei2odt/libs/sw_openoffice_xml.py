@@ -17,6 +17,8 @@ import logging
 
 from lxml import etree
 from sw_misc import make_temp_dir, zip_dir
+from sw_xml import getParser
+from sw_memprofile import stage
 
 
 NS_MAP = {
@@ -59,7 +61,7 @@ class OOWriterXML():
     def __init__(self, source_file, temp_dir=None):
         # an ODT file is just a regular Zip file...
         try:
-            if source_file[-4:].lower() != '.odt':
+            if source_file[-4:].lower() not in ('.odt', '.ott'):
                 raise zipfile.BadZipfile
             source_zip_file = zipfile.ZipFile(source_file)
         except zipfile.BadZipfile:
@@ -82,7 +84,8 @@ class OOWriterXML():
             self.temp_dir = temp_dir
 
         # extract to the temp folder
-        source_zip_file.extractall(path=self.temp_dir)
+        with stage('extractall'):
+            source_zip_file.extractall(path=self.temp_dir)
 
     def save(self, output_file=None):
         """ Saves the ODT document (if no `output_file` is passed,
@@ -102,7 +105,7 @@ class OOWriterXML():
 
     def get_styles_xml(self):
         """ Returns the XML tree for the ODT styles. """
-        return etree.parse(self.get_styles_path())
+        return etree.parse(self.get_styles_path(), getParser('document'))
 
     def save_styles(self, styles):
         """ Writes the modified XML back to the temp file. """
@@ -110,16 +113,516 @@ class OOWriterXML():
             output_file.write(
                     unicode(etree.tostring(styles, encoding='utf-8'), 'utf8'))
 
+    def get_style_index(self):
+        """ Returns a StyleIndex of the ODT styles (its `tree` can be passed
+            to `save_styles` after any edits).
+        """
+        return StyleIndex(self.get_styles_xml())
+
     def get_content_path(self):
         """ Returns the path to the extracted `content.xml`. """
         return os.path.join(self.temp_dir, 'content.xml')
 
     def get_content_xml(self):
         """ Returns the XML tree for the ODT content. """
-        return etree.parse(self.get_content_path())
+        return etree.parse(self.get_content_path(), getParser('document'))
 
     def save_content(self, content):
         """ Writes the modified XML back to the temp file. """
         with codecs.open(self.get_content_path(), 'w', 'utf-8') as output_file:
             output_file.write(
                     unicode(etree.tostring(content, encoding='utf-8'), 'utf8'))
+
+
+def qualify(tag):
+    """ Expands a `prefix:name` tag or attribute name using NS_MAP. """
+    prefix, name = tag.split(':')
+    return '{{{0}}}{1}'.format(NS_MAP[prefix], name)
+
+
+class StyleIndex():
+    """ Index of the common styles in a `styles.xml` tree, built in one
+        pass: the styles by family and name (or display name), their
+        parents and children, and which styles set each property, so that
+        queries and bulk edits only cost as much as their results.
+        Properties are the attributes of the `style:*-properties` elements,
+        by qualified name (e.g. `qualify('fo:font-size')`).
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.styles = {}
+        self.display_names = {}
+        self.parents = {}
+        self.children = {}
+        self.defaults = {}
+        self.setters = {}
+        self._effective = {}
+
+        office_styles = tree.find('.//' + qualify('office:styles'))
+        if office_styles is None:
+            return
+
+        for default in office_styles.iterchildren(
+                                            qualify('style:default-style')):
+            self.defaults[default.get(qualify('style:family'))] = \
+                                                self._own_properties(default)
+
+        for style in office_styles.iterchildren(qualify('style:style')):
+            family = style.get(qualify('style:family'))
+            name = style.get(qualify('style:name'))
+            self.styles[(family, name)] = style
+            display_name = style.get(qualify('style:display-name'))
+            if display_name is not None:
+                self.display_names[(family, display_name)] = name
+            for attrib in self._own_properties(style):
+                self.setters.setdefault(attrib, set()).add((family, name))
+
+        for (family, name), style in self.styles.items():
+            parent = style.get(qualify('style:parent-style-name'))
+            if parent is not None:
+                self.parents[(family, name)] = parent
+                self.children.setdefault((family, parent), []).append(name)
+
+    def _own_properties(self, style):
+        """ Returns the properties set by a style element itself. """
+        properties = {}
+        for child in style:
+            if child.tag.endswith('-properties'):
+                properties.update(child.attrib)
+        return properties
+
+    def name(self, family, name):
+        """ Returns the style name for a name or display name (or None if
+            there is no such style).
+        """
+        if (family, name) in self.styles:
+            return name
+        return self.display_names.get((family, name))
+
+    def get(self, family, name):
+        """ Returns the style element (or None). """
+        return self.styles.get((family, self.name(family, name)))
+
+    def names(self, family):
+        """ Returns the names of the styles in a family. """
+        return [name for style_family, name in self.styles
+                    if style_family == family]
+
+    def ancestors(self, family, name):
+        """ Returns the names of a style's parent, grandparent, etc. """
+        ancestors = []
+        parent = self.parents.get((family, self.name(family, name)))
+        while parent is not None and parent not in ancestors:
+            ancestors.append(parent)
+            parent = self.parents.get((family, parent))
+        return ancestors
+
+    def descendants(self, family, name):
+        """ Returns the names of all of the styles based on a style. """
+        descendants = []
+        pending = list(self.children.get((family, self.name(family, name)),
+                                         ()))
+        while pending:
+            child = pending.pop()
+            if child not in descendants:
+                descendants.append(child)
+                pending.extend(self.children.get((family, child), ()))
+        return descendants
+
+    def properties(self, family, name):
+        """ Returns the effective properties of a style (the family's
+            defaults, overridden by those of each ancestor in turn).
+        """
+        name = self.name(family, name)
+        if (family, name) not in self._effective:
+            parent = self.parents.get((family, name))
+            if parent is not None and (family, parent) in self.styles and \
+               name not in self.ancestors(family, parent):
+                properties = dict(self.properties(family, parent))
+            else:
+                properties = dict(self.defaults.get(family, {}))
+            if (family, name) in self.styles:
+                properties.update(self._own_properties(
+                                            self.styles[(family, name)]))
+            self._effective[(family, name)] = properties
+        return self._effective[(family, name)]
+
+    def setting(self, attrib, family=None):
+        """ Returns the (family, name) of the styles which set a property
+            themselves.
+        """
+        return set(key for key in self.setters.get(attrib, ())
+                        if family is None or key[0] == family)
+
+    def inheriting(self, attrib, family=None):
+        """ Returns the (family, name) of the styles which have a property,
+            whether they set it or inherit it (not counting the family
+            defaults).
+        """
+        styles = set()
+        for style_family, name in self.setting(attrib, family):
+            styles.add((style_family, name))
+            styles.update((style_family, descendant) for descendant in
+                                    self.descendants(style_family, name))
+        return styles
+
+    def remove_property(self, attrib, family=None):
+        """ Removes a property from the styles which set it (their
+            descendants then inherit it from further up, if anywhere).
+            Returns the number of styles changed.
+        """
+        changed = self.setting(attrib, family)
+        for key in changed:
+            for child in self.styles[key]:
+                if child.tag.endswith('-properties') and \
+                   attrib in child.attrib:
+                    del child.attrib[attrib]
+            self.setters[attrib].discard(key)
+        if changed:
+            self._effective.clear()
+        return len(changed)
+
+
+def _prefix_names(content, prefix):
+    """ Renames the automatic styles and the ids (footnotes, index marks,
+        etc.) in a `content.xml` tree, so that they can't clash with those
+        of another document.
+    """
+    auto_styles = content.find(qualify('office:automatic-styles'))
+    names = set()
+    if auto_styles is not None:
+        names = set(style.get(qualify('style:name')) for style in auto_styles)
+
+    id_attribs = (qualify('text:id'),
+                  '{http://www.w3.org/XML/1998/namespace}id')
+    for elm in content.iter(tag=etree.Element):
+        for key, value in elm.attrib.items():
+            if key in id_attribs or (key == qualify('text:ref-name') and
+                                     elm.tag == qualify('text:note-ref')):
+                elm.set(key, prefix + value)
+            elif (key.endswith('style-name') or key == qualify('style:name')) \
+                    and value in names:
+                elm.set(key, prefix + value)
+
+
+def _merge_children(target, source, key):
+    """ Appends the children of `source` which aren't already in `target`
+        (as identified by the `key` function).
+    """
+    if target is None or source is None:
+        return
+    existing = set(key(elm) for elm in target)
+    for elm in list(source):
+        if key(elm) not in existing:
+            target.append(elm)
+
+
+def _style_key(elm):
+    """ Identifies a style definition by its tag, family and name. """
+    return (elm.tag, elm.get(qualify('style:family')),
+            elm.get(qualify('style:name')))
+
+
+def renumber_notes(body):
+    """ Numbers the footnote (and endnote) citations in order. """
+    counters = {}
+    for note in body.iter(qualify('text:note')):
+        note_class = note.get(qualify('text:note-class'))
+        counters[note_class] = counters.get(note_class, 0) + 1
+        citation = note.find(qualify('text:note-citation'))
+        if citation is not None and \
+           citation.get(qualify('text:label')) is None:
+            citation.text = str(counters[note_class])
+
+
+def merge_documents(source_files, output_file):
+    """ Concatenates the text of several ODT documents (e.g. chapters which
+        have been rendered separately) into a single document.  Common
+        styles are merged (the first definition of a style wins), automatic
+        styles and ids are renamed to keep them distinct, and the footnotes
+        are renumbered.
+    """
+    target = OOWriterXML(source_files[0])
+    content = target.get_content_xml().getroot()
+    styles = target.get_styles_xml().getroot()
+    body = content.find('{0}/{1}'.format(qualify('office:body'),
+                                         qualify('office:text')))
+    _prefix_names(content, 'f0_')
+
+    for index, source_file in enumerate(source_files[1:]):
+        source = OOWriterXML(source_file)
+        source_content = source.get_content_xml().getroot()
+        source_styles = source.get_styles_xml().getroot()
+        _prefix_names(source_content, 'f{0}_'.format(index + 1))
+
+        for tag in ('office:font-face-decls', 'office:automatic-styles'):
+            _merge_children(content.find(qualify(tag)),
+                            source_content.find(qualify(tag)), _style_key)
+        for tag in ('office:font-face-decls', 'office:styles'):
+            _merge_children(styles.find(qualify(tag)),
+                            source_styles.find(qualify(tag)), _style_key)
+
+        # each document ends with an empty paragraph (after the last
+        #  paragraph break), which the next document's text replaces
+        if len(body) and body[-1].tag == qualify('text:p') and \
+           not len(body[-1]) and not body[-1].text:
+            body.remove(body[-1])
+
+        source_body = source_content.find('{0}/{1}'.format(
+                            qualify('office:body'), qualify('office:text')))
+        for elm in list(source_body):
+            # skip the document-level declarations (*-decls, forms)
+            if elm.tag.endswith('-decls') or \
+               elm.tag == qualify('office:forms'):
+                continue
+            body.append(elm)
+
+    renumber_notes(body)
+
+    target.save_content(content)
+    target.save_styles(styles)
+    target.save(output_file)
+
+
+# elements whose contents are text at the level of the paragraph
+_PARA_TAGS = (qualify('text:p'), qualify('text:h'))
+
+# inline elements which are left out of the normalized text (but whose
+#  contents are kept)
+_IGNORED_INLINE_TAGS = (qualify('text:soft-page-break'),
+                        qualify('text:note-citation'),
+                        qualify('text:alphabetical-index-mark'),
+                        qualify('text:toc-mark'))
+
+
+def _style_names(content, styles):
+    """ Returns {style name: display name} for the common styles, with the
+        automatic styles mapped to the common styles they are based on.
+    """
+    names = {}
+    for style in styles.iter(qualify('style:style')):
+        names[style.get(qualify('style:name'))] = \
+                    style.get(qualify('style:display-name')) or \
+                    style.get(qualify('style:name'))
+    auto_styles = content.find(qualify('office:automatic-styles'))
+    for style in auto_styles.iter(qualify('style:style')):
+        parent = style.get(qualify('style:parent-style-name'))
+        names[style.get(qualify('style:name'))] = names.get(parent, parent)
+    return names
+
+
+def _add_text(runs, char_style, text):
+    """ Appends text to a list of runs, merging it with the last run if
+        that has the same style.
+    """
+    if not text:
+        return
+    if runs and runs[-1][0] == 'text' and runs[-1][1] == char_style:
+        runs[-1] = ('text', char_style, runs[-1][2] + text)
+    else:
+        runs.append(('text', char_style, text))
+
+
+def _normalize_inline(elm, char_style, runs, names):
+    """ Adds the text of an element (without its tail) to `runs`. """
+    if elm.tag == qualify('text:span'):
+        char_style = names.get(elm.get(qualify('text:style-name')))
+    elif elm.tag == qualify('text:s'):
+        _add_text(runs, char_style,
+                  u' ' * int(elm.get(qualify('text:c'), 1)))
+        return
+    elif elm.tag == qualify('text:tab'):
+        _add_text(runs, char_style, u'\t')
+        return
+    elif elm.tag == qualify('text:line-break'):
+        _add_text(runs, char_style, u'\n')
+        return
+    elif elm.tag == qualify('text:note'):
+        body = elm.find(qualify('text:note-body'))
+        runs.append(('note', elm.get(qualify('text:note-class')),
+                     _normalize_block(body, names)))
+        return
+    elif elm.tag in (qualify('text:bookmark'),
+                     qualify('text:bookmark-start')):
+        runs.append(('bookmark', elm.get(qualify('text:name')), None))
+        return
+    elif elm.tag == qualify('text:bookmark-end'):
+        return
+    elif elm.tag not in _IGNORED_INLINE_TAGS + _PARA_TAGS and \
+         elm.tag != qualify('text:a'):
+        runs.append(('element', elm.tag, None))
+
+    _add_text(runs, char_style, elm.text)
+    for child in elm:
+        _normalize_inline(child, char_style, runs, names)
+        _add_text(runs, char_style, child.tail)
+
+
+def _normalize_block(container, names):
+    """ Returns the normalized paragraphs of a block container (the body
+        text, a note body, a list...).
+    """
+    paras = []
+    for elm in container:
+        if elm.tag in _PARA_TAGS:
+            runs = []
+            _normalize_inline(elm, None, runs, names)
+            # (a default character style is no character style)
+            runs = [('text', None, run[2]) if run[0] == 'text' and
+                        run[1] in ('Default', 'Standard') else run
+                            for run in runs]
+            paras.append((names.get(elm.get(qualify('text:style-name'))),
+                          runs))
+        elif elm.tag.endswith('-decls') or elm.tag in _IGNORED_INLINE_TAGS:
+            continue
+        else:
+            paras.extend(_normalize_block(elm, names))
+    return paras
+
+
+def normalize_odt(odt_file):
+    """ Returns a comparable model of an ODT's text: the paragraphs (with
+        their common style names, and their contents as runs of
+        ('text', character style, text), ('note', class, paragraphs) and
+        ('bookmark', name, None)), and the definitions of the
+        styles used, as {(family, name): [parent, grandparent...]}.  Two
+        documents with the same model look the same, however they were
+        written (automatic styles, spans, etc.).
+    """
+    odt = OOWriterXML(odt_file)
+    content = odt.get_content_xml().getroot()
+    styles = odt.get_styles_xml().getroot()
+    names = _style_names(content, styles)
+
+    body = content.find('{0}/{1}'.format(qualify('office:body'),
+                                         qualify('office:text')))
+    paras = _normalize_block(body, names)
+    while paras and not paras[-1][1]:
+        paras.pop()
+
+    # the style hierarchy of the styles which are used
+    used = set()
+    def collect(paras):
+        for style_name, runs in paras:
+            used.add(('paragraph', style_name))
+            for run in runs:
+                if run[0] == 'note':
+                    collect(run[2])
+                elif run[0] == 'text':
+                    used.add(('text', run[1]))
+    collect(paras)
+
+    definitions = {}
+    for style in styles.find(qualify('office:styles')).iter(
+                                                    qualify('style:style')):
+        definitions[(style.get(qualify('style:family')),
+                     names[style.get(qualify('style:name'))])] = \
+                            names.get(style.get(
+                                qualify('style:parent-style-name')))
+    hierarchy = {}
+    for family, style_name in used:
+        if style_name is None:
+            continue
+        parents = []
+        parent = definitions.get((family, style_name))
+        while parent is not None and parent not in parents:
+            parents.append(parent)
+            parent = definitions.get((family, parent))
+        hierarchy[(family, style_name)] = parents
+
+    return {'content': paras, 'styles': hierarchy}
+
+
+# elements whose text (and whose children's tails) is part of the text
+_TEXT_CONTAINERS = _PARA_TAGS + (qualify('text:span'), qualify('text:a'))
+
+
+def _iter_part(odt_zip, part, **args):
+    """ Streams a part of an (open) ODT zip file through iterparse. """
+    return etree.iterparse(odt_zip.open(part), huge_tree=True, **args)
+
+
+def scan_odt(odt_file):
+    """ Returns statistics of an ODT's text, streamed straight out of the
+        zip (nothing is extracted, and the body is freed as it goes):
+            {'paragraphs': {style: count}, 'notes': {class: count},
+             'characters': count, 'unknown_styles': [(family, name)]}
+        Paragraph styles are given by their display names, with automatic
+        styles counted as the common styles they are based on.
+    """
+    with zipfile.ZipFile(odt_file) as odt_zip:
+        defined = set()
+        names = {}
+        for event, style in _iter_part(odt_zip, 'styles.xml',
+                                       tag=qualify('style:style')):
+            key = (style.get(qualify('style:family')),
+                   style.get(qualify('style:name')))
+            defined.add(key)
+            names[key] = style.get(qualify('style:display-name')) or key[1]
+            style.clear()
+
+        paragraphs = {}
+        notes = {}
+        characters = 0
+        unknown = set()
+        body_text = qualify('office:text')
+        in_body = False
+
+        for event, elm in _iter_part(odt_zip, 'content.xml',
+                                     events=('start', 'end')):
+            if event == 'start':
+                if elm.tag == body_text:
+                    in_body = True
+                if not in_body:
+                    continue
+                style_name = elm.get(qualify('text:style-name'))
+                if elm.tag in _PARA_TAGS:
+                    key = ('paragraph', style_name)
+                    if key not in defined:
+                        unknown.add(key)
+                    name = names.get(key, style_name)
+                    paragraphs[name] = paragraphs.get(name, 0) + 1
+                elif elm.tag == qualify('text:span') and \
+                     ('text', style_name) not in defined:
+                    unknown.add(('text', style_name))
+                elif elm.tag == qualify('text:note'):
+                    note_class = elm.get(qualify('text:note-class'))
+                    notes[note_class] = notes.get(note_class, 0) + 1
+                continue
+
+            if elm.tag == qualify('style:style'):
+                # (an automatic style -- counted as its parent)
+                key = (elm.get(qualify('style:family')),
+                       elm.get(qualify('style:name')))
+                defined.add(key)
+                parent = elm.get(qualify('style:parent-style-name'))
+                names[key] = names.get((key[0], parent), parent)
+                continue
+            if not in_body:
+                continue
+
+            if elm.tag in _TEXT_CONTAINERS:
+                characters += len(elm.text or u'')
+            elif elm.tag == qualify('text:s'):
+                characters += int(elm.get(qualify('text:c'), 1))
+            elif elm.tag in (qualify('text:tab'),
+                             qualify('text:line-break')):
+                characters += 1
+            parent = elm.getparent()
+            if parent is not None and parent.tag in _TEXT_CONTAINERS:
+                characters += len(elm.tail or u'')
+
+            if parent is not None and parent.tag == body_text:
+                elm.clear()
+                while elm.getprevious() is not None:
+                    del parent[0]
+            elif elm.tag == body_text:
+                in_body = False
+
+    return {
+        'paragraphs': paragraphs,
+        'notes': notes,
+        'characters': characters,
+        'unknown_styles': sorted(unknown),
+    }
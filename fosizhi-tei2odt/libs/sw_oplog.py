@@ -0,0 +1,164 @@
+#-*- coding:utf-8 -*-
+
+""" Records the calls made to a writer (sw_uno.OOWriter, sw_odf.ODFWriter,
+    or anything with the same interface) as a log of operations, which can
+    be saved, and replayed onto another writer later.
+
+    Operations are (writer method name, args) pairs; the constructors below
+    make the ones which processing functions return as batches (see
+    `render.run_ops`).
+"""
+
+__program_name__ = 'sw_oplog'
+__version__ = '0.1'
+__author__ = 'Simon Wiles'
+__email__ = 'simonjwiles@gmail.com'
+__copyright__ = 'Copyright (c) 2010-2011, Simon Wiles'
+__license__ = 'GPL http://www.gnu.org/licenses/gpl.txt'
+__date__ = 'April, 2011'
+
+import json
+
+# the handle of the main text context
+MAIN_CONTEXT = 0
+
+
+def text_op(text, style_name=None):
+    """ Writes a string (in a character style, if one is given). """
+    return ('write_string', (text, style_name))
+
+
+def footnote_op(text):
+    """ Inserts a footnote with some text. """
+    return ('insert_footnote', (text,))
+
+
+def para_break_op():
+    """ Closes the current paragraph. """
+    return ('close_para', ())
+
+
+def index_op(index_name, key, text):
+    """ Writes an entry (with the current page) to an index.  This isn't a
+        writer method -- whoever runs the batch handles it.
+    """
+    return ('index_entry', (index_name, key, text))
+
+
+def merge_text(ops):
+    """ Returns a batch of operations with adjacent strings in the same
+        character style merged into one.
+    """
+    merged = []
+    for operation, args in ops:
+        if operation == 'write_string' and merged and \
+           merged[-1][0] == 'write_string' and merged[-1][1][1] == args[1]:
+            merged[-1] = (operation, (merged[-1][1][0] + args[0], args[1]))
+        else:
+            merged.append((operation, args))
+    return merged
+
+
+def apply_ops(ops, writer):
+    """ Runs a batch of operations on a writer -- in one call, if the writer
+        has a `run_ops` method, or otherwise one by one.
+    """
+    ops = merge_text(ops)
+    if hasattr(writer, 'run_ops'):
+        writer.run_ops(ops)
+    else:
+        for operation, args in ops:
+            getattr(writer, operation)(*args)
+
+
+class RecordingWriter():
+    """ Stand-in writer which records each call as an (operation, args)
+        pair.  Contexts (footnotes) are recorded as integer handles.
+    """
+
+    def __init__(self):
+        self.ops = []
+        self.contexts = 0
+        self.context = MAIN_CONTEXT
+
+    def _record(self, operation, *args):
+        self.ops.append((operation, args))
+
+    def set_context(self, context=None):
+        """ Set the document context (the main text, or a footnote). """
+        if context is None:
+            context = MAIN_CONTEXT
+        self.context = context
+        self._record('set_context', context)
+
+    def check_style_name(self, style_name, style_type, parent_style_name=None):
+        self._record('check_style_name', style_name, style_type,
+                     parent_style_name)
+
+    def create_styles(self, needed_styles):
+        self._record('create_styles', needed_styles)
+
+    def open_para(self, style_name='Default', parent_style_name=None):
+        self._record('open_para', style_name, parent_style_name)
+
+    def close_para(self):
+        self._record('close_para')
+
+    def write_para(self, text, style_name='Default', parent_style_name=None):
+        self._record('write_para', text, style_name, parent_style_name)
+
+    def write_string(self, text, style_name=None):
+        self._record('write_string', text, style_name)
+
+    def open_char_style(self, style_name='Default'):
+        self._record('open_char_style', style_name)
+
+    def close_char_style(self):
+        self._record('close_char_style')
+
+    def insert_footnote(self, text):
+        self._record('insert_footnote', text)
+
+    def create_footnote(self):
+        """ Returns the handle of a new footnote context. """
+        self.contexts += 1
+        self._record('create_footnote', self.contexts)
+        return self.contexts
+
+    def insert_bookmark(self, name):
+        self._record('insert_bookmark', name)
+
+    def run_ops(self, ops):
+        """ Records a batch of operations. """
+        self.ops.extend(ops)
+
+    def current_page(self):
+        """ Page numbers aren't known until the log is replayed. """
+        return ''
+
+
+def replay(ops, writer):
+    """ Replays a log of operations onto a writer. """
+    contexts = {MAIN_CONTEXT: None}
+    for operation, args in ops:
+        if operation == 'create_footnote':
+            contexts[args[0]] = writer.create_footnote()
+        elif operation == 'set_context':
+            writer.set_context(contexts[args[0]])
+        else:
+            getattr(writer, operation)(*args)
+
+
+def save_ops(ops, file_path):
+    """ Saves a log of operations (one JSON list per line). """
+    with open(file_path, 'w') as log_file:
+        for operation, args in ops:
+            log_file.write(json.dumps([operation] + list(args)))
+            log_file.write('\n')
+
+
+def load_ops(file_path):
+    """ Loads a log of operations saved by `save_ops`. """
+    with open(file_path) as log_file:
+        return [(op[0], tuple(op[1:])) for op in
+                    (json.loads(line) for line in log_file if line.strip())]
@@ -0,0 +1,222 @@
+#-*- coding:utf-8 -*-
+
+""" Samples the memory and CPU use of processes (from /proc, so Linux
+    only) in a background thread, together with a work counter, and writes
+    the time series to a CSV file.
+"""
+
+__program_name__ = 'sw_telemetry'
+__version__ = '0.1'
+__author__ = 'Simon Wiles'
+__email__ = 'simonjwiles@gmail.com'
+__copyright__ = 'Copyright (c) 2010-2011, Simon Wiles'
+__license__ = 'GPL http://www.gnu.org/licenses/gpl.txt'
+__date__ = 'April, 2011'
+
+import os
+import csv
+import json
+import time
+import threading
+import logging
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_KB = os.sysconf('SC_PAGE_SIZE') // 1024
+
+SAMPLE_COLUMNS = ('elapsed', 'python_rss_kb', 'python_cpu_pct',
+                  'office_rss_kb', 'office_cpu_pct', 'items', 'items_per_s',
+                  'done', 'total')
+
+
+def proc_available():
+    """ Whether process statistics can be read (i.e. there is a /proc). """
+    return os.path.exists('/proc/self/stat')
+
+
+def process_stat(pid):
+    """ Returns (name, parent pid, cpu ticks, rss in KB) for a process, or
+        None if it has gone.
+    """
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as stat_file:
+            stat = stat_file.read()
+    except IOError:
+        return None
+    # (the name is in brackets, and may contain spaces)
+    name = stat[stat.index('(') + 1:stat.rindex(')')]
+    fields = stat[stat.rindex(')') + 2:].split()
+    return (name, int(fields[1]), int(fields[11]) + int(fields[12]),
+            int(fields[21]) * PAGE_KB)
+
+
+def process_tree(pid):
+    """ Returns {pid: stat} for a process and all of its descendants. """
+    stats = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            stat = process_stat(int(entry))
+            if stat is not None:
+                stats[int(entry)] = stat
+
+    tree = {}
+    pending = [pid]
+    while pending:
+        parent = pending.pop()
+        if parent in stats:
+            tree[parent] = stats[parent]
+        pending.extend(child for child, stat in stats.items()
+                            if stat[1] == parent and child not in tree)
+    return tree
+
+
+def find_process(fragment):
+    """ Returns the pid of a process whose command line contains
+        `fragment` (or None).
+    """
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/cmdline'.format(entry)) as cmdline_file:
+                cmdline = cmdline_file.read().replace('\0', ' ')
+        except IOError:
+            continue
+        if fragment in cmdline:
+            return int(entry)
+    return None
+
+
+class Sampler(threading.Thread):
+    """ Background thread which samples the CPU and memory use of this
+        process (and its children) and of OpenOffice, with the throughput
+        of a work counter, at a fixed interval.
+
+        `count()` should return the number of items (e.g. elements) done so
+        far, and `progress()` (optional) a (done, total) pair; OpenOffice
+        processes are recognised by name (`office_names`) amongst this
+        process's descendants, and `office_pids()` (optional) can return
+        others (e.g. a server which was already running).
+    """
+
+    def __init__(self, output_file=None, interval=1.0, count=None,
+                 progress=None, progress_interval=0, office_pids=None,
+                 office_names=('soffice', 'soffice.bin', 'oosplash')):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.output_file = output_file
+        self.interval = interval
+        self.count = count or (lambda: 0)
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.office_pids = office_pids or (lambda: ())
+        self.office_names = office_names
+
+        self.samples = []
+        self.start_time = None
+        self.stopping = threading.Event()
+        self.previous_ticks = {}
+
+    def _sample(self, elapsed, interval):
+        """ Takes one sample (a row of SAMPLE_COLUMNS). """
+        processes = process_tree(os.getpid())
+        for pid in self.office_pids():
+            if pid is not None and pid not in processes:
+                processes.update(process_tree(pid))
+
+        usage = {'python': [0, 0], 'office': [0, 0]}
+        ticks = {}
+        for pid, (name, ppid, cpu_ticks, rss) in processes.items():
+            kind = 'office' if name in self.office_names else 'python'
+            usage[kind][0] += rss
+            usage[kind][1] += cpu_ticks - self.previous_ticks.get(pid,
+                                                                  cpu_ticks)
+            ticks[pid] = cpu_ticks
+        self.previous_ticks = ticks
+
+        items = self.count()
+        previous_items = self.samples[-1][5] if self.samples else 0
+        done, total = self.progress() if self.progress else (None, None)
+        scale = 100.0 / (CLOCK_TICKS * max(interval, 0.001))
+        return (round(elapsed, 2),
+                usage['python'][0], round(usage['python'][1] * scale, 1),
+                usage['office'][0], round(usage['office'][1] * scale, 1),
+                items, round((items - previous_items) / max(interval, 0.001),
+                             1),
+                done, total)
+
+    def run(self):
+        self.start_time = time.time()
+        last_time = self.start_time
+        last_report = self.start_time
+        while True:
+            stopping = self.stopping.wait(self.interval)
+            now = time.time()
+            try:
+                self.samples.append(self._sample(now - self.start_time,
+                                                 now - last_time))
+            except (IOError, OSError), exc:
+                logging.warning('Telemetry sample failed: %s', exc)
+            last_time = now
+
+            if self.progress_interval and self.samples and \
+               now - last_report >= self.progress_interval:
+                last_report = now
+                self.report_progress()
+
+            if stopping or self.stopping.is_set():
+                break
+
+    def report_progress(self):
+        """ Logs a progress line from the last sample. """
+        sample = self.samples[-1]
+        if sample[8]:
+            logging.info('%d%% done (%d of %d top-level divs), '
+                         '%.0f elements/s, soffice %.0f%% CPU',
+                         100 * sample[7] // sample[8], sample[7], sample[8],
+                         sample[6], sample[4])
+        else:
+            logging.info('%d elements, %.0f elements/s, soffice %.0f%% CPU',
+                         sample[5], sample[6], sample[4])
+
+    def stop(self):
+        """ Stops sampling, writes the time series (if there is an
+            `output_file`), and returns the summary.
+        """
+        self.stopping.set()
+        self.join()
+        if self.output_file is not None:
+            with open(self.output_file, 'wb') as csv_file:
+                writer = csv.writer(csv_file)
+                writer.writerow(SAMPLE_COLUMNS)
+                writer.writerows(self.samples)
+        summary = self.summary()
+        if self.output_file is not None:
+            with open('{0}.summary.json'.format(self.output_file), 'w') \
+                                                            as summary_file:
+                json.dump(summary, summary_file, indent=2)
+        return summary
+
+    def summary(self):
+        """ Returns the peaks and means of the samples, and which process
+            was the busier.
+        """
+        if not self.samples:
+            return {}
+        duration = self.samples[-1][0]
+        columns = zip(*self.samples)
+        mean = lambda values: round(sum(values) / float(len(values)), 1)
+        summary = {
+            'duration_s': duration,
+            'samples': len(self.samples),
+            'items': self.samples[-1][5],
+            'items_per_s': round(self.samples[-1][5] / max(duration, 0.001),
+                                 1),
+            'python_peak_rss_kb': max(columns[1]),
+            'python_mean_cpu_pct': mean(columns[2]),
+            'office_peak_rss_kb': max(columns[3]),
+            'office_mean_cpu_pct': mean(columns[4]),
+        }
+        summary['bound_by'] = 'soffice' \
+                    if summary['office_mean_cpu_pct'] > \
+                       summary['python_mean_cpu_pct'] else 'python'
+        return summary
@@ -16,6 +16,12 @@ import subprocess
 import time
 import atexit
 import logging
+import threading
+import Queue
+from sw_telemetry import proc_available, find_process
+from sw_openoffice_xml import OOWriterXML
+from sw_odf import get_known_styles, PAGE_MARK
+from sw_oplog import merge_text
 
 try:
     import uno
@@ -75,6 +81,9 @@ Locale = uno.getClass('com.sun.star.lang.Locale')
 DIRECT_VALUE = uno.getConstantByName(
                     'com.sun.star.beans.PropertyState.DIRECT_VALUE')
 
+# PIDs of the OpenOffice servers started by `connectOO`, by port
+OFFICE_PIDS = {}
+
 
 def whereis(program):
     """ Generic function to find the location of a binary executable
@@ -88,9 +97,12 @@ def whereis(program):
 
 
 def connectOO(headless=False, keepopen=False,
-                oo_host='127.0.0.1', oo_port='8100'):
+                oo_host='127.0.0.1', oo_port='8100', profile_dir=None):
     """ Open and/or connect to an OpenOffice server.  Returns an
         instance of com.sun.star.frame.Desktop.
+
+        A separate `profile_dir` is needed to run more than one server at
+        once (otherwise a new soffice just hands over to the running one).
     """
     local = uno.getComponentContext()
     resolver = local.ServiceManager.createInstanceWithContext(
@@ -104,14 +116,19 @@ def connectOO(headless=False, keepopen=False,
         context = resolver.resolve(connection_string.format(oo_host, oo_port))
         logging.debug('Connected to OpenOffice on %s:%s', oo_host, oo_port)
     except NoConnectException:
-        office = subprocess.Popen([
+        command = [
             whereis('soffice'),
             '-headless' if headless else '-invisible',
             '-nofirststartwizard',
             '-norestore',
             '-nologo',
             '-accept=socket,host={0},port={1};urp;'.format(oo_host, oo_port),
-        ])
+        ]
+        if profile_dir is not None:
+            command.append('-env:UserInstallation={0}'.format(
+                    unohelper.systemPathToFileUrl(profile_dir)))
+        office = subprocess.Popen(command)
+        OFFICE_PIDS[oo_port] = office.pid
         time.sleep(3)
 
         def cleanup():
@@ -136,12 +153,155 @@ def connectOO(headless=False, keepopen=False,
     return desktop
 
 
+def office_pid(oo_port='8100'):
+    """ Returns the PID of the OpenOffice server on a port (if it was
+        started by `connectOO`, or can be found in /proc), or None.
+    """
+    if oo_port in OFFICE_PIDS:
+        return OFFICE_PIDS[oo_port]
+    if proc_available():
+        return find_process('port={0};'.format(oo_port))
+    return None
+
+
+def terminateOO(oo_host='127.0.0.1', oo_port='8100'):
+    """ Shuts down the OpenOffice server listening on a given port (if
+        there is one).
+    """
+    local = uno.getComponentContext()
+    resolver = local.ServiceManager.createInstanceWithContext(
+                    'com.sun.star.bridge.UnoUrlResolver', local)
+    try:
+        context = resolver.resolve(
+            'uno:socket,host={0},port={1};urp;StarOffice.ComponentContext'\
+                                                    .format(oo_host, oo_port))
+    except NoConnectException:
+        return
+    desktop = context.ServiceManager.createInstanceWithContext(
+                'com.sun.star.frame.Desktop', context)
+    try:
+        desktop.terminate()
+    except DisposedException:
+        # the bridge goes down with the server
+        pass
+    logging.debug('Closed OpenOffice on %s:%s', oo_host, oo_port)
+
+
+def parse_filter_options(options):
+    """ Converts a filter options string (e.g. "UseTaggedPDF=true,
+        SelectPdfVersion=1") into a dict, with booleans and integers
+        converted.
+    """
+    filter_data = {}
+    for option in (options or '').split(','):
+        if '=' not in option:
+            continue
+        name, value = [part.strip() for part in option.split('=', 1)]
+        if value.lower() in ('true', 'false'):
+            value = value.lower() == 'true'
+        elif value.isdigit():
+            value = int(value)
+        filter_data[name] = value
+    return filter_data
+
+
+def filter_properties(filter_name, filter_data=None):
+    """ Returns the properties for storeToURL with an export filter. """
+    properties = [PropertyValue('FilterName', 0, filter_name, 0)]
+    if filter_data:
+        data = tuple(PropertyValue(name, 0, value, 0)
+                                for name, value in filter_data.items())
+        properties.append(PropertyValue('FilterData', 0,
+                uno.Any('[]com.sun.star.beans.PropertyValue', data), 0))
+    return tuple(properties)
+
+
+class ExportQueue(threading.Thread):
+    """ Exports finished documents (e.g. ODT -> PDF) on a dedicated
+        OpenOffice server, in the background, so that exporting overlaps
+        with rendering on the other server(s).
+    """
+
+    def __init__(self, **args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.connect_args = args
+        self.jobs = Queue.Queue()
+        self.failures = []
+
+    def add(self, source_file, output_file, filter_name='writer_pdf_Export',
+                    filter_data=None):
+        """ Queues an export of `source_file` to `output_file`. """
+        self.jobs.put((source_file, output_file, filter_name, filter_data))
+
+    def finish(self):
+        """ Waits for all of the queued exports to finish. """
+        self.jobs.put(None)
+        self.join()
+
+    def run(self):
+        try:
+            desktop = connectOO(**self.connect_args)
+        except Exception, exc:
+            # (the queued exports are still taken, and failed, so that
+            #  `finish` returns and the caller sees the failures)
+            logging.error('Can\'t connect to OpenOffice for exporting: %s',
+                          exc)
+            desktop = None
+        hidden = (PropertyValue('Hidden', 0, True, 0),)
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            source_file, output_file, filter_name, filter_data = job
+            if desktop is None:
+                self.failures.append(output_file)
+                continue
+            document = None
+            try:
+                document = desktop.loadComponentFromURL(
+                        unohelper.systemPathToFileUrl(source_file),
+                        '_blank', 0, hidden)
+                document.storeToURL(unohelper.systemPathToFileUrl(
+                                                            output_file),
+                        filter_properties(filter_name, filter_data))
+                logging.info('Exported %s', output_file)
+            except Exception, exc:
+                logging.error('Exporting %s failed: %s', output_file, exc)
+                self.failures.append(output_file)
+            finally:
+                # (a failed export mustn't leave its document open)
+                if document is not None:
+                    try:
+                        document.close(True)
+                    except Exception, exc:
+                        logging.warning('Can\'t close %s: %s', source_file,
+                                        exc)
+
+
 class OOWriter():
     """ Class to manipulate OpenOffice Writer using the Uno API. """
 
-    def __init__(self, **args):
-        self.desktop = connectOO(**args)
-        self.document = self.desktop.getCurrentComponent()
+    def __init__(self, source_file=None, new_document=False, desktop=None,
+                 template_file=None, mark_pages=None, **args):
+        # (a long-running process can pass in the desktop it already has,
+        #  rather than connecting to OpenOffice again)
+        self.desktop = desktop if desktop is not None else connectOO(**args)
+
+        if source_file is not None:
+            # carry on writing at the end of an existing document
+            self.document = self.desktop.loadComponentFromURL(
+                    unohelper.systemPathToFileUrl(source_file),
+                    '_blank', 0, ())
+        elif template_file is not None:
+            # a new (untitled) document, with the template's styles
+            self.document = self.desktop.loadComponentFromURL(
+                    unohelper.systemPathToFileUrl(template_file), '_blank', 0,
+                    (PropertyValue('AsTemplate', 0, True, 0),))
+        elif new_document:
+            self.document = None
+        else:
+            self.document = self.desktop.getCurrentComponent()
 
         if self.document is None:
             self.document = self.desktop.loadComponentFromURL(
@@ -149,16 +309,36 @@ class OOWriter():
             #document = desktop.loadComponentFromURL(
                 #'file:///home/simon/test.odt' ,'_blank', 0, ())
 
-        self.saved_char_style_name = None
-
         self.contexts = [self.document.Text]
         self.cursors = {0: self.document.Text.createTextCursor()}
+        # local shadows of each cursor's style properties, and its stack of
+        #  open character styles (every property read or write is a round
+        #  trip to OpenOffice, so we only send the ones that change)
+        self.shadows = {0: {}}
+        self.char_styles = {0: []}
         self.cursor = None
         self.context = None
+        self.shadow = None
         self.set_context()
 
+        # (style_type, style_name) of the styles known to exist
+        self.known_styles = set()
+        if template_file is not None:
+            self.known_styles.update(get_known_styles(
+                                OOWriterXML(template_file).get_style_index()))
+
+        if source_file is not None:
+            self.cursor.gotoEnd(False)
+
         self.view_cursor = self.document.getCurrentController().getViewCursor()
 
+        # if `mark_pages` (a prefix for the bookmarks' names) is given,
+        #  `current_page` inserts a bookmark, and returns its name (matching
+        #  sw_odf.PAGE_MARKS) -- for documents which are to be merged
+        #  before their page numbers are known
+        self.mark_pages = mark_pages
+        self.page_marks = 0
+
     def set_context(self, context=None):
         """ Set the document context in the OpenOffice document. """
         if context is None:
@@ -167,39 +347,108 @@ class OOWriter():
             self.context = context
 
         if self.context in self.contexts:
-            self.cursor = self.cursors[self.contexts.index(self.context)]
+            index = self.contexts.index(self.context)
+            self.cursor = self.cursors[index]
         else:
             self.contexts.append(self.context)
+            index = self.contexts.index(self.context)
             self.cursor = self.context.createTextCursor()
-            self.cursors[self.contexts.index(self.context)] = self.cursor
+            self.cursors[index] = self.cursor
+            self.shadows[index] = {}
+            self.char_styles[index] = []
+
+        self.shadow = self.shadows[index]
+        self.char_style_stack = self.char_styles[index]
+
+    def get_cursor_property(self, name):
+        """ Returns a cursor property (read from OpenOffice only the first
+            time).
+        """
+        if name not in self.shadow:
+            self.shadow[name] = getattr(self.cursor, name)
+        return self.shadow[name]
+
+    def set_cursor_property(self, name, value):
+        """ Sets a cursor property, unless it already has that value. """
+        if self.shadow.get(name) != value:
+            setattr(self.cursor, name, value)
+            self.shadow[name] = value
+
+    def set_style(self, style_name, style_type, parent_style_name=None):
+        """ Applies a paragraph or character style at the cursor, creating
+            it first if necessary.
+        """
+        property_name = '{0}StyleName'.format(style_type[:4])
+        try:
+            self.set_cursor_property(property_name, style_name)
+        except UnoException:
+            self.check_style_name(style_name, style_type, parent_style_name)
+            self.set_cursor_property(property_name, style_name)
 
     def check_style_name(self, style_name, style_type, parent_style_name=None):
         """ Checks if a style name exists, and creates it if not.  This is
             necessary as Uno will crash if attempting to assign a style which
             doesn't already exist!
         """
+        if (style_type, style_name) in self.known_styles:
+            return
+
         styles = self.document.StyleFamilies.getByName(
                                                 '{0}Styles'.format(style_type))
 
         if not styles.hasByName(style_name):
-            style = self.document.createInstance(
-                    'com.sun.star.style.{0}Style'.format(style_type))
+            self._insert_style(styles, style_name, style_type,
+                               parent_style_name)
+
+        self.known_styles.add((style_type, style_name))
+
+    def _insert_style(self, styles, style_name, style_type,
+                            parent_style_name=None):
+        """ Creates a new style in a style family. """
+        style = self.document.createInstance(
+                'com.sun.star.style.{0}Style'.format(style_type))
 
-            if parent_style_name is not None:
-                self.check_style_name(parent_style_name, style_type)
-                style.ParentStyle = parent_style_name
-            elif style_type == 'Paragraph':
-                style.ParentStyle = 'Default'
+        if parent_style_name is not None:
+            self.check_style_name(parent_style_name, style_type)
+            style.ParentStyle = parent_style_name
+        elif style_type == 'Paragraph':
+            style.ParentStyle = 'Default'
 
-            styles.insertByName(style_name, style)
+        styles.insertByName(style_name, style)
+
+    def create_styles(self, needed_styles):
+        """ Creates, in one batch, all of the styles in `needed_styles`
+            ({style_type: {style_name: parent_style_name}}) which don't
+            already exist.
+        """
+        for style_type, names in needed_styles.items():
+            styles = self.document.StyleFamilies.getByName(
+                                                '{0}Styles'.format(style_type))
+            # one call for all the existing names, instead of one per style
+            for style_name in styles.ElementNames:
+                self.known_styles.add((style_type, style_name))
+
+            created = 0
+            for style_name in sorted(names):
+                if (style_type, style_name) in self.known_styles:
+                    continue
+                parent_style_name = names[style_name]
+                if parent_style_name is not None:
+                    # make sure the parent comes first
+                    self.check_style_name(parent_style_name, style_type,
+                                          names.get(parent_style_name))
+                self._insert_style(styles, style_name, style_type,
+                                   parent_style_name)
+                self.known_styles.add((style_type, style_name))
+                created += 1
+
+            logging.debug('Created %d new %s styles', created, style_type)
 
     def open_para(self, style_name='Default', parent_style_name=None):
         """ Begins a new paragraph, with specified style. """
-        try:
-            self.cursor.ParaStyleName = style_name
-        except UnoException:
-            self.check_style_name(style_name, 'Paragraph', parent_style_name)
-            self.cursor.ParaStyleName = style_name
+        # (n.b. a paragraph break doesn't change the paragraph style, so
+        #  the shadowed value is still good for the new paragraph)
+        self.set_style(style_name, 'Paragraph', parent_style_name)
 
     def close_para(self):
         """ Closes the current paragraph (i.e. inserts a paragraph break). """
@@ -208,11 +457,7 @@ class OOWriter():
 
     def write_para(self, text, style_name='Default', parent_style_name=None):
         """ Writes an entire paragraph in one go. """
-        try:
-            self.cursor.ParaStyleName = style_name
-        except UnoException:
-            self.check_style_name(style_name, 'Paragraph', parent_style_name)
-            self.cursor.ParaStyleName = style_name
+        self.set_style(style_name, 'Paragraph', parent_style_name)
 
         self.context.insertString(self.cursor, text, False)
         self.context.insertControlCharacter(
@@ -223,29 +468,50 @@ class OOWriter():
             Character Style.
         """
         if style_name is not None:
-            saved_char_style = self.cursor.CharStyleName
-            try:
-                self.cursor.CharStyleName = style_name
-            except UnoException:
-                self.check_style_name(style_name, 'Character')
-                self.cursor.CharStyleName = style_name
+            self.open_char_style(style_name)
 
         self.context.insertString(self.cursor, text, False)
 
         if style_name is not None:
-            # ugh! don't seem to be able to "unset" this property..?
-            self.cursor.CharStyleName = \
-                saved_char_style if saved_char_style != '' else 'Default'
+            self.close_char_style()
 
     def open_char_style(self, style_name='Default'):
-        """ Begins a new Character Style. """
-        self.saved_char_style_name = self.cursor.CharStyleName
-        try:
-            self.cursor.CharStyleName = style_name
-        except UnoException:
-            self.check_style_name(style_name, 'Character')
-            self.cursor.CharStyleName = style_name
-            self.cursor.CharStyleName = style_name
+        """ Begins a new Character Style (styles are kept on a stack, and
+            closed in reverse order).
+        """
+        self.char_style_stack.append(self.get_cursor_property('CharStyleName'))
+        self.set_style(style_name, 'Character')
+
+    def close_char_style(self):
+        """ Ends the current Character Style, restoring the previous one. """
+        saved_char_style = self.char_style_stack.pop()
+        # ugh! don't seem to be able to "unset" this property..?
+        self.set_cursor_property('CharStyleName',
+                saved_char_style if saved_char_style != '' else 'Default')
+
+    def run_ops(self, ops):
+        """ Runs a batch of operations (see sw_oplog).  Adjacent strings are
+            merged, and the character style is only restored at the end of
+            each run of strings, rather than after every one.
+        """
+        saved_char_style = None
+        for operation, args in merge_text(ops):
+            if operation != 'write_string':
+                if saved_char_style is not None:
+                    self.set_cursor_property('CharStyleName', saved_char_style)
+                    saved_char_style = None
+                getattr(self, operation)(*args)
+                continue
+
+            text, style_name = args
+            if saved_char_style is None:
+                saved_char_style = \
+                        self.get_cursor_property('CharStyleName') or 'Default'
+            self.set_style(style_name or saved_char_style, 'Character')
+            self.context.insertString(self.cursor, text, False)
+
+        if saved_char_style is not None:
+            self.set_cursor_property('CharStyleName', saved_char_style)
 
     def insert_footnote(self, text):
         """ quick convenience function """
@@ -259,6 +525,46 @@ class OOWriter():
         self.context.insertTextContent(self.cursor, footnote, False)
         return footnote
 
+    def insert_bookmark(self, name):
+        """ Inserts a (point) bookmark at the cursor. """
+        bookmark = self.document.createInstance('com.sun.star.text.Bookmark')
+        bookmark.setName(name)
+        self.context.insertTextContent(self.cursor, bookmark, False)
+
+    def current_page(self):
+        """ Returns the page number at the view cursor (but see
+            `mark_pages`).
+        """
+        if self.mark_pages is None:
+            return self.view_cursor.Page
+        self.page_marks += 1
+        name = PAGE_MARK.format(self.mark_pages, self.page_marks)
+        self.insert_bookmark(name)
+        return name
+
+    def insert_document(self, file_path):
+        """ Inserts a whole document (e.g. a flat ODF fragment written by
+            sw_odf.ODFWriter) at the cursor, in one call, and moves the
+            cursor to the end of it.
+        """
+        properties = (PropertyValue('FilterName', 0,
+                                    'OpenDocument Text Flat XML', 0),)
+        self.cursor.insertDocumentFromURL(
+                unohelper.systemPathToFileUrl(file_path), properties)
+        self.cursor.gotoEnd(False)
+        # (the inserted text may have changed the cursor's styles)
+        self.shadow.clear()
+
+    def bookmark_page(self, name, remove=True):
+        """ Returns the page number of a bookmark (and removes it). """
+        bookmark = self.document.getBookmarks().getByName(name)
+        anchor = bookmark.getAnchor()
+        self.view_cursor.gotoRange(anchor, False)
+        page = self.view_cursor.Page
+        if remove:
+            anchor.getText().removeTextContent(bookmark)
+        return page
+
     def load_styles_from_file(self, file_path):
         """ Loads styles from a specified ODT file. """
         # Available options:
@@ -275,6 +581,12 @@ class OOWriter():
         url = unohelper.systemPathToFileUrl(file_path)
         self.document.StyleFamilies.loadStylesFromURL(url, properties)
 
+        # the styles in the file now exist, so there's no need to ask
+        #  OpenOffice about them later
+        if file_path[-4:].lower() in ('.odt', '.ott'):
+            self.known_styles.update(get_known_styles(
+                                OOWriterXML(file_path).get_style_index()))
+
     def create_index(self, anchor=None, index_type='toc', index_name=None,
                         index_title=''):
         """
@@ -353,3 +665,23 @@ uno.invoke(index.LevelFormat, 'replaceByIndex', (2, level_format))
         #document.store()
         url = unohelper.systemPathToFileUrl(file_path)
         self.document.storeAsURL(url, ())
+
+    def save_copy(self, file_path):
+        """ Save a copy of the document as an ODT file (the document itself
+            stays attached to its current location).
+        """
+        properties = (PropertyValue('FilterName', 0, 'writer8', 0),)
+        url = unohelper.systemPathToFileUrl(file_path)
+        self.document.storeToURL(url, properties)
+
+    def export_pdf(self, file_path, filter_data=None):
+        """ Export the document as PDF (`filter_data` is a dict of PDF
+            export filter options).
+        """
+        url = unohelper.systemPathToFileUrl(file_path)
+        self.document.storeToURL(url,
+                        filter_properties('writer_pdf_Export', filter_data))
+
+    def close(self):
+        """ Closes the document (discarding any unsaved changes). """
+        self.document.close(True)
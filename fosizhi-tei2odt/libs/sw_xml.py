@@ -12,18 +12,80 @@ __comments__        = ("Somewhere to collect useful XML processing functions, "
                        "as a library and as a command-line tool")
 
 
+import os
 import sys
+import glob
+import atexit
+import time
+import resource
 import optparse
 import logging
 import string
+import threading
+import urllib
+from collections import OrderedDict
+from copy import deepcopy
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 from StringIO import StringIO
 from lxml import etree
+from sw_memprofile import stage, staged, enable as enableMemProfile
 
 validators = {
     'xsd': etree.XMLSchema,
     'rng': etree.RelaxNG
 }
 
+# XMLParser options, by kind of document:
+#  `document` -- mixed-content text (TEI, ODF), where whitespace between
+#               elements can matter, so blank text is kept
+#  `data`     -- element-only documents (schemas, settings...), where blank
+#               text is only indentation
+#  `default`  -- lxml's defaults
+parserProfiles = {
+    'default': {},
+    'document': {
+        'remove_comments': True,
+        'huge_tree': True,
+        'collect_ids': False,
+    },
+    'data': {
+        'remove_comments': True,
+        'remove_blank_text': True,
+        'collect_ids': False,
+    },
+}
+
+_parsers = threading.local()
+
+
+def parserOptions(profile='document', **overrides):
+    """ Returns the XMLParser keyword arguments for a profile (these can
+        also be passed to `etree.iterparse`).
+    """
+    options = dict(parserProfiles[profile])
+    options.update(overrides)
+    return options
+
+
+def makeParser(profile='document', **overrides):
+    """ Returns a new XMLParser for a profile (for when the parser is to be
+        customised, e.g. with a resolver).
+    """
+    return etree.XMLParser(**parserOptions(profile, **overrides))
+
+
+def getParser(profile='document'):
+    """ Returns a shared XMLParser for a profile (parsers can't be used by
+        more than one thread at once, so each thread gets its own).
+    """
+    parsers = getattr(_parsers, 'parsers', None)
+    if parsers is None:
+        parsers = _parsers.parsers = {}
+    if profile not in parsers:
+        parsers[profile] = makeParser(profile)
+    return parsers[profile]
+
 
 def detectSchematype(schema):
     if schema[-3:] in validators.keys():
@@ -66,20 +128,30 @@ def stripComments(tree):
         el.getparent().remove(el)
 
 
-def validateXML(tree, name, schema=None, schematype=None):
+def getValidator(schema, schematype=None):
+    """ Compiles a schema, and returns the validator (or None). """
 
     if schema is None:
         logging.error('No XML schema specified!')
-        return False
+        return None
 
     if schematype is None: schematype = detectSchematype(schema)
     if schematype == False:
         logging.error('XML schema-type cannot be determined!')
-        return False
+        return None
 
     logging.debug('XML Schema: %s (%s)' % (schema, schematype))
 
-    validator = validators[schematype](etree.parse(schema))
+    return validators[schematype](etree.parse(schema, getParser('data')))
+
+
+def validateXML(tree, name, schema=None, schematype=None, validator=None):
+
+    if validator is None:
+        validator = getValidator(schema, schematype)
+        if validator is None:
+            return False
+
     if validator(tree):
         logging.info('The %s tree has passed validation!' % name)
         return True
@@ -92,6 +164,7 @@ def validateXML(tree, name, schema=None, schematype=None):
         return False
 
 
+@staged('stripNamespaces')
 def stripNamespaces(tree):
     import io
 
@@ -128,12 +201,312 @@ def stripNamespaces(tree):
 
     return tree
 
+XI_NS = 'http://www.w3.org/2001/XInclude'
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+
+
+class DocumentCache():
+    """ Thread-safe LRU cache of parsed (and XIncluded) documents, by path,
+        so that files included by many documents are only parsed once.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self.documents = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, loader):
+        """ Returns the cached value for `path`, calling `loader(path)` to
+            make it if necessary.
+        """
+        with self.lock:
+            if path in self.documents:
+                value = self.documents.pop(path)
+                self.documents[path] = value
+                return value
+
+        value = loader(path)
+
+        with self.lock:
+            self.documents[path] = value
+            while len(self.documents) > self.size:
+                self.documents.popitem(last=False)
+        return value
+
+
+def _url_to_path(url):
+    """ Converts a (file) URL or path to an absolute path. """
+    if url.startswith('file://'):
+        url = urllib.unquote(url[len('file://'):])
+    return os.path.abspath(url)
+
+
+def _load_included(path, cache=None):
+    """ Loads an included document (resolving its own XIncludes), and
+        returns (root_element, set_of_files_loaded).
+    """
+    tree = etree.parse(path, getParser('document'))
+    files = xinclude(tree, threads=1, cache=cache)
+    files.add(path)
+    return tree.getroot(), files
+
+
+@staged('xinclude')
+def xinclude(tree, threads=4, cache=None):
+    """ Resolves the XIncludes in a tree, like `tree.xinclude()`, except that
+        the included files are parsed in a thread pool (libxml2 parses
+        without the GIL), and if a DocumentCache is given, files shared
+        between documents are only parsed once.  Returns the set of files
+        loaded.
+
+        Only whole-file includes (parse="xml" or "text") are handled here --
+        anything else (xpointer, xi:fallback, etc.) is left to libxml2.
+    """
+    root = tree.getroot() if hasattr(tree, 'getroot') else tree
+    fallback = '{{{0}}}fallback'.format(XI_NS)
+    includes = []
+    unhandled = False
+    for include in root.iter('{{{0}}}include'.format(XI_NS)):
+        if include.get('xpointer') is not None or \
+           include.get('parse', 'xml') not in ('xml', 'text') or \
+           include.find(fallback) is not None or \
+           next(include.iterancestors(fallback), None) is not None:
+            unhandled = True
+            continue
+        base_dir = os.path.dirname(_url_to_path(include.base or '.'))
+        path = os.path.normpath(os.path.join(base_dir, include.get('href')))
+        includes.append((include, path, base_dir))
+
+    def load(include_info):
+        """ Loads one included file (in a pool thread). """
+        include, path = include_info[:2]
+        if include.get('parse', 'xml') == 'text':
+            with open(path, 'rb') as text_file:
+                return (text_file.read().decode(
+                                include.get('encoding', 'utf-8')), set([path]))
+        if cache is not None:
+            return cache.get(path, lambda p: _load_included(p, cache))
+        return _load_included(path)
+
+    if threads > 1 and len(includes) > 1:
+        pool = ThreadPool(min(threads, len(includes)))
+        loaded = pool.map(load, includes)
+        pool.close()
+        pool.join()
+    else:
+        loaded = [load(include_info) for include_info in includes]
+
+    files = set()
+    for (include, path, base_dir), (content, content_files) in \
+                                                    zip(includes, loaded):
+        files.update(content_files)
+        parent = include.getparent()
+        if include.get('parse', 'xml') == 'text':
+            # splice the text (and the include's tail) into the parent
+            text = content + (include.tail or '')
+            previous = include.getprevious()
+            if previous is not None:
+                previous.tail = (previous.tail or '') + text
+            else:
+                parent.text = (parent.text or '') + text
+            parent.remove(include)
+        else:
+            # (copied, as cached documents may be included again)
+            included = deepcopy(content)
+            if os.path.dirname(path) != base_dir:
+                included.set('{{{0}}}base'.format(XML_NS),
+                             include.get('href'))
+            included.tail = include.tail
+            parent.replace(include, included)
+
+    if unhandled:
+        root.getroottree().xinclude()
+
+    return files
+
+
+def expandPaths(patterns):
+    """ Expands a list of paths and glob patterns (directories are searched
+        for *.xml files), keeping the order and dropping duplicates.
+    """
+    paths = OrderedDict()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.xml')
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            logging.warning('No files match %s' % pattern)
+        for path in matches:
+            paths[path] = True
+    return paths.keys()
+
+
+def writeAtomically(tree, path):
+    """ Writes an ElementTree over a file, via a temp file and a rename, so
+        that the file is never left half-written.
+    """
+    encoding = tree.docinfo.encoding or 'utf-8'
+    writeFileAtomically(etree.tostring(tree, xml_declaration=True,
+                                       encoding=encoding) + '\n', path)
+
+
+def writeFileAtomically(data, path):
+    """ Writes a (byte) string over a file, as `writeAtomically` does. """
+    tmpPath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmpPath, 'wb') as tmpFile:
+            tmpFile.write(data)
+        if os.path.exists(path):
+            os.chmod(tmpPath, os.stat(path).st_mode)
+        os.rename(tmpPath, path)
+    finally:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
+
+def commandParser(command, opts):
+    """ Returns the parser (profile, overrides) for a command-line command
+        (validation may need the ids, and comments are only removed from
+        formatted files if asked).
+    """
+    if command == 'validate':
+        return ('document', {'collect_ids': True})
+    return ('data', {'remove_comments': opts.removeComments})
+
+
+# per-process state for batch runs (the schema is compiled once per worker)
+_BATCH = {}
+
+
+def _initBatch(command, opts, validator=None):
+    _BATCH['command'] = command
+    _BATCH['opts'] = opts
+    profile, overrides = commandParser(command, opts)
+    _BATCH['parser'] = makeParser(profile, **overrides)
+    if command == 'validate':
+        if validator is None:
+            # (an exception here would have the pool respawn the worker
+            #  forever -- the schema has been checked in the parent anyway)
+            try:
+                validator = getValidator(opts.schema, opts.schematype)
+            except (IOError, etree.LxmlError):
+                validator = None
+        _BATCH['validator'] = validator
+
+
+def _processFile(path):
+    """ Runs the batch command on one file, and returns
+        (path, succeeded, error message).
+    """
+    opts = _BATCH['opts']
+    try:
+        tree = etree.parse(path, _BATCH['parser'])
+    except (IOError, etree.XMLSyntaxError), e:
+        return (path, False, str(e))
+
+    if _BATCH['command'] == 'validate':
+        validator = _BATCH['validator']
+        if validator is None:
+            return (path, False, 'no usable schema')
+        if validator(tree):
+            return (path, True, None)
+        log = validator.error_log
+        return (path, False, '%d errors, the first: line %d: %s' %
+                                    (len(log), log[0].line, log[0].message))
+
+    if opts.removeComments:
+        stripComments(tree)
+    formatTree(tree.getroot(), opts.indent)
+    try:
+        writeAtomically(tree, path)
+    except (IOError, OSError), e:
+        return (path, False, str(e))
+    return (path, True, None)
+
+
+def processFiles(command, paths, opts, jobs=None):
+    """ Runs a command (`validate`, or `format` in place) over many files in
+        a process pool, logs a summary, and returns the failures.
+    """
+    if jobs is None:
+        jobs = cpu_count()
+    start = time.time()
+    failures = []
+
+    # check the schema once, here, before any worker needs it
+    validator = None
+    if command == 'validate':
+        try:
+            validator = getValidator(opts.schema, opts.schematype)
+        except (IOError, etree.LxmlError), e:
+            logging.error('Unable to load the schema %s: %s' % (opts.schema, e))
+        if validator is None:
+            sys.exit(1)
+
+    if jobs > 1 and len(paths) > 1:
+        pool = Pool(min(jobs, len(paths)), _initBatch, (command, opts))
+        results = pool.imap_unordered(_processFile, paths,
+                                      max(1, len(paths) // (jobs * 4)))
+    else:
+        pool = None
+        _initBatch(command, opts, validator)
+        results = (_processFile(path) for path in paths)
+
+    for path, succeeded, error in results:
+        if succeeded:
+            logging.debug('%s: OK' % path)
+        else:
+            logging.warning('%s: %s' % (path, error))
+            failures.append((path, error))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start
+    logging.info('%s: %d files, %d OK, %d failed in %.1fs (%.1f files/s)' %
+        (command, len(paths), len(paths) - len(failures), len(failures),
+         elapsed, len(paths) / max(elapsed, 0.001)))
+
+    return failures
+
+
+def _measureParse(args):
+    """ Parses a file with a profile's parser, and returns (seconds, peak
+        memory growth in KB).  Meant to be run in a fresh process.
+    """
+    path, profile = args
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    etree.parse(path, makeParser(profile))
+    elapsed = time.time() - start
+    return (elapsed,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - maxrss)
+
+
+def compareParsers(paths, profiles=('default', 'document', 'data')):
+    """ Logs the parse time and memory of each file with each parser
+        profile (each parse is done in a new process, so that the memory
+        figures are independent).
+    """
+    for path in paths:
+        for profile in profiles:
+            pool = Pool(1)
+            elapsed, memory = pool.apply(_measureParse, ((path, profile),))
+            pool.close()
+            pool.join()
+            logging.info('%s (%s): %.3fs, %d KB' %
+                                        (path, profile, elapsed, memory))
+
+
 if __name__ == '__main__':
 
     optp = optparse.OptionParser(
-                usage=('usage: %prog [options] command filename\n\n\n'
+                usage=('usage: %prog [options] command [filename|glob ...]\n\n\n'
                      'Commands:\n  validate\tPerform XML validation against a schema'
-                     '\n  format\tCleanup and prettify an XML tree (output to STDOUT)\n'),
+                     '\n  format\tCleanup and prettify an XML tree (output to STDOUT)'
+                     '\n  parsers\tCompare parse time and memory with each parser profile\n\n'
+                     'With more than one file, the files are processed in parallel.'),
                 version='%s v%s' % (__program_name__, __version__)
     )
 
@@ -171,14 +544,82 @@ if __name__ == '__main__':
                         help='strip out XML comments [%default]'
                     )
 
+    formatOpts.add_option('--in-place',
+                        action='store_true',
+                        dest='inPlace',
+                        default=False,
+                        help=('rewrite the files in place, instead of printing '
+                              'them (needed for more than one file) [%default]')
+                    )
+
     optp.add_option_group(formatOpts)
 
+    optp.add_option('-j', '--jobs',
+                        type='int',
+                        dest='jobs',
+                        default=cpu_count(),
+                        help='number of worker processes for many files [%default]'
+                    )
+
+    optp.add_option('--memprofile',
+                        dest='memprofile',
+                        metavar='FILE',
+                        help=('write the memory used by each stage to FILE (and '
+                              'FILE.json); the worker processes of a batch '
+                              'aren\'t included, so use -j 1 for those')
+                    )
+
     opts, args = optp.parse_args()
 
+    if opts.memprofile is not None:
+        atexit.register(enableMemProfile().save, opts.memprofile)
+
     if len(args) == 0:
         optp.print_help()
         sys.exit()
 
+    if args[0] == 'parsers':
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s.%(msecs)03d (%(module)s) %(levelname)-8s: %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        )
+        compareParsers(expandPaths(args[1:]))
+        sys.exit()
+
+    if len(args) == 2 and args[0] == 'format' and not opts.inPlace and \
+       (os.path.isdir(args[1]) or glob.has_magic(args[1])):
+        # (a folder or glob is only printed if it comes to a single file)
+        paths = expandPaths(args[1:])
+        if not paths:
+            optp.error('No input files found!')
+        if len(paths) > 1:
+            optp.error('%s matches %d files -- formatting more than one file '
+                       'needs --in-place' % (args[1], len(paths)))
+        args[1] = paths[0]
+
+    if len(args) > 2 or (len(args) == 2 and opts.inPlace) or \
+       (len(args) == 2 and args[0] == 'validate' and
+            (os.path.isdir(args[1]) or glob.has_magic(args[1]))):
+
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s.%(msecs)03d (%(module)s) %(levelname)-8s: %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        )
+
+        if args[0] not in ('validate', 'format'):
+            optp.error('Command not found: %s' % args[0])
+        if args[0] == 'format' and not opts.inPlace:
+            optp.error('formatting more than one file needs --in-place')
+
+        paths = expandPaths(args[1:])
+        if not paths:
+            optp.error('No input files found!')
+        with stage(args[0]):
+            failures = processFiles(args[0], paths, opts, opts.jobs)
+        sys.exit(1 if failures else 0)
+
     if len(args) == 2:
         iFile = args[1]
     else:
@@ -195,7 +636,10 @@ if __name__ == '__main__':
     )
 
     try:
-        tree = etree.parse(iFile).getroot()
+        profile, overrides = commandParser(args[0], opts)
+        with stage('parse'):
+            tree = etree.parse(iFile,
+                               makeParser(profile, **overrides)).getroot()
     except IOError:
         logging.fatal('Error reading %s' % iFile)
         sys.exit(2)
@@ -204,14 +648,20 @@ if __name__ == '__main__':
         sys.exit(2)
 
     if args[0] == 'validate':
-        if validateXML(tree, opts.schema, opts.schematype):
+        name = args[1] if len(args) == 2 else 'input'
+        with stage('validate'):
+            valid = validateXML(tree, name, opts.schema, opts.schematype)
+        if valid:
             sys.exit(0)
         else:
             sys.exit(1)
     elif args[0] == 'format':
-        if opts.removeComments:
-            stripComments(tree)
-        formatTree(tree, opts.indent)
-        print etree.tostring(tree, pretty_print=True, xml_declaration=False, encoding='utf-8')
+        with stage('format'):
+            if opts.removeComments:
+                stripComments(tree)
+            formatTree(tree, opts.indent)
+            output = etree.tostring(tree, pretty_print=True,
+                                    xml_declaration=False, encoding='utf-8')
+        print output
     else:
         optp.error('Command not found: %s' % args[0])
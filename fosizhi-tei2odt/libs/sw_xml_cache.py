@@ -0,0 +1,127 @@
+#-*- coding:utf-8 -*-
+
+""" On-disk cache of prepared (parsed, XIncluded, transformed...) XML
+    trees, invalidated when any of the files they were built from changes.
+"""
+
+__program_name__ = 'sw_xml_cache'
+__version__ = '0.1'
+__author__ = 'Simon Wiles'
+__email__ = 'simonjwiles@gmail.com'
+__copyright__ = 'Copyright (c) 2010-2011, Simon Wiles'
+__license__ = 'GPL http://www.gnu.org/licenses/gpl.txt'
+__date__ = 'April, 2011'
+
+import os
+import json
+import urllib
+import hashlib
+import logging
+from lxml import etree
+
+# bump this if the layout (or the parsing) of the cache files changes
+CACHE_FORMAT = 2
+
+
+class DependencyRecorder(etree.Resolver):
+    """ Parser resolver which records every file that the parser (or
+        XInclude) loads, and otherwise leaves resolving to libxml2.
+    """
+
+    def __init__(self):
+        etree.Resolver.__init__(self)
+        self.files = set()
+
+    def resolve(self, url, public_id, context):
+        if url.startswith('file://'):
+            url = urllib.unquote(url[len('file://'):])
+        if '://' not in url:
+            self.files.add(os.path.abspath(url))
+        return None
+
+
+def file_stamp(file_path):
+    """ Returns the [mtime, size] of a file (or None if it has gone). """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size]
+
+
+class XMLCache():
+    """ A folder of cached XML trees.  Each cache file is a one-line JSON
+        header (recording the source files and their stamps), followed by
+        the serialized tree.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_cache_path(self, key):
+        """ Returns the path of the cache file for a key. """
+        return os.path.join(self.cache_dir, '{0}.xml'.format(
+                    hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+    def read_header(self, cache_file, key):
+        """ Reads the header of an open cache file, and returns it, or None
+            if the file isn't current for `key`.
+        """
+        header = json.loads(cache_file.readline())
+        if header.get('format') != CACHE_FORMAT or header.get('key') != key:
+            return None
+        for file_path, stamp in header['dependencies'].items():
+            if file_stamp(file_path) != stamp:
+                logging.debug('Cache for %s is stale (%s has changed)',
+                              key, file_path)
+                return None
+        return header
+
+    def dependencies(self, key):
+        """ Returns the source files of the cached tree for `key`, with their
+            stamps ({path: [mtime, size]}), or None if it isn't cached (or is
+            stale).
+        """
+        cache_path = self.get_cache_path(key)
+        if not os.path.exists(cache_path):
+            return None
+        with open(cache_path, 'rb') as cache_file:
+            header = self.read_header(cache_file, key)
+        return None if header is None else header['dependencies']
+
+    def load(self, key, parser=None):
+        """ Returns the cached tree for `key`, or None if there isn't one or
+            if any of its source files have changed.
+        """
+        cache_path = self.get_cache_path(key)
+        if not os.path.exists(cache_path):
+            return None
+
+        with open(cache_path, 'rb') as cache_file:
+            if self.read_header(cache_file, key) is None:
+                return None
+            tree = etree.parse(cache_file, parser)
+
+        logging.debug('Loaded %s from the cache', key)
+        return tree
+
+    def save(self, key, tree, dependencies):
+        """ Caches a tree, built from the `dependencies` (file paths). """
+        header = {
+            'format': CACHE_FORMAT,
+            'key': key,
+            'dependencies': dict((file_path, file_stamp(file_path))
+                                        for file_path in dependencies),
+        }
+        cache_path = self.get_cache_path(key)
+
+        # write to a temp file and rename it, so that readers never see a
+        #  half-written cache file
+        temp_path = '{0}.{1}.tmp'.format(cache_path, os.getpid())
+        with open(temp_path, 'wb') as cache_file:
+            cache_file.write(json.dumps(header))
+            cache_file.write('\n')
+            cache_file.write(etree.tostring(tree, encoding='utf-8'))
+        os.rename(temp_path, cache_path)
@@ -3,9 +3,12 @@
 
 import os
 import sys
+import time
+import atexit
+import optparse
 
 from sw_xml import *
-from copy import deepcopy
+from multiprocessing.pool import ThreadPool
 
 XML_NS = 'http://www.w3.org/XML/1998/namespace'
 TEI_NS = 'http://www.tei-c.org/ns/1.0'
@@ -46,31 +49,35 @@ def removeUnusedCharDecl(tei):
         are not actually used in the present 志
     """
 
-    refs = []
-
+    # (a chapter on its own has no wrapper div, so its whole text is used)
     wrapper = tei.find('.//{%s}div[@type="wrapper"]' % TEI_NS)
-    for g in wrapper.iter('{%s}g' % TEI_NS):
-        ref = g.get('ref')[1:]
-        if ref not in refs:
-                refs.append(ref)
+    if wrapper is None:
+        wrapper = tei.find('.//{%s}text' % TEI_NS)
+    if wrapper is None:
+        logging.warning('No text found -- keeping the whole charDecl')
+        return
+    refs = set(g.get('ref')[1:] for g in wrapper.iter('{%s}g' % TEI_NS)
+                                            if g.get('ref') is not None)
 
     charDecl = tei.find('.//{%s}charDecl' % TEI_NS)
     if charDecl is not None:
-        for glyph in charDecl.iter('{%s}glyph' % TEI_NS):
+        # (collected first, as removing elements during iter() skips some)
+        for glyph in list(charDecl.iter('{%s}glyph' % TEI_NS)):
             ref = glyph.get('{%s}id' % XML_NS)
             if ref in refs:
                 refs.remove(ref)
             else:
-                charDecl.remove(glyph)
+                glyph.getparent().remove(glyph)
 
     """ report any missing Gaiji """
     if len(refs):
         logging.warning(
             'The folling Gaijis are not found in the encodingDesc:\n\t%s' % \
-                    '\n\t'.join(refs))
+                    '\n\t'.join(sorted(refs)))
 
 
-def dumpTEI(tei):
+@staged('cleanTEI')
+def cleanTEI(tei):
     """ remove unused glyph declarations """
     removeUnusedCharDecl(tei)
     encodingDesc = tei.find(
@@ -83,32 +90,125 @@ def dumpTEI(tei):
     """ cleanup namespaces """
     tei_new = etree.Element(
         '{%s}TEI' % TEI_NS, nsmap={None: TEI_NS, 'xml': XML_NS})
-    tei_new[:] = deepcopy(tei[:])
+    # (the children are moved, not copied -- `tei` is finished with)
+    tei_new[:] = tei[:]
     etree.cleanup_namespaces(tei_new)
 
-    """ output a nice clean, complete TEI doc """
     stripComments(tei_new)
     #formatTree(tei_new)
-    teiXML = etree.tostring(
-        tei_new, pretty_print=True, xml_declaration=False, encoding='utf-8')
+    return tei_new
+
 
-    print teiXML
+def dumpTEI(tei):
+    """ return a nice clean, complete TEI doc (serialized the same way for
+        stdout and for the --outputDir files) """
+    tei = cleanTEI(tei)
+    with stage('serialize'):
+        teiXML = etree.tostring(tei,
+                pretty_print=True, xml_declaration=False, encoding='utf-8')
+
+    return teiXML + '\n'
+
+
+def loadTEI(iFile, cache=None):
+    """ get the TEI, and parse XIncludes (with a DocumentCache, the parts
+        shared between gazetteers -- master header, charDecl -- are only
+        parsed once) """
+    with stage('parse'):
+        tei = etree.parse(iFile, getParser('document'))
+    xinclude(tei, cache=cache)
+    return tei.getroot()
+
+
+def exportTEI(task):
+    """ write the clean TEI for one main file to the output directory """
+    iFile, outputDir, cache = task
+    start = time.time()
+    try:
+        teiXML = dumpTEI(loadTEI(iFile, cache))
+        oFile = os.path.join(outputDir, os.path.basename(iFile))
+        writeFileAtomically(teiXML, oFile)
+    except Exception, e:
+        # (recorded as a failure, so that the other files carry on)
+        logging.error('Error exporting %s: %s: %s' %
+                                        (iFile, type(e).__name__, e))
+        return (iFile, False, time.time() - start)
+    logging.debug('Wrote %s' % oFile)
+    return (iFile, True, time.time() - start)
+
+
+def exportAll(iFiles, outputDir, jobs=4):
+    """ export many gazetteers, concurrently, sharing the parsed master
+        parts; returns the number which failed """
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+
+    start = time.time()
+    cache = DocumentCache()
+    pool = ThreadPool(max(1, min(jobs, len(iFiles))))
+    results = pool.map(exportTEI,
+                        [(iFile, outputDir, cache) for iFile in iFiles], 1)
+    pool.close()
+    pool.join()
+
+    failed = len([r for r in results if not r[1]])
+    logging.info('Exported %d of %d gazetteers to %s in %.1fs' %
+                    (len(iFiles) - failed, len(iFiles), outputDir,
+                     time.time() - start))
+    return failed
 
 
 if __name__ == '__main__':
 
-    iFile = sys.argv[1]
+    optp = optparse.OptionParser(
+                usage=('usage: %prog [options] main_file\n'
+                       '       %prog [options] -o output_dir main_file|glob '
+                       '...\n\n'
+                       'Writes a clean, self-contained TEI file for a '
+                       'gazetteer (to STDOUT), or\nfor many at once, into '
+                       'an output directory.'))
+
+    optp.add_option('-o', '--outputDir', dest='outputDir',
+                        help='directory to write the TEI files to')
+
+    optp.add_option('-j', '--jobs', dest='jobs', type='int', default=4,
+                        help='gazetteers to export at once [%default]')
+
+    optp.add_option('--memprofile', dest='memprofile', metavar='FILE',
+                        help='write the memory used at each stage to FILE '
+                             '(and FILE.json)')
+
+    opts, args = optp.parse_args()
+
+    if opts.memprofile is not None:
+        atexit.register(enableMemProfile().save, opts.memprofile)
+
+    if not args:
+        optp.print_help()
+        raise SystemExit
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s.%(msecs)03d (%(module)s) %(levelname)-8s: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    if opts.outputDir is not None:
+        iFiles = expandPaths(args)
+        if not iFiles:
+            optp.error('No input files found!')
+        if exportAll(iFiles, opts.outputDir, opts.jobs):
+            sys.exit(1)
+        sys.exit()
+
+    if len(args) > 1:
+        optp.error('More than one file needs an --outputDir')
 
     """ get the TEI """
     try:
-        tei = etree.parse(iFile)
+        tei = loadTEI(args[0])
     except IOError:
-        print >> sys.stderr, 'bad input file %s' % iFile
+        print >> sys.stderr, 'bad input file %s' % args[0]
         raise SystemExit
 
-    """ parse XIncludes """
-    tei.xinclude()
-    tei = tei.getroot()
-
-    dumpTEI(tei)
-
+    sys.stdout.write(dumpTEI(tei))
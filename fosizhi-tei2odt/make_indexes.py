@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+""" Build the person, place and date indexes for the whole corpus straight
+    from the TEI (no OpenOffice, so no page numbers -- positions are given
+    by chapter, paragraph and sequence within the chapter).
+"""
+
+import os
+import csv
+import sqlite3
+import logging
+import multiprocessing
+from lxml import etree
+from sw_misc import prep_logging, get_parser
+from sw_xml import parserOptions
+from tei_source import tei_path, list_gazetteers, chapter_files
+
+import settings
+
+# the tags to index, and the kinds of entry they make
+INDEX_TAGS = {
+    'persName': 'person',
+    'placeName': 'place',
+    'date': 'date',
+}
+
+INDEX_COLUMNS = ('kind', 'key', 'appears_as', 'gazetteer', 'chapter',
+                 'paragraph', 'seq')
+
+
+def date_key(elm):
+    """ Returns the western date for a <date> (as `settings.date`). """
+    if elm.get('notBefore') is not None and elm.get('notAfter') is not None:
+        return '{0} -> {1}'.format(elm.get('notBefore'), elm.get('notAfter'))
+    elif elm.get('from') is not None and elm.get('to') is not None:
+        return '{0} -> {1}'.format(elm.get('from'), elm.get('to'))
+    return elm.get('when')
+
+
+def index_chapter(task):
+    """ Streams a chapter file, and returns its index rows. """
+    gaz, chapter_file = task
+    rows = []
+    chapter = None
+    paragraph = 0
+    seq = 0
+    depth = 0
+
+    for event, elm in etree.iterparse(chapter_file, events=('start', 'end'),
+                                      **parserOptions('document')):
+        tag = elm.tag.rsplit('}', 1)[-1]
+
+        if event == 'start':
+            if chapter is None:
+                chapter = elm.get('id') or os.path.basename(chapter_file)
+            if tag in settings.PARASTYLE_TAGS:
+                paragraph += 1
+            depth += 1
+            continue
+
+        depth -= 1
+        if tag in INDEX_TAGS:
+            seq += 1
+            key = date_key(elm) if tag == 'date' else elm.get('key')
+            rows.append((INDEX_TAGS[tag], key, u''.join(elm.itertext()),
+                         gaz, chapter, paragraph, seq))
+
+        # discard what we've finished with (but only at the top level, so
+        #  that nothing is lost from an element still being read)
+        if depth == 1:
+            elm.clear()
+            while elm.getprevious() is not None:
+                del elm.getparent()[0]
+
+    return rows
+
+
+def write_sqlite(output_file, results):
+    """ Writes the index rows to an SQLite database. """
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    db = sqlite3.connect(output_file)
+    db.execute('CREATE TABLE occurrences (kind TEXT, key TEXT, '
+               'appears_as TEXT, gazetteer TEXT, chapter TEXT, '
+               'paragraph INTEGER, seq INTEGER)')
+    count = 0
+    for rows in results:
+        db.executemany('INSERT INTO occurrences VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       rows)
+        count += len(rows)
+    db.execute('CREATE INDEX occurrences_key ON occurrences (kind, key)')
+    db.commit()
+    db.close()
+    return count
+
+
+def write_csv(output_file, results):
+    """ Writes the index rows to a CSV file. """
+    count = 0
+    with open(output_file, 'wb') as csv_file:
+        writer = csv.writer(csv_file, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(INDEX_COLUMNS)
+        for rows in results:
+            writer.writerows([[value.encode('utf-8')
+                    if isinstance(value, unicode) else value
+                            for value in row] for row in rows])
+            count += len(rows)
+    return count
+
+
+def main():
+    """ Build the entity indexes. """
+
+    parser = get_parser()
+
+    parser.add_option('-g', '--gazetteer', dest='gazetteers', action='append',
+                        help='Gazetteer to index (e.g. g008; may be given '
+                                    'more than once) [all of them]')
+
+    parser.add_option('--teiBase', dest='teiBase', action='store',
+                        default=settings.TEI_BASE,
+                        help='path to TEI files (eXist dump) ({0})'\
+                                                .format(settings.TEI_BASE))
+
+    parser.add_option('-o', '--output', dest='destFile', action='store',
+                        default='entityIndex.sqlite',
+                        help='output file -- SQLite, or CSV if it ends in '
+                                    '".csv" [%default]')
+
+    parser.add_option('-j', '--jobs', dest='jobs', action='store',
+                        type='int', default=multiprocessing.cpu_count(),
+                        help='number of worker processes [%default]')
+
+    opts = parser.parse_args()[0]
+
+    prep_logging(opts.verbose, opts.quiet)
+
+    gazetteers = opts.gazetteers or list_gazetteers(opts.teiBase)
+    tasks = []
+    for gaz in gazetteers:
+        for chapter_file in chapter_files(tei_path(opts.teiBase, gaz)):
+            tasks.append((gaz, chapter_file))
+    logging.debug('Indexing %d chapters of %d gazetteers',
+                  len(tasks), len(gazetteers))
+
+    pool = multiprocessing.Pool(opts.jobs)
+    results = pool.imap(index_chapter, tasks)
+
+    if opts.destFile.lower().endswith('.csv'):
+        count = write_csv(opts.destFile, results)
+    else:
+        count = write_sqlite(opts.destFile, results)
+
+    pool.close()
+    pool.join()
+
+    logging.info('Wrote %d index entries to %s', count, opts.destFile)
+
+
+if __name__ == '__main__':
+    main()
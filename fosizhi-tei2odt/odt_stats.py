@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+""" Checks rendered ODTs without OpenOffice: each one's `content.xml` is
+    streamed straight out of the zip (see sw_openoffice_xml.scan_odt), in a
+    pool of processes, for its paragraphs by style, footnotes, characters
+    and any styles it uses without defining them; and if the gazetteer's
+    TEI can be found (by the ODT's name, e.g. g008.odt), the counts are
+    compared with those the TEI should give (see tag_census.py).
+
+      odt_stats.py output/            (every .odt in a folder)
+      odt_stats.py -v g008.odt g009.odt
+
+    Exits with status 1 if any ODT has a problem.
+"""
+
+import os
+import glob
+import json
+import logging
+import multiprocessing
+from collections import Counter
+from sw_misc import prep_logging, get_parser
+from sw_openoffice_xml import scan_odt
+from tei_source import tei_path, chapter_files
+from tag_census import census_file
+
+import settings
+
+# paragraph styles which the TEI doesn't account for
+UNCOUNTED_STYLES = ('Default', 'Standard')
+
+
+def odt_paths(patterns):
+    """ Expands a list of ODT paths, folders and glob patterns. """
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.odt')
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            logging.warning('No files match %s', pattern)
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+
+def expected_counts(xml_file):
+    """ Returns the paragraphs (by style) and footnotes a gazetteer's TEI
+        should render to.
+    """
+    tags = Counter()
+    styles = Counter()
+    for chapter_file in chapter_files(xml_file):
+        chapter, file_tags, rends, file_styles, error = \
+                                                census_file(chapter_file)
+        if error is not None:
+            raise IOError(error)
+        tags.update(file_tags)
+        styles.update(file_styles)
+
+    paragraphs = dict((name, count) for (style_type, name), count
+                            in styles.items()
+                                    if style_type == 'Paragraph' and count)
+    # (each choice adds a footnote, with a paragraph of its own)
+    notes = sum(tags[tag] for tag in settings.FOOTNOTE_TAGS) + tags['choice']
+    paragraphs['Footnote'] = paragraphs.get('Footnote', 0) + tags['choice']
+    return {'paragraphs': paragraphs, 'footnotes': notes}
+
+
+def compare_counts(stats, expected):
+    """ Returns the differences between an ODT's counts and those expected
+        from its TEI.  (Line breaks split paragraphs, so there may be more
+        paragraphs than elements, but never fewer.)
+    """
+    problems = []
+    footnotes = stats['notes'].get('footnote', 0)
+    if footnotes != expected['footnotes']:
+        problems.append('{0} footnotes, but the TEI has {1}'.format(
+                                            footnotes, expected['footnotes']))
+    for style_name, count in sorted(expected['paragraphs'].items()):
+        found = stats['paragraphs'].get(style_name, 0)
+        if found < count:
+            problems.append('{0} "{1}" paragraphs, but the TEI has {2}'
+                                .format(found, style_name, count))
+    unexpected = sorted(style_name for style_name in stats['paragraphs']
+                            if style_name not in expected['paragraphs'] and
+                                style_name not in UNCOUNTED_STYLES)
+    if unexpected:
+        problems.append('paragraphs in styles the TEI doesn\'t use: {0}'
+                            .format(', '.join(unexpected)))
+    return problems
+
+
+def check_odt(task):
+    """ Scans an ODT, and compares it with its TEI (in a worker process).
+        Returns (odt_file, stats, expected counts, problems).
+    """
+    odt_file, tei_base = task
+    try:
+        stats = scan_odt(odt_file)
+    except Exception, exc:
+        return odt_file, None, None, ['can\'t read it: {0}'.format(exc)]
+
+    problems = ['undefined {0} style "{1}"'.format(family, name)
+                    for family, name in stats['unknown_styles']]
+
+    expected = None
+    xml_file = None
+    if tei_base is not None:
+        gaz = os.path.basename(odt_file).split('.')[0]
+        xml_file = tei_path(tei_base, gaz)
+    if xml_file is not None and os.path.exists(xml_file):
+        try:
+            expected = expected_counts(xml_file)
+        except IOError, exc:
+            problems.append('can\'t read the TEI: {0}'.format(exc))
+        else:
+            problems.extend(compare_counts(stats, expected))
+
+    return odt_file, stats, expected, problems
+
+
+def main():
+    """ Check rendered ODTs. """
+
+    parser = get_parser()
+    parser.usage = '%prog [options] ODT|folder|glob ...'
+
+    parser.add_option('--teiBase', dest='teiBase', action='store',
+                        default=settings.TEI_BASE,
+                        help='path to TEI files, to compare with ({0})'\
+                                            .format(settings.TEI_BASE))
+
+    parser.add_option('--noTEI', dest='noTEI', action='store_true',
+                        default=False,
+                        help='don\'t compare the ODTs with their TEI')
+
+    parser.add_option('-j', '--jobs', dest='jobs', action='store',
+                        type='int', default=multiprocessing.cpu_count(),
+                        help='worker processes [%default]')
+
+    parser.add_option('--json', dest='jsonFile', action='store',
+                        help='also write the statistics to this JSON file')
+
+    opts, args = parser.parse_args()
+
+    if not args:
+        parser.print_help()
+        raise SystemExit
+
+    prep_logging(opts.verbose, opts.quiet)
+
+    odt_files = odt_paths(args)
+    tei_base = None if opts.noTEI else opts.teiBase
+
+    pool = multiprocessing.Pool(max(1, min(opts.jobs, len(odt_files) or 1)))
+    results = sorted(pool.imap_unordered(check_odt,
+                            [(odt_file, tei_base) for odt_file in odt_files]))
+    pool.close()
+    pool.join()
+
+    failed = 0
+    for odt_file, stats, expected, problems in results:
+        if stats is not None:
+            logging.info('%s: %d paragraphs, %d footnotes, %d characters%s',
+                         odt_file, sum(stats['paragraphs'].values()),
+                         stats['notes'].get('footnote', 0),
+                         stats['characters'],
+                         '' if expected is None else ' (checked with the TEI)')
+            for style_name, count in sorted(stats['paragraphs'].items()):
+                logging.debug('  %-40s %9d%s', style_name, count,
+                        '' if expected is None else ' (TEI: {0})'.format(
+                            expected['paragraphs'].get(style_name, 0)))
+        for problem in problems:
+            logging.error('%s: %s', odt_file, problem)
+        if problems:
+            failed += 1
+
+    logging.info('%d ODTs checked, %d with problems', len(results), failed)
+
+    if opts.jsonFile is not None:
+        with open(opts.jsonFile, 'w') as json_file:
+            json.dump(dict((odt_file, {'stats': stats, 'expected': expected,
+                                       'problems': problems})
+                        for odt_file, stats, expected, problems in results),
+                      json_file, indent=2, sort_keys=True)
+
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
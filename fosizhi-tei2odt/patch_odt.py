@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+""" Patch the paragraphs which have changed in a gazetteer's TEI into an
+    ODT rendered earlier (with `working.py --bookmarks`), instead of
+    rendering the whole gazetteer again.  No OpenOffice is needed; the
+    changed paragraphs are rendered straight to ODF XML.
+
+    Only changes inside elements with ids can be patched -- if anything
+    else has changed (elements added, removed or moved, or text between
+    them), the gazetteer has to be rendered again.  Index entries for the
+    patched paragraphs are not written, since page numbers can't be known
+    without a layout.
+"""
+
+import os
+import re
+import copy
+import logging
+from lxml import etree
+from sw_misc import prep_logging, get_parser
+from sw_odf import ODFWriter, add_styles, get_known_styles
+from sw_openoffice_xml import OOWriterXML, qualify, renumber_notes
+from tei_source import load_tei, get_wrapper_divs, load_snapshot, \
+                       save_snapshot, snapshot_path, tei_dependencies
+from gaiji import load_glyph_index
+import render
+from render import load_settings, render_elm, end_bookmark_name
+
+import settings
+
+# the note ids of patched elements (each patch takes a new number, as the
+#  ids of earlier patches are still in the ODT)
+PATCH_NOTE_ID = 'patch{0}_ftn'
+PATCH_NOTE_IDS = re.compile(r'patch(\d+)_ftn')
+
+
+def is_patchable(elm):
+    """ Whether an element can be found again in the ODT. """
+    return elm.tag in render.PARASTYLE_TAGS and elm.get('id') is not None
+
+
+def patchable_elements(divs):
+    """ Returns {id: element} for the outermost patchable elements. """
+    elements = {}
+    for div in divs:
+        for elm in div.iter(tag=etree.Element):
+            if is_patchable(elm) and not any(is_patchable(ancestor)
+                                        for ancestor in elm.iterancestors()):
+                elements[elm.get('id')] = elm
+    return elements
+
+
+def skeleton(divs):
+    """ Returns the divs serialized with the contents of the patchable
+        elements left out (so that two versions of a gazetteer have the same
+        skeleton if only the contents of patchable elements differ).
+    """
+    parts = []
+    for div in divs:
+        div = copy.deepcopy(div)
+        for elm_id, elm in patchable_elements([div]).items():
+            tail = elm.tail
+            elm.clear()
+            elm.set('id', elm_id)
+            elm.tail = tail
+        parts.append(etree.tostring(div, encoding='utf-8'))
+    return ''.join(parts)
+
+
+def render_stack(elm, divs):
+    """ Returns the para_style stack `render_elm` would have when it reached
+        an element (rendering from the top-level `divs`), and the character
+        styles open there.
+    """
+    ancestors = []
+    for ancestor in elm.iterancestors():
+        ancestors.insert(0, ancestor)
+        if any(ancestor is div for div in divs):
+            break
+
+    stack = []
+    char_styles = []
+    for ancestor in ancestors:
+        if ancestor.tag in render.FOOTNOTE_TAGS:
+            stack = ['Footnote']
+            char_styles = []
+        else:
+            stack.append(ancestor.tag)
+        if ancestor.tag in render.CHARSTYLE_TAGS:
+            char_style = ancestor.tag
+            if ancestor.get('rend') is not None:
+                char_style = '_'.join([char_style, ancestor.get('rend')])
+            char_styles.append(char_style)
+    return stack, char_styles
+
+
+def render_element(elm, divs, known_styles, note_id_prefix):
+    """ Renders an element (without its tail) to ODF paragraphs, and returns
+        the paragraphs and the writer.
+    """
+    writer = ODFWriter(known_styles, note_id_prefix)
+    stack, char_styles = render_stack(elm, divs)
+    for char_style in char_styles:
+        writer.open_char_style(char_style)
+
+    elm = copy.deepcopy(elm)
+    elm.tail = None
+    render_elm(writer, elm, stack)
+
+    return writer.get_paragraphs(), writer
+
+
+def next_patch_number(content):
+    """ Returns the first number free for the note ids of a patched element
+        in a `content.xml` tree.
+    """
+    numbers = [int(match.group(1)) for match in
+                    (PATCH_NOTE_IDS.search(elm.get(qualify('text:id')))
+                        for elm in content.iter(tag=etree.Element)
+                            if elm.get(qualify('text:id')) is not None)
+                    if match is not None]
+    return max(numbers) + 1 if numbers else 0
+
+
+def find_bookmarks(content):
+    """ Returns {bookmark name: (paragraph, child of the paragraph holding
+        the bookmark)} for the bookmarks in a `content.xml` tree.
+    """
+    bookmarks = {}
+    para_tags = (qualify('text:p'), qualify('text:h'))
+    for bookmark in content.iter(qualify('text:bookmark')):
+        anchor = bookmark
+        while anchor.getparent().tag not in para_tags:
+            anchor = anchor.getparent()
+        bookmarks[bookmark.get(qualify('text:name'))] = \
+                                                (anchor.getparent(), anchor)
+    return bookmarks
+
+
+def move_leading(para, anchor, new_para):
+    """ Moves the text and elements before `anchor` in a paragraph (the
+        tail of whatever preceded the patched element) to the start of
+        `new_para`.
+    """
+    text = new_para.text
+    new_para.text = para.text
+    leading = []
+    for child in para:
+        if child is anchor:
+            break
+        leading.append(child)
+    for index, child in enumerate(leading):
+        new_para.insert(index, child)
+    if leading:
+        leading[-1].tail = (leading[-1].tail or u'') + (text or u'')
+    else:
+        new_para.text = (new_para.text or u'') + (text or u'')
+
+
+def bookmarked_range(bookmarks, elm_id):
+    """ Returns the paragraphs from the one with the element's bookmark to
+        the one with its end bookmark (or None if they can't be found).
+    """
+    if elm_id not in bookmarks or end_bookmark_name(elm_id) not in bookmarks:
+        return None
+    first = bookmarks[elm_id][0]
+    last = bookmarks[end_bookmark_name(elm_id)][0]
+    if first.getparent() is not last.getparent():
+        return None
+    paras = [first]
+    while paras[-1] is not last:
+        paras.append(paras[-1].getnext())
+        if paras[-1] is None:
+            return None
+    return paras
+
+
+def patch_odt(odt_file, divs, old_divs):
+    """ Patches the changed elements into an ODT.  Returns the number of
+        elements patched, or None if the ODT has to be rendered again.
+    """
+    if skeleton(divs) != skeleton(old_divs):
+        logging.warning('The structure of the TEI has changed')
+        return None
+
+    old_elements = patchable_elements(old_divs)
+    changed = [elm for elm_id, elm in sorted(patchable_elements(divs).items())
+                    if etree.tostring(elm, with_tail=False) !=
+                        etree.tostring(old_elements[elm_id], with_tail=False)]
+    if not changed:
+        return 0
+
+    odt = OOWriterXML(odt_file)
+    content = odt.get_content_xml()
+    style_index = odt.get_style_index()
+    styles = style_index.tree
+    known_styles = get_known_styles(style_index)
+
+    bookmarks = find_bookmarks(content)
+    first_number = next_patch_number(content)
+
+    new_styles = {}
+    for index, elm in enumerate(changed):
+        old_paras = bookmarked_range(bookmarks, elm.get('id'))
+        if old_paras is None:
+            logging.warning('Can\'t find "%s" in %s', elm.get('id'), odt_file)
+            return None
+
+        new_paras, writer = render_element(elm, divs, known_styles,
+                                PATCH_NOTE_ID.format(first_number + index))
+        known_styles.update(writer.new_styles)
+        new_styles.update(writer.new_styles)
+
+        move_leading(old_paras[0], bookmarks[elm.get('id')][1], new_paras[0])
+
+        parent = old_paras[0].getparent()
+        position = parent.index(old_paras[0])
+        for para in old_paras:
+            parent.remove(para)
+        for offset, para in enumerate(new_paras):
+            parent.insert(position + offset, para)
+        logging.debug('Patched "%s"', elm.get('id'))
+
+    renumber_notes(content.getroot())
+    odt.save_content(content)
+    if new_styles:
+        add_styles(styles, new_styles)
+        odt.save_styles(styles)
+    odt.save()
+
+    return len(changed)
+
+
+def main():
+    """ Patch an ODT. """
+
+    load_settings(settings)
+
+    parser = get_parser()
+
+    parser.add_option('-g', '--gazetteer', dest='gazetteer', action='store',
+                        help='Gazetteer the ODT was rendered from (e.g. g008)')
+
+    parser.add_option('--teiBase', dest='teiBase', action='store',
+                        default=settings.TEI_BASE,
+                        help='path to TEI files (eXist dump) ({0})'\
+                                            .format(settings.TEI_BASE))
+
+    parser.add_option('--cacheDir', dest='cacheDir', action='store',
+                        default=settings.TEI_CACHE,
+                        help='folder to cache the prepared TEI in ({0})'\
+                                            .format(settings.TEI_CACHE))
+
+    opts, args = parser.parse_args()
+
+    if not opts.gazetteer or len(args) != 1:
+        parser.print_help()
+        raise SystemExit
+
+    prep_logging(opts.verbose, opts.quiet)
+
+    odt_file = args[0]
+    if not os.path.exists(snapshot_path(odt_file)):
+        logging.fatal('There is no TEI snapshot for %s (it must be rendered '
+                      'with --bookmarks)', odt_file)
+        raise SystemExit
+
+    tei = load_tei(opts.teiBase, opts.gazetteer, opts.cacheDir)
+    settings.GLYPHS = load_glyph_index(tei, opts.cacheDir, tei_dependencies(
+                            opts.teiBase, opts.gazetteer, opts.cacheDir))
+    divs = get_wrapper_divs(tei)
+
+    # index entries need page numbers, so they are left to a full render
+    settings.personIndex = settings.placeIndex = open(os.devnull, 'w')
+    render.BOOKMARK_IDS = True
+
+    patched = patch_odt(odt_file, divs, load_snapshot(odt_file))
+    settings.closeup()
+
+    if patched is None:
+        logging.error('%s can\'t be patched -- render it again', odt_file)
+        raise SystemExit(1)
+
+    if patched:
+        save_snapshot(divs, odt_file)
+    logging.info('Patched %d elements in %s', patched, odt_file)
+
+
+if __name__ == '__main__':
+    main()
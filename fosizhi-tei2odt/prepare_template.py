@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+""" Prepares a styles template (.ott) for rendering: the styles of a styles
+    ODT, plus every derived paragraph and character style which the
+    gazetteers need (from the style pre-pass), so that new documents can be
+    opened straight from it with all of their styles in place (see
+    `working.py -s TEMPLATE.ott`, or `--template`).  No OpenOffice is
+    needed.
+
+    The template is only rebuilt when the styles ODT, or the styles the
+    gazetteers need, have changed (a digest of them is kept alongside it,
+    in TEMPLATE.ott.inputs).
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import zipfile
+from contextlib import closing
+from sw_misc import prep_logging, get_parser, make_temp_dir
+from sw_odf import ODFWriter, get_known_styles
+from sw_openoffice_xml import OOWriterXML
+from tei_source import load_tei, get_wrapper_divs, list_gazetteers
+from style_prepass import collect_styles, div_events
+
+import settings
+
+# bump this when the way templates are built changes
+TEMPLATE_FORMAT = 1
+
+TEXT_MIMETYPE = 'application/vnd.oasis.opendocument.text'
+TEMPLATE_MIMETYPE = 'application/vnd.oasis.opendocument.text-template'
+
+
+def corpus_styles(tei_base, gazetteers, cache_dir=None):
+    """ Returns the styles needed by all of the gazetteers (in the form
+        returned by `style_prepass.collect_styles`).
+    """
+    styles = None
+    for gaz in gazetteers:
+        tei = load_tei(tei_base, gaz, cache_dir)
+        styles = collect_styles(div_events(get_wrapper_divs(tei)), styles)
+        logging.debug('Collected the styles of %s', gaz)
+    return styles or {'Paragraph': {}, 'Character': {}}
+
+
+def template_digest(styles_file, needed_styles):
+    """ Returns a digest of the inputs to a template. """
+    digest = hashlib.sha1(str(TEMPLATE_FORMAT))
+    with open(styles_file, 'rb') as input_file:
+        digest.update(input_file.read())
+    digest.update(json.dumps(needed_styles, sort_keys=True))
+    return digest.hexdigest()
+
+
+def inputs_path(template_file):
+    """ Returns the path of the digest kept alongside a template. """
+    return '{0}.inputs'.format(template_file)
+
+
+def is_current(template_file, digest):
+    """ Whether a template exists, and was built from the same inputs. """
+    if not os.path.exists(template_file) or \
+       not os.path.exists(inputs_path(template_file)):
+        return False
+    with open(inputs_path(template_file)) as inputs_file:
+        return inputs_file.read().strip() == digest
+
+
+def mark_as_template(odt_file, template_file):
+    """ Copies an ODT to an OTT, changing its mimetype (which has to be the
+        first entry in the zip, uncompressed).
+    """
+    with closing(zipfile.ZipFile(odt_file)) as source:
+        with closing(zipfile.ZipFile(template_file, 'w',
+                                     zipfile.ZIP_DEFLATED)) as target:
+            target.writestr(zipfile.ZipInfo('mimetype'), TEMPLATE_MIMETYPE)
+            for info in source.infolist():
+                if info.filename == 'mimetype':
+                    continue
+                data = source.read(info.filename)
+                if info.filename == 'META-INF/manifest.xml':
+                    data = data.replace('"{0}"'.format(TEXT_MIMETYPE),
+                                        '"{0}"'.format(TEMPLATE_MIMETYPE))
+                target.writestr(info, data)
+
+
+def build_template(styles_file, needed_styles, template_file):
+    """ Writes a template with the styles of `styles_file` (without its
+        text) and all of the `needed_styles`.  Returns the number of styles
+        added.
+    """
+    writer = ODFWriter(get_known_styles(
+                            OOWriterXML(styles_file).get_style_index()))
+    writer.create_styles(needed_styles)
+
+    odt_file = os.path.join(make_temp_dir(cleanup=True), 'template.odt')
+    writer.save_odt(odt_file, styles_file)
+    mark_as_template(odt_file, template_file)
+    return len(writer.new_styles)
+
+
+def ensure_template(styles_file, needed_styles, template_file, force=False):
+    """ (Re)builds a template, unless it is up to date.  Returns True if it
+        was rebuilt.
+    """
+    digest = template_digest(styles_file, needed_styles)
+    if not force and is_current(template_file, digest):
+        logging.debug('%s is up to date', template_file)
+        return False
+
+    # (written alongside, and moved into place, so that a render which is
+    #  opening the old template never sees half of the new one)
+    temp_file = '{0}.tmp'.format(template_file)
+    added = build_template(styles_file, needed_styles, temp_file)
+    shutil.move(temp_file, template_file)
+    logging.info('Prepared %s (%d styles added)', template_file, added)
+    with open(inputs_path(template_file), 'w') as inputs_file:
+        inputs_file.write(digest)
+    return True
+
+
+def main():
+    """ Prepare a styles template. """
+
+    parser = get_parser()
+
+    parser.add_option('-s', '--styles', dest='stylesFile', action='store',
+                        help='ODT file to take the styles from')
+
+    parser.add_option('-o', '--output', dest='templateFile', action='store',
+                        help='template to write [the styles file, as .ott]')
+
+    parser.add_option('-g', '--gazetteer', dest='gazetteers', action='append',
+                        help='Gazetteer whose styles are needed (may be given '
+                                    'more than once) [all of them]')
+
+    parser.add_option('--teiBase', dest='teiBase', action='store',
+                        default=settings.TEI_BASE,
+                        help='path to TEI files (eXist dump) ({0})'\
+                                            .format(settings.TEI_BASE))
+
+    parser.add_option('--cacheDir', dest='cacheDir', action='store',
+                        default=settings.TEI_CACHE,
+                        help='folder to cache the prepared TEI in ({0})'\
+                                            .format(settings.TEI_CACHE))
+
+    parser.add_option('-f', '--force', dest='force', action='store_true',
+                        default=False,
+                        help='rebuild the template even if it is up to date')
+
+    opts = parser.parse_args()[0]
+
+    if opts.stylesFile is None:
+        parser.print_help()
+        raise SystemExit
+
+    prep_logging(opts.verbose, opts.quiet)
+
+    template_file = opts.templateFile or \
+                    '{0}.ott'.format(os.path.splitext(opts.stylesFile)[0])
+    gazetteers = opts.gazetteers or list_gazetteers(opts.teiBase)
+
+    needed_styles = corpus_styles(opts.teiBase, gazetteers, opts.cacheDir)
+    if not ensure_template(opts.stylesFile, needed_styles, template_file,
+                           opts.force):
+        logging.info('%s is up to date', template_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+#-*- coding:utf-8 -*-
+
+""" Renders TEI elements through a writer (sw_uno.OOWriter, or anything
+    with the same interface).
+"""
+
+import sys
+from lxml import etree
+import logging
+from sw_oplog import apply_ops, text_op
+
+import settings
+
+PROCESSED_TAGS = []
+
+# running totals (read by the telemetry sampler) -- threads rendering
+#  documents at once keep their own, registered in THREAD_STATS (see
+#  `stats`)
+STATS = {'elements': 0}
+THREAD_STATS = []
+
+
+def load_settings(settings):
+    """ Function to load settings from external module. """
+    _thismodule = sys.modules[__name__]
+    _m = settings
+    for _k in dir(_m):
+        if _k.isupper() and not _k.startswith('__'):
+            setattr(_thismodule, _k, getattr(_m, _k))
+
+
+def end_bookmark_name(elm_id):
+    """ Returns the name of the bookmark at the end of an element. """
+    return '{0}_end'.format(elm_id)
+
+
+def processed_tags():
+    """ Returns the tags (and styles) processed so far -- this thread's own
+        list, if it has one (see settings.THREAD_STATE).
+    """
+    return getattr(settings.THREAD_STATE, 'processed_tags', PROCESSED_TAGS)
+
+
+def stats():
+    """ Returns the running totals of this thread (if it has its own, see
+        settings.THREAD_STATE), or the module-level ones.
+    """
+    return getattr(settings.THREAD_STATE, 'stats', STATS)
+
+
+def elements_rendered():
+    """ Returns the number of elements rendered so far, by every thread. """
+    return STATS['elements'] + sum(thread_stats['elements']
+                                        for thread_stats in THREAD_STATS)
+
+
+def index_file(index_name):
+    """ Returns one of the index files in `settings` (this thread's own, if
+        it has one).
+    """
+    return getattr(settings.THREAD_STATE, index_name, None) or \
+           getattr(settings, index_name)
+
+
+def write_index_entry(writer, index_name, key, text):
+    """ Writes an entry to one of the index files in `settings`, with the
+        page number the writer is on.
+    """
+    index_file(index_name).write((u'"{0}","{1}","{2}"\n'.format(
+                    key, text, writer.current_page())).encode('utf-8'))
+
+
+def run_ops(writer, ops):
+    """ Runs a batch of operations returned by a processing function: the
+        writer operations in batches (see `sw_oplog.apply_ops`), and index
+        entries in between.
+    """
+    batch = []
+    for operation, args in ops:
+        if operation == 'index_entry':
+            if batch:
+                apply_ops(batch, writer)
+                batch = []
+            write_index_entry(writer, *args)
+        else:
+            batch.append((operation, args))
+    if batch:
+        apply_ops(batch, writer)
+
+
+def render_elm(writer, elm, stack=None, context=None):
+    """ Renders a TEI element in OpenOffice. """
+
+    if stack is None:
+        stack = []
+
+    stats()['elements'] += 1
+    processed = processed_tags()
+
+    if elm.tag in FOOTNOTE_TAGS:
+        # create a footnote, set the cursor context...
+        footnote = writer.create_footnote()
+        saved_context = writer.context
+        writer.set_context(footnote)
+        #  ...and flush the para_style stack
+        stack = ['Footnote']
+    else:
+        # otherwise we're still in the main context, so just append the
+        #  tage name to the para_style stack
+        stack.append(elm.tag)
+
+    if elm.tag in CHARSTYLE_TAGS:
+        char_style = elm.tag
+        if elm.get('rend') is not None:
+            char_style = '_'.join([char_style, elm.get('rend')])
+
+        if char_style not in processed:
+            writer.check_style_name(char_style, 'Character')
+            processed.append(char_style)
+
+        # char_style is opened here, but not closed, in case there are
+        #  sub-elements (the writer keeps a stack of open char styles)
+        writer.open_char_style(char_style)
+        if elm.text:
+            writer.write_string(elm.text)
+
+    elif elm.tag in PARASTYLE_TAGS or elm.tag in FOOTNOTE_TAGS:
+        if elm.tag not in processed:
+            processed.append(elm.tag)
+
+        para_style = '-'.join(stack)
+
+        if para_style not in processed:
+            processed.append(para_style)
+
+        writer.open_para(para_style, elm.tag)
+        if BOOKMARK_IDS and elm.tag in PARASTYLE_TAGS and \
+           elm.get('id') is not None:
+            # mark where this element's text begins (and, below, ends), so
+            #  that it can be found again in the ODT (see patch_odt.py)
+            writer.insert_bookmark(elm.get('id'))
+        if elm.text:
+            # strip newlines needed for tag = 'item'
+            writer.write_string(elm.text.strip('\n'))
+
+    elif elm.tag in PASS_TAGS:
+        if elm.text:
+            writer.write_string(elm.text)
+
+    elif elm.tag in IGNORE_TAGS:
+        pass
+
+    else:
+        if elm.tag not in processed and elm.tag not in dir(settings):
+            logging.warning('tag "{0}" has no processing instuction and is not'
+                            ' "pass"ed (behaviour undefined)!'.format(elm.tag))
+            processed.append(elm.tag)
+
+    for sub_elm in elm.iterchildren(tag=etree.Element):
+        render_elm(writer, sub_elm, stack, context)
+
+    if elm.tag in PARASTYLE_TAGS:
+        if BOOKMARK_IDS and elm.get('id') is not None:
+            writer.insert_bookmark(end_bookmark_name(elm.get('id')))
+        writer.close_para()
+
+    if elm.tag in CHARSTYLE_TAGS:
+        writer.close_char_style()
+
+    # check if there's a function in `settings` to process this element
+    ops = None
+    if elm.tag in dir(settings):
+        func = getattr(settings, elm.tag)
+        if callable(func):
+            # the function should return a list of operations (see
+            #  sw_oplog) on success -- or, if it writes to the writer
+            #  itself, True -- and False on failure
+            result = func(writer, elm, stack)
+            if isinstance(result, list):
+                ops = result
+            elif not result:
+                logging.error('malformed %s element!\n%s',
+                        elm.tag, etree.tostring(elm, pretty_print=True))
+                raise SystemExit
+
+    if elm.tag in FOOTNOTE_TAGS:
+        # (a footnote's own operations go in the footnote)
+        if ops is not None:
+            run_ops(writer, ops)
+            ops = None
+        # return the context after a footnote
+        writer.set_context(saved_context)
+
+    if ops is not None:
+        # (the tail goes in the same batch)
+        if elm.tail:
+            ops.append(text_op(elm.tail))
+        run_ops(writer, ops)
+    elif elm.tail:
+        writer.write_string(elm.tail)
+
+    # pop the tag name back off the para_style stack
+    del stack[-1]
@@ -0,0 +1,553 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+""" Long-running render service: keeps worker processes (each with its own
+    OpenOffice, already connected, and its own caches of prepared TEI)
+    waiting for conversion jobs, which clients submit over a Unix-domain
+    socket.
+
+      render_daemon.py serve [-w WORKERS]
+      render_daemon.py submit -g g008 -o g008.odt [-s styles.odt] [--pdf ..]
+      render_daemon.py status
+      render_daemon.py shutdown
+
+    The protocol is one JSON object per line.  A client sends a request
+    ({"command": "submit", "job": {...}}), and the server answers with
+    events until the job is finished ({"event": "queued" | "started" |
+    "progress" | "done" | "error", ...}).  Pending jobs run in order of
+    priority (highest first), and an identical job which is already
+    pending is shared, rather than queued again.
+"""
+
+import os
+import json
+import heapq
+import socket
+import logging
+import itertools
+import threading
+import Queue
+import SocketServer
+import multiprocessing
+from sw_misc import prep_logging, get_parser, make_temp_dir
+
+import settings
+
+# the default socket (one per user)
+DEFAULT_SOCKET = '/tmp/fosizhi-render-{0}.sock'.format(os.getuid())
+
+# OpenOffice port for the first worker (the others follow on)
+DAEMON_BASE_PORT = 8201
+
+# how many times in a row a worker which dies is started again
+WORKER_RESPAWNS = 3
+
+# seconds between checks that the workers are still alive
+WORKER_CHECK_INTERVAL = 1.0
+
+# the job options which make two jobs the same
+JOB_KEYS = ('gazetteer', 'teiBase', 'cacheDir', 'styles', 'output', 'pdf',
+            'pdfOptions', 'bookmarks')
+
+
+def job_key(job):
+    """ Returns the identity of a job (for spotting duplicates). """
+    return json.dumps([job.get(key) for key in JOB_KEYS])
+
+
+def run_job(job, writer_args, report):
+    """ Renders one job (in a worker process), calling `report(event,
+        **details)` as it goes.
+    """
+    import render
+    from render import render_elm, PROCESSED_TAGS
+    from working import new_writer
+    from tei_source import load_tei, get_wrapper_divs, save_snapshot, \
+                           tei_dependencies
+    from gaiji import load_glyph_index
+    from style_prepass import collect_styles, div_events
+    from sw_uno import parse_filter_options
+
+    gaz = job['gazetteer']
+    tei = load_tei(job['teiBase'], gaz, job.get('cacheDir'))
+    settings.GLYPHS.clear()
+    settings.GLYPHS.update(load_glyph_index(tei, job.get('cacheDir'),
+                                tei_dependencies(job['teiBase'], gaz,
+                                                 job.get('cacheDir'))))
+    divs = get_wrapper_divs(tei)
+    needed_styles = collect_styles(div_events(divs))
+
+    # (the index files go alongside the output)
+    settings.closeup()
+    settings.open_indexes('{0}_'.format(os.path.splitext(job['output'])[0]))
+
+    del PROCESSED_TAGS[:]
+    render.BOOKMARK_IDS = job.get('bookmarks', False)
+    writer = new_writer(writer_args, job.get('styles'), needed_styles)
+    try:
+        for position, div in enumerate(divs):
+            render_elm(writer, div, [])
+            report('progress', done=position + 1, total=len(divs))
+        writer.save_copy(job['output'])
+        if job.get('pdf'):
+            writer.export_pdf(job['pdf'],
+                              parse_filter_options(job.get('pdfOptions')))
+    finally:
+        writer.close()
+        settings.closeup()
+
+    if render.BOOKMARK_IDS:
+        save_snapshot(divs, job['output'])
+
+
+def worker_main(index, jobs, events, writer_args, profile_dir):
+    """ Worker process: connects to its own OpenOffice (with its own
+        profile), then runs jobs until it is sent None.  If OpenOffice
+        can't be (re)started, the worker exits, and the scheduler starts
+        another.
+    """
+    from render import load_settings
+    from sw_uno import connectOO, terminateOO, DisposedException, \
+                       RuntimeException
+    import render
+    load_settings(settings)
+
+    port = str(DAEMON_BASE_PORT + index)
+    connect_args = dict(writer_args, oo_port=port, profile_dir=profile_dir)
+    try:
+        desktop = connectOO(**connect_args)
+    except Exception, exc:
+        logging.error('Worker %d can\'t start OpenOffice (%s)', index, exc)
+        raise SystemExit(1)
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+
+        def report(event, **details):
+            details.update({'event': event, 'id': job['id']})
+            events.put((index, details))
+
+        report('started', worker=index)
+        for attempt in (1, 2):
+            try:
+                run_job(job, {'desktop': desktop, 'new_document': True},
+                        report)
+                report('done', output=job['output'])
+                break
+            except (DisposedException, RuntimeException), exc:
+                # OpenOffice has died -- restart it, and try once more
+                logging.warning('Worker %d lost OpenOffice (%s)', index, exc)
+                try:
+                    desktop = connectOO(**connect_args)
+                except Exception, connect_exc:
+                    report('error', message='OpenOffice died ({0}), and '
+                           'couldn\'t be restarted ({1})'.format(exc,
+                                                              connect_exc))
+                    raise SystemExit(1)
+                if attempt == 2:
+                    report('error', message=str(exc))
+            except BaseException, exc:
+                report('error', message='{0}: {1}'.format(
+                                            type(exc).__name__, exc))
+                break
+
+    if not writer_args.get('keepopen'):
+        terminateOO(oo_port=port)
+
+
+class Scheduler():
+    """ The queue of pending jobs, and the workers which run them. """
+
+    def __init__(self, workers, writer_args):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_by_key = {}
+        self.running = {}
+        self.subscribers = {}
+        self.counter = itertools.count(1)
+        self.completed = 0
+        self.stopping = False
+
+        self.events = multiprocessing.Queue()
+        self.writer_args = writer_args
+        self.profiles = make_temp_dir(cleanup=True)
+        # (process, job queue) of each worker -- (None, None) once it has
+        #  been given up on -- the job each is running, the ids of those
+        #  jobs which have started, and how many times in a row each
+        #  worker has died
+        self.workers = []
+        self.idle = []
+        self.assigned = {}
+        self.started = set()
+        self.deaths = {}
+        for index in range(workers):
+            self.workers.append(self.start_worker(index))
+            self.idle.append(index)
+            self.deaths[index] = 0
+
+        self.dispatcher = threading.Thread(target=self.dispatch_events)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def start_worker(self, index):
+        """ Starts a worker process, and returns (process, job queue). """
+        jobs = multiprocessing.Queue()
+        process = multiprocessing.Process(target=worker_main,
+                            args=(index, jobs, self.events, self.writer_args,
+                                  os.path.join(self.profiles,
+                                               'profile{0}'.format(index))))
+        process.daemon = True
+        process.start()
+        return process, jobs
+
+    def submit(self, job, subscriber):
+        """ Queues a job (or joins an identical pending one), and returns
+            its id.
+        """
+        priority = int(job.get('priority', 0))
+        with self.lock:
+            key = job_key(job)
+            if key in self.pending_by_key:
+                existing = self.pending_by_key[key]
+                self.subscribers[existing['id']].append(subscriber)
+                if priority > existing['priority']:
+                    # (re-queued at the higher priority; the old entry is
+                    #  skipped when it comes up)
+                    existing['priority'] = priority
+                    heapq.heappush(self.pending,
+                            (-priority, next(self.counter), existing))
+                return existing['id'], True
+
+            job = dict(job, id=next(self.counter), priority=priority)
+            self.pending_by_key[key] = job
+            self.subscribers[job['id']] = [subscriber]
+            heapq.heappush(self.pending, (-priority, job['id'], job))
+            self.start_jobs()
+            return job['id'], False
+
+    def start_jobs(self):
+        """ Hands pending jobs to idle workers (with the lock held). """
+        while self.idle and self.pending:
+            neg_priority, seq, job = heapq.heappop(self.pending)
+            if self.pending_by_key.get(job_key(job)) is not job or \
+               -neg_priority != job['priority']:
+                continue
+            del self.pending_by_key[job_key(job)]
+            index = self.idle.pop(0)
+            self.running[job['id']] = job
+            self.assigned[index] = job
+            self.workers[index][1].put(job)
+
+    def finish_job(self, index):
+        """ Records that a worker's job is over (with the lock held), and
+            returns the job's subscribers.
+        """
+        job = self.assigned.pop(index)
+        self.running.pop(job['id'], None)
+        self.started.discard(job['id'])
+        self.completed += 1
+        return self.subscribers.pop(job['id'], [])
+
+    def dispatch_events(self):
+        """ Passes the workers' events on to the clients, and checks on the
+            workers (in a thread).
+        """
+        while True:
+            try:
+                index, event = self.events.get(
+                                            timeout=WORKER_CHECK_INTERVAL)
+            except Queue.Empty:
+                self.check_workers()
+                continue
+            with self.lock:
+                job = self.assigned.get(index)
+                if job is None or job['id'] != event['id']:
+                    # (a late event from a worker which was given up for
+                    #  dead -- its job has already been dealt with)
+                    continue
+                subscribers = list(self.subscribers.get(event['id'], ()))
+                if event['event'] == 'started':
+                    self.started.add(event['id'])
+                elif event['event'] in ('done', 'error'):
+                    self.finish_job(index)
+                    if event['event'] == 'done':
+                        self.deaths[index] = 0
+                    self.idle.append(index)
+                    self.start_jobs()
+            for subscriber in subscribers:
+                subscriber.put(event)
+            self.check_workers()
+
+    def check_workers(self):
+        """ Fails the job of any worker which has died, and starts another
+            worker in its place (up to WORKER_RESPAWNS times in a row).  A
+            job which the dead worker hadn't started is handed on to the
+            new one.  If every worker has been given up on, the pending
+            jobs are failed.
+        """
+        notices = []
+        with self.lock:
+            if self.stopping:
+                return
+            for index, (process, jobs) in enumerate(self.workers):
+                if process is None or process.is_alive():
+                    continue
+                logging.error('Worker %d has died (exit code %s)', index,
+                              process.exitcode)
+                if index in self.idle:
+                    self.idle.remove(index)
+
+                job = self.assigned.get(index)
+                if job is not None and (job['id'] in self.started or
+                                self.deaths[index] >= WORKER_RESPAWNS):
+                    notices.append((self.finish_job(index),
+                            {'event': 'error', 'id': job['id'],
+                             'message': 'worker {0} died'.format(index)}))
+                    job = None
+
+                if self.deaths[index] >= WORKER_RESPAWNS:
+                    logging.error('Worker %d keeps dying -- giving up on it',
+                                  index)
+                    self.workers[index] = (None, None)
+                    continue
+                self.deaths[index] += 1
+                self.workers[index] = self.start_worker(index)
+                if job is not None:
+                    self.workers[index][1].put(job)
+                else:
+                    self.idle.append(index)
+
+            if all(process is None for process, jobs in self.workers):
+                for job in self.pending_by_key.values():
+                    self.completed += 1
+                    notices.append((self.subscribers.pop(job['id'], []),
+                            {'event': 'error', 'id': job['id'],
+                             'message': 'no workers are left'}))
+                self.pending_by_key.clear()
+                del self.pending[:]
+            else:
+                self.start_jobs()
+
+        for subscribers, event in notices:
+            for subscriber in subscribers:
+                subscriber.put(event)
+
+    def status(self):
+        """ Returns the numbers of jobs pending, running and completed. """
+        with self.lock:
+            return {'pending': len(self.pending_by_key),
+                    'running': len(self.running),
+                    'completed': self.completed,
+                    'workers': len([process for process, jobs in self.workers
+                                            if process is not None]),
+                    'idle': len(self.idle)}
+
+    def shutdown(self):
+        """ Stops the workers (after their current jobs). """
+        with self.lock:
+            self.stopping = True
+            workers = [(process, jobs) for process, jobs in self.workers
+                                            if process is not None]
+        for process, jobs in workers:
+            jobs.put(None)
+        for process, jobs in workers:
+            process.join()
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """ Handles one client request. """
+
+    def send(self, message):
+        self.wfile.write(json.dumps(message) + '\n')
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            self.send({'event': 'error', 'message': 'bad request'})
+            return
+
+        scheduler = self.server.scheduler
+        command = request.get('command')
+
+        if command == 'submit':
+            events = Queue.Queue()
+            job_id, shared = scheduler.submit(request['job'], events)
+            self.send({'event': 'queued', 'id': job_id, 'shared': shared})
+            while True:
+                event = events.get()
+                try:
+                    self.send(event)
+                except socket.error:
+                    # (the client has gone, but the job carries on)
+                    return
+                if event['event'] in ('done', 'error'):
+                    return
+
+        elif command == 'status':
+            self.send(dict(scheduler.status(), event='status'))
+
+        elif command == 'shutdown':
+            self.send({'event': 'shutdown'})
+            threading.Thread(target=self.server.shutdown).start()
+
+        else:
+            self.send({'event': 'error',
+                       'message': 'unknown command: {0}'.format(command)})
+
+
+class RenderServer(SocketServer.ThreadingMixIn,
+                   SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path, workers, writer_args):
+    """ Runs the service until it is told to shut down. """
+    if os.path.exists(socket_path):
+        if request(socket_path, {'command': 'status'}, quiet=True):
+            logging.fatal('A render service is already running on %s',
+                          socket_path)
+            raise SystemExit(1)
+        os.remove(socket_path)
+
+    # (the workers are forked before any threads are started)
+    scheduler = Scheduler(workers, writer_args)
+    server = RenderServer(socket_path, RequestHandler)
+    server.scheduler = scheduler
+    logging.info('Listening on %s, with %d workers', socket_path, workers)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        logging.info('Waiting for the workers to finish...')
+        scheduler.shutdown()
+
+
+def request(socket_path, message, quiet=False):
+    """ Sends a request to the service, logging the events it sends back.
+        Returns the last event (or None if the service can't be reached).
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except socket.error, exc:
+        if not quiet:
+            logging.error('Can\'t connect to the render service on %s (%s)',
+                          socket_path, exc)
+        return None
+
+    stream = client.makefile('rwb')
+    stream.write(json.dumps(message) + '\n')
+    stream.flush()
+    event = None
+    for line in stream:
+        event = json.loads(line)
+        if quiet:
+            continue
+        if event['event'] == 'progress':
+            logging.info('%d%% (%d of %d top-level divs)',
+                         100 * event['done'] // event['total'],
+                         event['done'], event['total'])
+        elif event['event'] == 'error':
+            logging.error('Job failed: %s', event['message'])
+        else:
+            logging.info('%s', ', '.join('{0}: {1}'.format(key, value)
+                        for key, value in sorted(event.items())))
+    client.close()
+    return event
+
+
+def main():
+    """ Run the render service, or talk to it. """
+
+    parser = get_parser()
+    parser.usage = '%prog [options] serve|submit|status|shutdown'
+
+    parser.add_option('--socket', dest='socket', action='store',
+                        default=DEFAULT_SOCKET,
+                        help='Unix socket of the service [%default]')
+
+    parser.add_option('-w', '--workers', dest='workers', action='store',
+                        type='int', default=2,
+                        help='(serve) worker processes, each with its own '
+                                    'OpenOffice [%default]')
+
+    parser.add_option('-H', '--headless', dest='headless', action='store_true',
+                        default=False, help='(serve) Headless Operation')
+
+    parser.add_option('-g', '--gazetteer', dest='gazetteer', action='store',
+                        help='(submit) Gazetteer to render (e.g. g008)')
+
+    parser.add_option('--teiBase', dest='teiBase', action='store',
+                        default=settings.TEI_BASE,
+                        help='(submit) path to TEI files ({0})'\
+                                            .format(settings.TEI_BASE))
+
+    parser.add_option('--cacheDir', dest='cacheDir', action='store',
+                        default=settings.TEI_CACHE,
+                        help='(submit) folder to cache the prepared TEI in '
+                                    '({0})'.format(settings.TEI_CACHE))
+
+    parser.add_option('-s', '--styles', dest='stylesFile', action='store',
+                        help='(submit) ODT or OTT file to read styles from')
+
+    parser.add_option('-o', '--output', dest='destFile', action='store',
+                        help='(submit) output file')
+
+    parser.add_option('--pdf', dest='pdfFile', action='store',
+                        help='(submit) also export a PDF file')
+
+    parser.add_option('--pdfOptions', dest='pdfOptions', action='store',
+                        help='(submit) PDF export filter options')
+
+    parser.add_option('--bookmarks', dest='bookmarks', action='store_true',
+                        default=settings.BOOKMARK_IDS,
+                        help='(submit) bookmark the elements with ids')
+
+    parser.add_option('-p', '--priority', dest='priority', action='store',
+                        type='int', default=0,
+                        help='(submit) priority (higher runs sooner) '
+                                    '[%default]')
+
+    opts, args = parser.parse_args()
+
+    if len(args) != 1 or \
+       args[0] not in ('serve', 'submit', 'status', 'shutdown'):
+        parser.print_help()
+        raise SystemExit
+
+    prep_logging(opts.verbose, opts.quiet)
+
+    if args[0] == 'serve':
+        serve(opts.socket, opts.workers, {'headless': opts.headless})
+        return
+
+    if args[0] == 'submit':
+        if opts.gazetteer is None or opts.destFile is None:
+            parser.error('submit needs a --gazetteer and an --output file')
+        path = lambda path: os.path.abspath(path) if path else None
+        message = {'command': 'submit', 'job': {
+            'gazetteer': opts.gazetteer,
+            'teiBase': path(opts.teiBase),
+            'cacheDir': path(opts.cacheDir),
+            'styles': path(opts.stylesFile),
+            'output': path(opts.destFile),
+            'pdf': path(opts.pdfFile),
+            'pdfOptions': opts.pdfOptions,
+            'bookmarks': opts.bookmarks,
+            'priority': opts.priority,
+        }}
+    else:
+        message = {'command': args[0]}
+
+    event = request(opts.socket, message)
+    if event is None or event['event'] == 'error':
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
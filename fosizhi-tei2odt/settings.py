@@ -1,8 +1,23 @@
 #-*- coding:utf-8 -*-
 
+import os
+import atexit
+import threading
+
+from sw_oplog import text_op, footnote_op, para_break_op, index_op
+
 # default - can be over-ridden by a command switch
 TEI_BASE = 'fosizhi/xml/'
 
+# where to cache the prepared (XIncluded, namespace-stripped) TEI -- None
+#  for no caching; can be over-ridden by a command switch
+TEI_CACHE = None
+
+# write bookmarks at the beginning and end of the paragraph-level elements
+#  which have ids, so that the ODT can be patched later with patch_odt.py
+#  -- can be over-ridden by a command switch
+BOOKMARK_IDS = False
+
 # tags to pass over (but process text/child-nodes)
 PASS_TAGS = [
     'div',
@@ -50,8 +65,38 @@ FOOTNOTE_TAGS = [
 ]
 
 
+# character styles written by the processing functions below, by tag
+#  (these are worked out by the style pre-pass, and created up front)
+HANDLER_CHARSTYLES = {
+    'gap': lambda el: ['gap_{0}'.format(el.get('reason'))],
+    'unclear': lambda el: ['unclear'],
+    'pb': lambda el: ['pageNo'],
+    'choice': lambda el: [style for style in ('corr', 'reg')
+                                    if el.find(style) is not None][:1],
+    'date': lambda el: ['westernDate'],
+    'g': lambda el: ['gaiji'],
+}
+
+# the gaiji declared in the charDecl, by id (filled in for each document by
+#  `gaiji.load_glyph_index`)
+GLYPHS = {}
+
+# per-thread state, for rendering several documents at once from threads
+#  (working.py --threads): a thread's own `glyphs`, `processed_tags`, and
+#  index files (`personIndex`, `placeIndex`) are used instead of the
+#  module-level ones, if it has them
+THREAD_STATE = threading.local()
+
+
 # TEI-tag processing functions begin
 ####################################
+#
+# each is called (after the element's children have been rendered) as
+#  func(writer, el, stack), and returns a list of operations for the writer
+#  to run in one batch (see sw_oplog), or False if the element is
+#  malformed.  (Functions which write to the writer themselves, and return
+#  True, work too.)
+
 
 def gap(writer, el, stack):
     extent = el.get('extent')
@@ -60,8 +105,7 @@ def gap(writer, el, stack):
         return False
     charStyle = 'gap_{0}'.format(reason)
     # insert U+303F, "〿"
-    writer.write_string(u'\u303f' * int(extent), charStyle)
-    return True
+    return [text_op(u'\u303f' * int(extent), charStyle)]
 
 
 def space(writer, el, stack):
@@ -69,23 +113,20 @@ def space(writer, el, stack):
     if quantity is None:
         return False
     # insert U+3000, full-width space
-    writer.write_string(u'\u3000' * int(quantity))
-    return True
+    return [text_op(u'\u3000' * int(quantity))]
 
 
 def unclear(writer, el, stack):
     if len(el) > 0 or len(el.text) != 1:
         return False
-    writer.write_string(u'{0}（？）'.format(el.text), 'unclear')
-    return True
+    return [text_op(u'{0}（？）'.format(el.text), 'unclear')]
 
 
 def pb(writer, el, stack):
     pageNo = el.get('n')
     if pageNo is None:
         return False
-    writer.write_string('[p{0}]'.format(pageNo), 'pageNo')
-    return True
+    return [text_op('[p{0}]'.format(pageNo), 'pageNo')]
 
 
 def choice(writer, el, stack):
@@ -105,9 +146,7 @@ def choice(writer, el, stack):
     else:
         return False
 
-    writer.write_string(mainText, charStyle)
-    writer.insert_footnote(fnText)
-    return True
+    return [text_op(mainText, charStyle), footnote_op(fnText)]
 
 
 def date(writer, el, stack):
@@ -122,47 +161,71 @@ def date(writer, el, stack):
     else:
         return False
 
-    writer.write_string('({0})'.format(westernDate), 'westernDate')
-    return True
+    return [text_op('({0})'.format(westernDate), 'westernDate')]
 
 
 def lb(writer, el, stack):
-    writer.close_para()
-    return True
+    return [para_break_op()]
+
+
+def g(writer, el, stack):
+    ref = el.get('ref')
+    if ref is None:
+        return False
+    glyphs = getattr(THREAD_STATE, 'glyphs', GLYPHS)
+    glyph = glyphs.get(ref.lstrip('#'), {})
+    text = glyph.get('unicode') or glyph.get('normalized')
+    if text is not None:
+        return [text_op(text)]
+    # no character for it -- insert U+3013, "〓" (the geta mark)
+    return [text_op(el.text or u'\u3013', 'gaiji')]
 
 
 def persName(writer, el, stack):
-    aid = el.get('key')
-    appears_as = joinText(el)
-    page = writer.view_cursor.Page
-    personIndex.write(
-        (u'"{0}","{1}","{2}"\n'.format(aid, appears_as, page)).encode('utf-8'))
-    return True
+    return [index_op('personIndex', el.get('key'), joinText(el))]
 
 
 def placeName(writer, el, stack):
-    aid = el.get('key')
-    appears_as = joinText(el)
-    page = writer.view_cursor.Page
-    placeIndex.write(
-        (u'"{0}","{1}","{2}"\n'.format(aid, appears_as, page)).encode('utf-8'))
-    return True
+    return [index_op('placeIndex', el.get('key'), joinText(el))]
 
 
 
 # some prep for the index files
-# (executed when the module is imported)
-import atexit
-
-personIndex = open('personIndex.csv', 'w')
-personIndex.write('"aid","appears_as","page"\n')
-placeIndex = open('placeIndex.csv', 'w')
-placeIndex.write('"aid","appears_as","page"\n')
+# (opened by the renderer, so that importing settings has no side-effects)
+personIndex = None
+placeIndex = None
+
+
+def index_files(path_prefix='', resume=False):
+    """ Opens a set of index files (with their headers), and returns them
+        as (personIndex, placeIndex).  If `resume`, existing files are
+        appended to (see working.Checkpoint).
+    """
+    files = []
+    for name in ('personIndex', 'placeIndex'):
+        file_path = '{0}{1}.csv'.format(path_prefix, name)
+        if resume and os.path.exists(file_path):
+            files.append(open(file_path, 'a'))
+            continue
+        index_file = open(file_path, 'w')
+        index_file.write('"aid","appears_as","page"\n')
+        files.append(index_file)
+    return tuple(files)
+
+
+def open_indexes(path_prefix='', resume=False):
+    """ (Re)opens the index files (parallel renders write one set per
+        chapter, with a path prefix, and merge them afterwards).
+    """
+    global personIndex, placeIndex
+    personIndex, placeIndex = index_files(path_prefix, resume)
 
 
 def closeup():
-    personIndex.close()
-    placeIndex.close()
+    if personIndex is not None:
+        personIndex.close()
+    if placeIndex is not None:
+        placeIndex.close()
 
 atexit.register(closeup)
 
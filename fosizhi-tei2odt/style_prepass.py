@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+""" Works out (without OpenOffice) every paragraph and character style that
+    rendering a TEI document will need, so that they can be created before
+    rendering starts, and reports those missing from a styles template.
+"""
+
+from lxml import etree
+from sw_misc import prep_logging, get_parser
+from sw_openoffice_xml import OOWriterXML
+from tei_source import load_tei, get_wrapper_divs
+
+import settings
+
+# ODF style families, by OpenOffice style type
+STYLE_FAMILIES = {
+    'Paragraph': 'paragraph',
+    'Character': 'text',
+}
+
+
+def div_events(divs):
+    """ Yields ('start'/'end', element) events for a list of (in-memory)
+        top-level divs.
+    """
+    for div in divs:
+        for event in etree.iterwalk(div, events=('start', 'end')):
+            yield event
+
+
+def collect_styles(events, styles=None, counts=None):
+    """ Follows the same rules as `working.render_elm` over a stream of
+        ('start'/'end', element) events (from `div_events`, or from
+        `etree.iterparse`), and returns a dict of the styles needed:
+            {'Paragraph': {name: parent_name}, 'Character': {name: None}}
+        (a parent of None means the OpenOffice default).  If a
+        collections.Counter is given as `counts`, the number of times each
+        (style_type, name) is used is added to it.
+    """
+    if styles is None:
+        styles = {'Paragraph': {}, 'Character': {}}
+
+    stack = []
+    saved_stacks = []
+
+    for event, elm in events:
+        tag = etree.QName(elm).localname
+
+        if event == 'start':
+            if tag in settings.FOOTNOTE_TAGS:
+                saved_stacks.append(stack)
+                stack = ['Footnote']
+            else:
+                stack.append(tag)
+
+            if tag in settings.CHARSTYLE_TAGS:
+                char_style = tag
+                if elm.get('rend') is not None:
+                    char_style = '_'.join([char_style, elm.get('rend')])
+                styles['Character'][char_style] = None
+                if counts is not None:
+                    counts[('Character', char_style)] += 1
+
+            elif tag in settings.PARASTYLE_TAGS or \
+                 tag in settings.FOOTNOTE_TAGS:
+                para_style = '-'.join(stack)
+                styles['Paragraph'].setdefault(tag, None)
+                if para_style != tag:
+                    styles['Paragraph'][para_style] = tag
+                if counts is not None:
+                    counts[('Paragraph', para_style)] += 1
+
+        else:
+            # the processing functions run once the element is complete
+            if tag in settings.HANDLER_CHARSTYLES:
+                for char_style in settings.HANDLER_CHARSTYLES[tag](elm):
+                    styles['Character'][char_style] = None
+                    if counts is not None:
+                        counts[('Character', char_style)] += 1
+
+            if tag in settings.FOOTNOTE_TAGS:
+                stack = saved_stacks.pop()
+            else:
+                del stack[-1]
+
+    return styles
+
+
+def get_template_styles(styles_file):
+    """ Returns the names of the styles defined in an ODT/OTT file, as
+        {style_type: set(names)}.
+    """
+    style_index = OOWriterXML(styles_file).get_style_index()
+    names = {}
+    for style_type, family in STYLE_FAMILIES.items():
+        names[style_type] = set(style_index.names(family))
+        names[style_type].update(display_name for (display_family,
+                    display_name) in style_index.display_names
+                            if display_family == family)
+    return names
+
+
+def main():
+    """ Report the styles a gazetteer needs which a template lacks. """
+
+    parser = get_parser()
+
+    parser.add_option('-g', '--gazetteer', dest='gazetteer', action='store',
+                        help='Gazetteer to process (e.g. g008)')
+
+    parser.add_option('--teiBase', dest='teiBase', action='store',
+                        default=settings.TEI_BASE,
+                        help='path to TEI files (eXist dump) ({0})'\
+                                                .format(settings.TEI_BASE))
+
+    parser.add_option('--cacheDir', dest='cacheDir', action='store',
+                        default=settings.TEI_CACHE,
+                        help='folder to cache the prepared TEI in ({0})'\
+                                                .format(settings.TEI_CACHE))
+
+    parser.add_option('-s', '--styles', dest='stylesFile', action='store',
+                        help='ODT or OTT file to check for the styles')
+
+    opts = parser.parse_args()[0]
+
+    if opts.gazetteer is None:
+        parser.print_help()
+        raise SystemExit
+
+    prep_logging(opts.verbose, opts.quiet)
+
+    tei = load_tei(opts.teiBase, opts.gazetteer, opts.cacheDir)
+    styles = collect_styles(div_events(get_wrapper_divs(tei)))
+
+    template_styles = {'Paragraph': set(), 'Character': set()}
+    if opts.stylesFile:
+        template_styles = get_template_styles(opts.stylesFile)
+
+    for style_type in sorted(styles):
+        missing = sorted(set(styles[style_type]) - template_styles[style_type])
+        print '{0} styles: {1} needed, {2} missing'.format(
+                style_type, len(styles[style_type]), len(missing))
+        for name in missing:
+            parent = styles[style_type][name]
+            print '  {0}{1}'.format(name,
+                        ' (parent: {0})'.format(parent) if parent else '')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+""" Takes a census of the TEI (without OpenOffice, and without building
+    whole trees): streams every chapter of the gazetteers through
+    iterparse, in a pool of processes, counting the tags, their `rend`
+    values and the styles `render.render_elm` would use, then checks them
+    against the categories and processing functions in `settings.py`.
+
+    Exits with status 1 if any tag would be rendered without a rule (the
+    "has no processing instuction" warning), so that gaps can be caught
+    before a render starts.
+"""
+
+import json
+import logging
+import multiprocessing
+from collections import Counter
+from lxml import etree
+from sw_misc import prep_logging, get_parser
+from tei_source import tei_path, list_gazetteers, chapter_files
+from style_prepass import collect_styles, get_template_styles
+
+import settings
+
+# the tag categories in `settings`
+CATEGORIES = ('PASS_TAGS', 'IGNORE_TAGS', 'CHARSTYLE_TAGS', 'PARASTYLE_TAGS',
+              'FOOTNOTE_TAGS')
+
+
+def handler_names():
+    """ Returns the names of the processing functions in `settings` (those
+        taking (writer, el, stack)).
+    """
+    names = set()
+    for name in dir(settings):
+        func = getattr(settings, name)
+        code = getattr(func, 'func_code', None)
+        if code is not None and \
+           code.co_varnames[:3] == ('writer', 'el', 'stack'):
+            names.add(name)
+    return names
+
+
+def rendered_events(xml_file):
+    """ Yields ('start'/'end', element) events (with the namespaces
+        stripped) for the parts of a TEI file which are rendered: the
+        top-level divs inside the wrapper div, or the whole file if it is a
+        chapter on its own.  Each top-level div is freed once it's done.
+    """
+    depth = 0
+    top_depth = None
+    for event, elm in etree.iterparse(xml_file, events=('start', 'end'),
+                                      remove_comments=True, huge_tree=True):
+        if event == 'start':
+            elm.tag = etree.QName(elm).localname
+            depth += 1
+            if depth == 1 and elm.tag != 'TEI':
+                top_depth = 1
+            elif top_depth is None and elm.tag == 'div' and \
+                 elm.get('type') == 'wrapper':
+                top_depth = depth + 1
+                continue
+            if top_depth is not None and depth >= top_depth:
+                yield event, elm
+        else:
+            if top_depth is not None and depth >= top_depth:
+                yield event, elm
+                if depth == top_depth:
+                    elm.clear()
+                    while elm.getprevious() is not None:
+                        del elm.getparent()[0]
+            elif top_depth is not None and depth == top_depth - 1:
+                # (the end of the wrapper)
+                top_depth = None
+            depth -= 1
+
+
+def census_file(xml_file):
+    """ Takes the census of one file (in a worker process).  Returns
+        (xml_file, tag counts, (tag, rend) counts, style counts, error).
+    """
+    tags = Counter()
+    rends = Counter()
+    styles = Counter()
+
+    def counted(events):
+        for event, elm in events:
+            if event == 'start':
+                tags[elm.tag] += 1
+                if elm.get('rend') is not None:
+                    rends[(elm.tag, elm.get('rend'))] += 1
+            yield event, elm
+
+    try:
+        needed = collect_styles(counted(rendered_events(xml_file)),
+                                counts=styles)
+    except (etree.XMLSyntaxError, IOError), exc:
+        return xml_file, tags, rends, styles, str(exc)
+    # (the parent styles are needed too, though nothing uses them directly)
+    for style_type, names in needed.items():
+        for name in names:
+            styles[(style_type, name)] += 0
+    return xml_file, tags, rends, styles, None
+
+
+def check_coverage(tags, rends):
+    """ Checks the tag counts against `settings`.  Returns a dict of the
+        problems found (each a sorted list).
+    """
+    handlers = handler_names()
+    categorised = {}
+    for category in CATEGORIES:
+        for tag in getattr(settings, category):
+            categorised.setdefault(tag, []).append(category)
+
+    return {
+        # (render_elm warns about these)
+        'unhandled': sorted(tag for tag in tags
+                        if tag not in categorised and tag not in handlers),
+        'conflicting': sorted('{0} ({1})'.format(tag, ', '.join(categories))
+                        for tag, categories in categorised.items()
+                                if len(categories) > 1),
+        'unused_categories': sorted('{0} ({1})'.format(tag,
+                                        ', '.join(categorised[tag]))
+                        for tag in categorised if tag not in tags),
+        'unused_handlers': sorted(name for name in handlers
+                                    if name not in tags),
+        # (only character styles take account of `rend`)
+        'ignored_rends': sorted('{0}[@rend="{1}"]'.format(tag, rend)
+                        for tag, rend in rends
+                                if tag not in settings.CHARSTYLE_TAGS),
+    }
+
+
+def main():
+    """ Take a census of the TEI tags. """
+
+    parser = get_parser()
+
+    parser.add_option('-g', '--gazetteer', dest='gazetteers', action='append',
+                        help='Gazetteer to include (may be given more than '
+                                    'once) [all of them]')
+
+    parser.add_option('--teiBase', dest='teiBase', action='store',
+                        default=settings.TEI_BASE,
+                        help='path to TEI files (eXist dump) ({0})'\
+                                            .format(settings.TEI_BASE))
+
+    parser.add_option('-s', '--styles', dest='stylesFile', action='store',
+                        help='ODT or OTT file to check for the styles as well')
+
+    parser.add_option('-j', '--jobs', dest='jobs', action='store',
+                        type='int', default=multiprocessing.cpu_count(),
+                        help='worker processes [%default]')
+
+    parser.add_option('--json', dest='jsonFile', action='store',
+                        help='also write the census to this JSON file')
+
+    opts = parser.parse_args()[0]
+
+    prep_logging(opts.verbose, opts.quiet)
+
+    gazetteers = opts.gazetteers or list_gazetteers(opts.teiBase)
+    files = []
+    for gaz in gazetteers:
+        files.extend(chapter_files(tei_path(opts.teiBase, gaz)))
+    logging.debug('%d files in %d gazetteers', len(files), len(gazetteers))
+
+    tags = Counter()
+    rends = Counter()
+    styles = Counter()
+    failed = False
+    pool = multiprocessing.Pool(max(opts.jobs, 1))
+    for xml_file, file_tags, file_rends, file_styles, error in \
+                            pool.imap_unordered(census_file, files):
+        if error is not None:
+            logging.error('Can\'t read %s: %s', xml_file, error)
+            failed = True
+            continue
+        tags.update(file_tags)
+        rends.update(file_rends)
+        styles.update(file_styles)
+    pool.close()
+    pool.join()
+
+    problems = check_coverage(tags, rends)
+    missing_styles = []
+    if opts.stylesFile is not None:
+        template_styles = get_template_styles(opts.stylesFile)
+        missing_styles = sorted('{0}: {1}'.format(style_type, name)
+                    for style_type, name in styles
+                            if name not in template_styles[style_type])
+
+    print '{0} elements ({1} tags) in {2} files'.format(
+                sum(tags.values()), len(tags), len(files))
+    for tag, count in tags.most_common():
+        print '  {0:<16} {1:>9}'.format(tag, count)
+    print '{0} rend values'.format(len(rends))
+    for (tag, rend), count in rends.most_common():
+        print '  {0:<16} {1:<16} {2:>9}'.format(tag, rend, count)
+    print '{0} styles'.format(len(styles))
+    for (style_type, name), count in sorted(styles.items()):
+        print '  {0:<10} {1:<40} {2:>9}'.format(style_type, name, count)
+
+    for problem in ('unhandled', 'conflicting', 'unused_categories',
+                    'unused_handlers', 'ignored_rends'):
+        if problems[problem]:
+            print '{0}: {1}'.format(problem.replace('_', ' '),
+                                    ', '.join(problems[problem]))
+    if missing_styles:
+        print 'not in {0} (they will be created): {1}'.format(
+                        opts.stylesFile, ', '.join(missing_styles))
+
+    if opts.jsonFile is not None:
+        with open(opts.jsonFile, 'w') as json_file:
+            json.dump({
+                'files': len(files),
+                'tags': dict(tags),
+                'rends': dict(('{0}/{1}'.format(tag, rend), count)
+                                    for (tag, rend), count in rends.items()),
+                'styles': dict(('{0}/{1}'.format(style_type, name), count)
+                                    for (style_type, name), count
+                                            in styles.items()),
+                'problems': problems,
+                'missing_styles': missing_styles,
+            }, json_file, indent=2, sort_keys=True)
+
+    if failed or problems['unhandled']:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#-*- coding:utf-8 -*-
+
+""" Locating and loading the Fosizhi TEI (no OpenOffice needed). """
+
+import os
+import logging
+from lxml import etree
+from sw_xml import stripNamespaces, xinclude, DocumentCache, getParser, \
+                   makeParser
+from sw_xml_cache import XMLCache, DependencyRecorder
+from sw_memprofile import stage
+
+XI_NS = 'http://www.w3.org/2001/XInclude'
+
+# included documents shared by the gazetteers (the master header, charDecl,
+#  etc.) are only parsed once in a batch run
+SHARED_DOCUMENTS = DocumentCache()
+
+
+def tei_path(tei_base, gaz):
+    """ Returns the path to the main TEI file for a gazetteer. """
+    return os.path.join(tei_base, gaz, '{0}_main.xml'.format(gaz))
+
+
+def list_gazetteers(tei_base):
+    """ Returns the names of all of the gazetteers in the TEI base folder. """
+    return sorted(gaz for gaz in os.listdir(tei_base)
+                            if os.path.exists(tei_path(tei_base, gaz)))
+
+
+def chapter_files(xml_file):
+    """ Returns the paths of the chapter files XIncluded into the main TEI
+        body (or just the main file, if there aren't any).
+    """
+    main = etree.parse(xml_file, getParser('document'))
+    base_dir = os.path.dirname(os.path.abspath(xml_file))
+    hrefs = [include.get('href')
+                for include in main.iter('{{{0}}}include'.format(XI_NS))
+                        if include.getparent().get('type') == 'wrapper']
+    if not hrefs:
+        return [xml_file]
+    return [os.path.join(base_dir, href) for href in hrefs]
+
+
+def load_tei(tei_base, gaz, cache_dir=None):
+    """ Parses a gazetteer's TEI, resolves the XIncludes and strips the
+        namespaces.  Returns the (namespace-stripped) tree.  If a
+        `cache_dir` is given, the result is cached there, and re-used until
+        the main file or any of the included files changes.
+    """
+    xml_file = tei_path(tei_base, gaz)
+
+    cache = None
+    if cache_dir is not None:
+        cache = XMLCache(cache_dir)
+        with stage('cache load'):
+            tei = cache.load(os.path.abspath(xml_file),
+                             getParser('document'))
+        if tei is not None:
+            return tei
+
+    # get the TEI (recording the files which go into it)
+    recorder = DependencyRecorder()
+    parser = makeParser('document')
+    parser.resolvers.add(recorder)
+    try:
+        with stage('parse'):
+            tei = etree.parse(xml_file, parser)
+    except IOError:
+        logging.error('''
+        file "%s" could not be found!  make sure the tei is available in
+            "%s", or specify the --teiBase option correctly''',
+                xml_file, tei_base)
+        raise SystemExit
+
+    # parse XIncludes
+    recorder.files.update(xinclude(tei, cache=SHARED_DOCUMENTS))
+    tei = tei.getroot()
+
+    # strip namespaces for clarity and cleanliness :)
+    tei = stripNamespaces(tei)
+
+    logging.debug('Successfully loaded and parsed XML for %s', gaz)
+
+    if cache is not None:
+        recorder.files.add(os.path.abspath(xml_file))
+        cache.save(os.path.abspath(xml_file), tei, recorder.files)
+
+    return tei
+
+
+def tei_dependencies(tei_base, gaz, cache_dir=None):
+    """ Returns the files (with their stamps) that a gazetteer's TEI, as
+        cached by `load_tei`, was built from -- or None if there is no
+        `cache_dir`, or the cache isn't current.
+    """
+    if cache_dir is None:
+        return None
+    return XMLCache(cache_dir).dependencies(
+                                os.path.abspath(tei_path(tei_base, gaz)))
+
+
+def get_wrapper_divs(tei):
+    """ Returns the top-level divs of the main TEI body. """
+    wrapper = tei.find('.//div[@type="wrapper"]')
+    return list(wrapper.iterchildren(tag=etree.Element))
+
+
+def snapshot_path(odt_file):
+    """ Returns the path of the TEI snapshot saved alongside an ODT. """
+    return '{0}.tei.xml'.format(odt_file)
+
+
+def save_snapshot(divs, odt_file):
+    """ Saves a copy of the top-level divs rendered into an ODT (so that
+        later changes to the TEI can be patched into it).
+    """
+    with open(snapshot_path(odt_file), 'wb') as snapshot:
+        snapshot.write('<snapshot>')
+        for div in divs:
+            snapshot.write(etree.tostring(div, encoding='utf-8',
+                                          xml_declaration=False))
+        snapshot.write('</snapshot>')
+
+
+def load_snapshot(odt_file):
+    """ Returns the top-level divs saved by `save_snapshot`. """
+    snapshot = etree.parse(snapshot_path(odt_file),
+                           getParser('document')).getroot()
+    return list(snapshot.iterchildren(tag=etree.Element))
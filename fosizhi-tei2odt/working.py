@@ -3,126 +3,578 @@
 
 """ Build Fosizhi ODTs """
 
-import sys
 import os
-from lxml import etree
+import json
+import shutil
+import StringIO
+import multiprocessing
+import threading
+import Queue
 import logging
-from sw_xml import stripNamespaces
-from sw_misc import prep_logging, get_parser
-from sw_uno import OOWriter
+from lxml import etree
+from sw_misc import prep_logging, get_parser, make_temp_dir
+from sw_uno import OOWriter, DisposedException, RuntimeException, \
+                   terminateOO, ExportQueue, parse_filter_options, \
+                   office_pid, connectOO
+from sw_telemetry import Sampler, proc_available
+from sw_memprofile import stage, enable as enable_memprofile
+from sw_openoffice_xml import merge_documents
+from sw_odf import ODFWriter, PAGE_MARKS
+from tei_source import load_tei, get_wrapper_divs, save_snapshot, \
+                       tei_dependencies
+from gaiji import load_glyph_index
+from style_prepass import collect_styles, div_events
+from prepare_template import corpus_styles, ensure_template
+import render
+from render import load_settings, render_elm, processed_tags, index_file, \
+                   PROCESSED_TAGS
 
 import settings
 
-PROCESSED_TAGS = []
-
-
-def load_settings(settings):
-    """ Function to load settings from external module. """
-    _thismodule = sys.modules[__name__]
-    _m = settings
-    for _k in dir(_m):
-        if _k.isupper() and not _k.startswith('__'):
-            setattr(_thismodule, _k, getattr(_m, _k))
-
-
-def render_elm(writer, elm, stack=None, context=None):
-    """ Renders a TEI element in OpenOffice. """
-
-    if stack is None:
-        stack = []
-
-    if elm.tag in FOOTNOTE_TAGS:
-        # create a footnote, set the cursor context...
-        footnote = writer.create_footnote()
-        saved_context = writer.context
-        writer.set_context(footnote)
-        #  ...and flush the para_style stack
-        stack = ['Footnote']
-    else:
-        # otherwise we're still in the main context, so just append the
-        #  tage name to the para_style stack
-        stack.append(elm.tag)
-
-    if elm.tag in CHARSTYLE_TAGS:
-        char_style = elm.tag
-        if elm.get('rend') is not None:
-            char_style = '_'.join([char_style, elm.get('rend')])
-
-        if char_style not in PROCESSED_TAGS:
-            writer.check_style_name(char_style, 'Character')
-            PROCESSED_TAGS.append(char_style)
-
-        # char_style is opened here, but not closed, in case there are
-        #  sub-elements
-        # (note that OOo nested tags don't work, so this may have to be
-        #  implemented as a stack, at some point)
-        # ALSO: this is dodgy anyway, probably a stack in the writer
-        #       class is a better idea
-        saved_charstyle = writer.cursor.CharStyleName
-        writer.cursor.CharStyleName = char_style
-        if elm.text:
-            writer.write_string(elm.text)
-
-    elif elm.tag in PARASTYLE_TAGS or elm.tag in FOOTNOTE_TAGS:
-        if elm.tag not in PROCESSED_TAGS:
-            PROCESSED_TAGS.append(elm.tag)
-
-        para_style = '-'.join(stack)
-
-        if para_style not in PROCESSED_TAGS:
-            PROCESSED_TAGS.append(para_style)
-
-        writer.open_para(para_style, elm.tag)
-        if elm.text:
-            # strip newlines needed for tag = 'item'
-            writer.write_string(elm.text.strip('\n'))
-
-    elif elm.tag in PASS_TAGS:
-        if elm.text:
-            writer.write_string(elm.text)
-
-    elif elm.tag in IGNORE_TAGS:
-        pass
-
+# how many times to restart OpenOffice before giving up on a render
+MAX_RESTARTS = 3
+
+# OpenOffice port for the first parallel worker (the others follow on)
+WORKER_BASE_PORT = 8101
+
+# OpenOffice port for the export worker (used in batch/parallel runs)
+EXPORT_PORT = 8099
+
+# per-process state for parallel rendering (inherited by the workers)
+_WORKER = {}
+
+# how far the current gazetteer has got (read by the telemetry sampler) --
+#  threads rendering gazetteers at once keep their own, registered in
+#  THREAD_PROGRESS (see `progress`)
+PROGRESS = {'done': 0, 'total': 0}
+THREAD_PROGRESS = []
+
+# held while the TEI is being prepared in the background (the parallel
+#  workers mustn't be forked while another thread is inside libxml2)
+_PREPARE_LOCK = threading.Lock()
+
+
+# the index files which a render writes to (see render.index_file)
+INDEX_NAMES = ('personIndex', 'placeIndex')
+
+
+def progress():
+    """ Returns the progress record of this thread (if it has its own, see
+        settings.THREAD_STATE), or the module-level one.
+    """
+    return getattr(settings.THREAD_STATE, 'progress', PROGRESS)
+
+
+def overall_progress():
+    """ Returns (done, total) top-level divs, over all of the gazetteers
+        being rendered.
+    """
+    records = [PROGRESS] + THREAD_PROGRESS
+    return (sum(record['done'] for record in records),
+            sum(record['total'] for record in records))
+
+
+class SharedDesktop():
+    """ An OpenOffice desktop shared by several rendering threads (see
+        `render_threaded`), which is reconnected -- once, by whichever
+        thread gets there first -- if OpenOffice dies.
+    """
+
+    def __init__(self, **connect_args):
+        self.connect_args = connect_args
+        self.lock = threading.Lock()
+        self.desktop = connectOO(**connect_args)
+
+    def reconnect(self, dead_desktop):
+        """ Replaces the desktop, unless another thread already has. """
+        with self.lock:
+            if self.desktop is dead_desktop:
+                self.desktop = connectOO(**self.connect_args)
+            return self.desktop
+
+
+def index_offsets():
+    """ Returns the length of each of the index files (which are only ever
+        appended to).
+    """
+    offsets = {}
+    for name in INDEX_NAMES:
+        index = index_file(name)
+        index.flush()
+        offsets[name] = os.fstat(index.fileno()).st_size
+    return offsets
+
+
+class Checkpoint():
+    """ Records the progress of a render (the partially rendered document,
+        the number of top-level divs which it contains, and how far the
+        index files had got), so that an interrupted job can be resumed.
+    """
+
+    def __init__(self, output_file, gaz):
+        self.gaz = gaz
+        self.partial_file = '{0}.partial.odt'.format(output_file)
+        self.state_file = '{0}.checkpoint'.format(output_file)
+        self.position = 0
+        self.index_offsets = None
+
+    def load(self):
+        """ Reads the saved state, returning True if there is a usable
+            checkpoint for this gazetteer.
+        """
+        if not os.path.exists(self.state_file) or \
+           not os.path.exists(self.partial_file):
+            return False
+
+        with open(self.state_file) as state_file:
+            state = json.load(state_file)
+
+        if state.get('gazetteer') != self.gaz:
+            logging.warning('checkpoint "%s" is for gazetteer "%s", not "%s"'
+                            ' -- ignoring it', self.state_file,
+                            state.get('gazetteer'), self.gaz)
+            return False
+
+        self.position = state['position']
+        self.index_offsets = state.get('indexes')
+        if self.index_offsets is None:
+            logging.warning('checkpoint "%s" doesn\'t record the index '
+                            'files -- they may have entries missing or '
+                            'repeated', self.state_file)
+        return True
+
+    def restore_indexes(self):
+        """ Cuts the index files back to where they were at the checkpoint
+            (or, if there isn't one yet, to where they were when the render
+            began), so that no entry is lost or written twice.
+        """
+        if self.index_offsets is None:
+            self.index_offsets = index_offsets()
+            return
+        for name in INDEX_NAMES:
+            index = index_file(name)
+            index.flush()
+            index.seek(self.index_offsets[name])
+            index.truncate()
+
+    def save(self, writer, position):
+        """ Saves the partial document, then records the position reached
+            (and the length of each index file).
+        """
+        # write to temp files and rename them, so that a crash can't leave
+        #  a half-written checkpoint behind
+        temp_file = '{0}.tmp.odt'.format(self.partial_file[:-4])
+        writer.save_copy(temp_file)
+        os.rename(temp_file, self.partial_file)
+
+        offsets = index_offsets()
+        temp_file = '{0}.tmp'.format(self.state_file)
+        with open(temp_file, 'w') as state_file:
+            json.dump({'gazetteer': self.gaz, 'position': position,
+                       'indexes': offsets}, state_file)
+        os.rename(temp_file, self.state_file)
+
+        self.position = position
+        self.index_offsets = offsets
+        logging.debug('Checkpoint saved after %d top-level divs', position)
+
+    def clear(self):
+        """ Removes the checkpoint files once the job is complete. """
+        for file_path in (self.state_file, self.partial_file):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+
+def new_writer(writer_args, styles_file=None, needed_styles=None,
+               source_file=None):
+    """ Returns an OOWriter for a new document (or for carrying on with
+        `source_file`), with the styles loaded from the styles template and
+        all of the `needed_styles` (from the style pre-pass) created.  A
+        prepared template (.ott, see prepare_template.py) is opened as the
+        new document, rather than having its styles loaded.
+    """
+    shared = writer_args.get('shared_desktop')
+    if shared is not None:
+        writer_args = dict(writer_args, desktop=shared.desktop)
+        del writer_args['shared_desktop']
+
+    if source_file is not None:
+        writer = OOWriter(source_file, **writer_args)
+    elif styles_file is not None and styles_file.lower().endswith('.ott'):
+        writer = OOWriter(template_file=styles_file, **writer_args)
     else:
-        if elm.tag not in PROCESSED_TAGS and elm.tag not in dir(settings):
-            logging.warning('tag "{0}" has no processing instuction and is not'
-                            ' "pass"ed (behaviour undefined)!'.format(elm.tag))
-            PROCESSED_TAGS.append(elm.tag)
-
-    for sub_elm in elm.iterchildren(tag=etree.Element):
-        render_elm(writer, sub_elm, stack, context)
-
-    if elm.tag in PARASTYLE_TAGS:
-        writer.close_para()
-
-    if elm.tag in CHARSTYLE_TAGS:
-        writer.cursor.CharStyleName = saved_charstyle \
-                            if saved_charstyle != '' else 'Default'
-
-    # check if there's a function in `settings` to process this element
-    if elm.tag in dir(settings):
-        func = getattr(settings, elm.tag)
-        if callable(func):
-            # the function should return True on success, or False on failure
-            if not func(writer, elm, stack):
-                logging.error('malformed %s element!\n%s',
-                        elm.tag, etree.tostring(elm, pretty_print=True))
+        writer = OOWriter(**writer_args)
+        # if a styles template file has been specified, load the styles now
+        if styles_file is not None:
+            writer.load_styles_from_file(styles_file)
+
+    if needed_styles is not None:
+        writer.create_styles(needed_styles)
+
+    return writer
+
+
+def insert_div(writer, div, position, bulk_dir):
+    """ Renders a top-level div with lxml into a flat ODF fragment, and
+        inserts that into the document in one call (instead of one call
+        per string).  The index entries' page numbers are looked up
+        afterwards, from bookmarks left in the fragment.
+    """
+    fragment = ODFWriter(writer.known_styles, 'div{0}_'.format(position),
+                         mark_pages=True)
+    # (the index entries are collected in this thread's own buffers)
+    names = ('personIndex', 'placeIndex')
+    indexes = [index_file(name) for name in names]
+    saved = [getattr(settings.THREAD_STATE, name, None) for name in names]
+    for name in names:
+        setattr(settings.THREAD_STATE, name, StringIO.StringIO())
+    try:
+        render_elm(fragment, div, [])
+        entries = [index_file(name).getvalue() for name in names]
+    finally:
+        for name, value in zip(names, saved):
+            setattr(settings.THREAD_STATE, name, value)
+
+    fragment_file = os.path.join(bulk_dir, '{0:04d}.fodt'.format(position))
+    fragment.save_fodt(fragment_file)
+    writer.insert_document(fragment_file)
+    os.remove(fragment_file)
+
+    page = lambda match: str(writer.bookmark_page(match.group(0)))
+    for index, text in zip(indexes, entries):
+        index.write(PAGE_MARKS.sub(page, text))
+
+
+def render_divs(divs, writer_args, styles_file=None, checkpoint=None,
+                needed_styles=None, bulk_dir=None):
+    """ Renders a list of top-level divs into a new document, and returns
+        the writer.  If a checkpoint is given, the document is saved after
+        each div, and if OpenOffice dies the render is resumed from the
+        last checkpoint (after restarting OpenOffice).  With a `bulk_dir`
+        (for the fragments), each div is inserted in one go (see
+        `insert_div`).
+    """
+    restarts = 0
+    position = checkpoint.position if checkpoint is not None else 0
+    record = progress()
+    shared = writer_args.get('shared_desktop')
+
+    while True:
+        # (re)start from the last saved position
+        del processed_tags()[:]
+        if checkpoint is not None:
+            checkpoint.restore_indexes()
+        desktop = shared.desktop if shared is not None else None
+        try:
+            if position > 0:
+                logging.info('Resuming from top-level div %d of %d',
+                             position + 1, len(divs))
+                writer = new_writer(writer_args, styles_file, needed_styles,
+                                    checkpoint.partial_file)
+            else:
+                writer = new_writer(writer_args, styles_file, needed_styles)
+
+            record['total'] = len(divs)
+            while position < len(divs):
+                record['done'] = position
+                if bulk_dir is not None:
+                    insert_div(writer, divs[position], position, bulk_dir)
+                else:
+                    render_elm(writer, divs[position], [])
+                position += 1
+                record['done'] = position
+                if checkpoint is not None:
+                    checkpoint.save(writer, position)
+
+            return writer
+
+        except (DisposedException, RuntimeException), exc:
+            if checkpoint is None or restarts >= MAX_RESTARTS:
+                raise
+            restarts += 1
+            position = checkpoint.position
+            logging.warning('Lost the connection to OpenOffice (%s) -- '
+                            'restarting (attempt %d of %d)',
+                            exc, restarts, MAX_RESTARTS)
+            if shared is not None:
+                # (the other threads' documents went with it)
+                shared.reconnect(desktop)
+
+
+def worker_args(writer_args, parts_dir, port):
+    """ Returns the writer arguments for the OpenOffice on a port (with its
+        own profile, in the parts folder).
+    """
+    return dict(writer_args, oo_port=str(port), new_document=True,
+                profile_dir=os.path.join(parts_dir,
+                                         'profile{0}'.format(port)))
+
+
+def worker_ports(parts_dir):
+    """ Returns the ports of the OpenOffices started for the workers (from
+        their profiles).
+    """
+    return sorted(int(name[len('profile'):])
+                        for name in os.listdir(parts_dir)
+                                if name.startswith('profile'))
+
+
+def take_slot(slots):
+    """ Claims the first slot (in a shared array of worker pids) which isn't
+        held by a live worker, and returns its number.
+    """
+    with slots.get_lock():
+        for number, pid in enumerate(slots):
+            if pid:
+                try:
+                    os.kill(pid, 0)
+                    continue
+                except OSError:
+                    pass
+            slots[number] = os.getpid()
+            return number
+    raise RuntimeError('no free worker slot')
+
+
+def init_worker(writer_args, styles_file, slots):
+    """ Sets up a parallel rendering worker, with its own OpenOffice, on the
+        port of its slot -- a worker which replaces one that died takes over
+        its slot (and its OpenOffice).
+    """
+    port = WORKER_BASE_PORT + take_slot(slots)
+    _WORKER['writer_args'] = worker_args(writer_args, _WORKER['parts_dir'],
+                                         port)
+    _WORKER['styles_file'] = styles_file
+
+
+def render_chapter(position):
+    """ Renders one top-level div into its own ODT fragment (and index
+        files), returning the fragment's path.
+    """
+    del PROCESSED_TAGS[:]
+    prefix = os.path.join(_WORKER['parts_dir'], '{0:04d}.'.format(position))
+    settings.closeup()
+    settings.open_indexes(prefix)
+
+    # (the index entries' pages are left as bookmarks, and looked up once
+    #  the chapters have been merged -- see `resolve_page_marks`)
+    writer = new_writer(dict(_WORKER['writer_args'],
+                             mark_pages='div{0:04d}'.format(position)),
+                        _WORKER['styles_file'], _WORKER['needed_styles'])
+    render_elm(writer, _WORKER['divs'][position], [])
+
+    fragment_file = '{0}odt'.format(prefix)
+    writer.save_copy(fragment_file)
+    writer.close()
+    settings.closeup()
+    logging.debug('Rendered top-level div %d', position + 1)
+    return fragment_file
+
+
+def render_parallel(divs, writer_args, styles_file, output_file, jobs,
+                    needed_styles=None):
+    """ Renders the top-level divs in parallel worker processes (each with
+        its own OpenOffice), and merges the fragments into a single ODT.
+    """
+    parts_dir = '{0}.parts'.format(output_file)
+    if not os.path.exists(parts_dir):
+        os.makedirs(parts_dir)
+
+    # the workers are forked, so they inherit these (and must not inherit
+    #  any buffered index-file output)
+    _WORKER['divs'] = divs
+    _WORKER['parts_dir'] = parts_dir
+    _WORKER['needed_styles'] = needed_styles
+    settings.personIndex.flush()
+    settings.placeIndex.flush()
+
+    with _PREPARE_LOCK:
+        pool = multiprocessing.Pool(jobs, init_worker,
+                        (writer_args, styles_file,
+                         multiprocessing.Array('i', jobs)))
+    try:
+        # (the elements are rendered in the workers, so they're counted
+        #  here as each chapter comes back)
+        PROGRESS['done'] = 0
+        PROGRESS['total'] = len(divs)
+        fragments = []
+        for position, fragment_file in enumerate(
+                            pool.imap(render_chapter, range(len(divs)), 1)):
+            fragments.append(fragment_file)
+            render.STATS['elements'] += sum(1 for elm in
+                                divs[position].iter(tag=etree.Element))
+            PROGRESS['done'] = position + 1
+        pool.close()
+        pool.join()
+
+        merge_documents(fragments, output_file)
+        # (on one of the workers' OpenOffices, which is still running)
+        ports = worker_ports(parts_dir)
+        resolve_page_marks(output_file, fragments,
+                           worker_args(writer_args, parts_dir, ports[0]))
+    finally:
+        if not writer_args.get('keepopen'):
+            for port in worker_ports(parts_dir):
+                terminateOO(oo_port=str(port))
+
+    shutil.rmtree(parts_dir)
+
+
+def resolve_page_marks(output_file, fragments, writer_args):
+    """ Appends the chapters' index entries to the index files, with the
+        page numbers (which the workers left as bookmarks) looked up in the
+        merged document -- which is saved again, without the bookmarks.
+    """
+    writer = OOWriter(output_file, **writer_args)
+    page = lambda match: str(writer.bookmark_page(match.group(0)))
+    for name in INDEX_NAMES:
+        index = index_file(name)
+        for fragment_file in fragments:
+            with open('{0}{1}.csv'.format(fragment_file[:-3], name)) \
+                                                        as chapter_index:
+                for line in chapter_index.readlines()[1:]:
+                    index.write(PAGE_MARKS.sub(page, line))
+    writer.save_odt(output_file)
+    writer.close()
+
+
+def prepare_gazetteers(tei_base, gazetteers, prepared, cache_dir=None):
+    """ Loads each gazetteer's TEI and works out the styles and gaiji it
+        needs, queuing them for rendering (this runs in a background thread,
+        so that the next gazetteer is prepared while the current one is
+        rendered).
+    """
+    for gaz in gazetteers:
+        try:
+            with _PREPARE_LOCK:
+                tei = load_tei(tei_base, gaz, cache_dir)
+                glyphs = load_glyph_index(tei, cache_dir, tei_dependencies(
+                                                tei_base, gaz, cache_dir))
+                divs = get_wrapper_divs(tei)
+                with stage('style prepass {0}'.format(gaz)):
+                    needed_styles = collect_styles(div_events(divs))
+            prepared.put((gaz, divs, needed_styles, glyphs))
+        except BaseException, exc:
+            # (load_tei reports errors with SystemExit)
+            prepared.put((gaz, None, exc, None))
+            return
+    prepared.put(None)
+
+
+def render_gazetteer(gaz, divs, needed_styles, dest_file, opts, writer_args,
+                     styles_file=None):
+    """ Renders (and saves, if `dest_file` is given) a gazetteer.  Returns
+        the writer, or None if it has been closed.
+    """
+    if opts.jobs > 1:
+        render_parallel(divs, writer_args, styles_file, dest_file,
+                        opts.jobs, needed_styles)
+        logging.info('Saved %s', dest_file)
+        if render.BOOKMARK_IDS:
+            save_snapshot(divs, dest_file)
+        return None
+
+    checkpoint = None
+    if dest_file is not None:
+        checkpoint = Checkpoint(dest_file, gaz)
+        if opts.resume:
+            if not checkpoint.load():
+                logging.error('no checkpoint found for "%s"!', dest_file)
                 raise SystemExit
+        else:
+            checkpoint.clear()
 
-    if elm.tag in FOOTNOTE_TAGS:
-        # return the context after a footnote
-        writer.set_context(saved_context)
+    # Initialize OOWriter class, connect to OOo, and render
+    bulk_dir = make_temp_dir(cleanup=True) if opts.bulk else None
+    writer = render_divs(divs, writer_args, styles_file, checkpoint,
+                         needed_styles, bulk_dir)
 
-    if elm.tail:
-        writer.write_string(elm.tail)
+    #render_elm(wrapper.find('./div[@id="g008_00.xml"]'))
 
-    # pop the tag name back off the para_style stack
-    del stack[-1]
+    if checkpoint is not None:
+        writer.save_odt(dest_file)
+        checkpoint.clear()
+        logging.info('Saved %s', dest_file)
+        if render.BOOKMARK_IDS:
+            save_snapshot(divs, dest_file)
+
+    return writer
+
+
+def render_threaded(prepared, threads, opts, writer_args, styles_file=None,
+                    exporter=None, pdf_options=None):
+    """ Renders the gazetteers from the `prepared` queue concurrently, from
+        several threads, each into its own document on one OpenOffice (so
+        that only one soffice's worth of memory is needed).  The renderer's
+        per-document state is kept in settings.THREAD_STATE.
+    """
+    writer_args = dict(writer_args, new_document=True,
+                       shared_desktop=SharedDesktop(
+                                headless=writer_args.get('headless'),
+                                keepopen=writer_args.get('keepopen')))
+    failures = []
+
+    def render_thread():
+        state = settings.THREAD_STATE
+        state.stats = {'elements': 0}
+        render.THREAD_STATS.append(state.stats)
+        state.progress = {'done': 0, 'total': 0}
+        THREAD_PROGRESS.append(state.progress)
+        while True:
+            item = prepared.get()
+            if item is None:
+                # (put it back for the other threads)
+                prepared.put(None)
+                return
+            gaz, divs, needed_styles, glyphs = item
+            if divs is None:
+                # the preparer failed
+                failures.append(needed_styles)
+                prepared.put(None)
+                return
+
+            state.glyphs = glyphs
+            state.processed_tags = []
+            state.personIndex, state.placeIndex = \
+                                    settings.index_files('{0}_'.format(gaz))
+            dest_file = os.path.abspath(opts.destFile.replace('{gaz}', gaz))
+            try:
+                with stage('render {0}'.format(gaz)):
+                    writer = render_gazetteer(gaz, divs, needed_styles,
+                                    dest_file, opts, writer_args, styles_file)
+                if opts.pdfFile is not None:
+                    pdf_file = os.path.abspath(
+                                        opts.pdfFile.replace('{gaz}', gaz))
+                    if exporter is not None:
+                        exporter.add(dest_file, pdf_file,
+                                     filter_data=pdf_options)
+                    else:
+                        writer.export_pdf(pdf_file, pdf_options)
+                        logging.info('Exported %s', pdf_file)
+                writer.close()
+            except BaseException, exc:
+                logging.error('Rendering %s failed (%s: %s)', gaz,
+                              type(exc).__name__, exc)
+                failures.append(exc)
+                return
+            finally:
+                state.personIndex.close()
+                state.placeIndex.close()
+
+    workers = [threading.Thread(target=render_thread)
+                    for count in range(threads)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    if failures:
+        raise failures[0]
 
 
 def main():
-    """ Process a TEI document. """
+    """ Process one or more TEI documents. """
 
     load_settings(settings)
 
@@ -135,68 +587,248 @@ def main():
                         default=False, help='Keep the OpenOffice server open '
                                     'when finished (if started by the script)')
 
-    parser.add_option('-g', '--gazetteer', dest='gazetteer', action='store',
-                        help='Gazetteer to process (e.g. g008)')
+    parser.add_option('-g', '--gazetteer', dest='gazetteers', action='append',
+                        help='Gazetteer to process (e.g. g008; may be given '
+                                    'more than once)')
 
     parser.add_option('--teiBase', dest='teiBase', action='store',
-                        default=TEI_BASE,
+                        default=settings.TEI_BASE,
                         help='path to TEI files (eXist dump) ({0})'\
-                                                            .format(TEI_BASE))
+                                            .format(settings.TEI_BASE))
 
-    parser.add_option('-s', '--styles', dest='stylesFile', action='store',
-                        help='ODT or OTT file to read styles from')
+    parser.add_option('--cacheDir', dest='cacheDir', action='store',
+                        default=settings.TEI_CACHE,
+                        help='folder to cache the prepared TEI in ({0})'\
+                                            .format(settings.TEI_CACHE))
 
-    #parser.add_option('-o', '--output', dest='destFile', action='store',
-                        #help='''output file''')
+    parser.add_option('-s', '--styles', dest='stylesFile', action='store',
+                        help='ODT or OTT file to read styles from (new '
+                                    'documents are opened from an OTT)')
+
+    parser.add_option('--template', dest='templateFile', action='store',
+                        help='prepare a template (OTT) with the --styles and '
+                                    'all the styles the gazetteers need, if '
+                                    'it isn\'t up to date, and open the new '
+                                    'documents from it')
+
+    parser.add_option('-o', '--output', dest='destFile', action='store',
+                        help='output file (the render is checkpointed after '
+                                    'each top-level div); with more than one '
+                                    'gazetteer, "{gaz}" in the name is '
+                                    'replaced by each gazetteer\'s name')
+
+    parser.add_option('--pdf', dest='pdfFile', action='store',
+                        help='also export a PDF file (with more than one '
+                                    'gazetteer, "{gaz}" in the name is '
+                                    'replaced as for --output)')
+
+    parser.add_option('--pdfOptions', dest='pdfOptions', action='store',
+                        help='PDF export filter options, e.g. '
+                                    '"UseTaggedPDF=true,SelectPdfVersion=1"')
+
+    parser.add_option('--bookmarks', dest='bookmarks', action='store_true',
+                        default=settings.BOOKMARK_IDS,
+                        help='bookmark the elements with ids (and save a '
+                                    'TEI snapshot with the output), so that '
+                                    'the ODT can be patched by patch_odt.py')
+
+    parser.add_option('--resume', dest='resume', action='store_true',
+                        default=False, help='resume an interrupted render '
+                                    'from its last checkpoint')
+
+    parser.add_option('-j', '--jobs', dest='jobs', action='store',
+                        type='int', default=1,
+                        help='render the top-level divs in parallel, with '
+                                    'this many OpenOffice workers (needs '
+                                    '--output)')
+
+    parser.add_option('--threads', dest='threads', action='store',
+                        type='int', default=1,
+                        help='render this many gazetteers at once, from '
+                                    'threads, on one OpenOffice (needs more '
+                                    'than one gazetteer) [%default]')
+
+    parser.add_option('--bulk', dest='bulk', action='store_true',
+                        default=False,
+                        help='render each top-level div to flat ODF with '
+                                    'lxml, and insert it into the document '
+                                    'in one call')
+
+    parser.add_option('--prefetch', dest='prefetch', action='store',
+                        type='int', default=1,
+                        help='number of gazetteers to load ahead of the one '
+                                    'being rendered [%default]')
+
+    parser.add_option('--telemetry', dest='telemetryFile', action='store',
+                        help='sample the CPU and memory use of Python and '
+                                    'OpenOffice, and the elements rendered '
+                                    'per second, to this CSV file (with a '
+                                    'summary in FILE.summary.json)')
+
+    parser.add_option('--sampleInterval', dest='sampleInterval',
+                        action='store', type='float', default=1.0,
+                        help='seconds between telemetry samples [%default]')
+
+    parser.add_option('--memprofile', dest='memprofileFile',
+                        action='store',
+                        help='record the memory used at each stage (parse, '
+                                    'xinclude, render...), by Python and '
+                                    'OpenOffice, to this file (and '
+                                    'FILE.json)')
+
+    parser.add_option('--progress', dest='progress', action='store',
+                        type='float', default=0,
+                        help='log the progress every so many seconds '
+                                    '(0 for never) [%default]')
 
     opts = parser.parse_args()[0]
 
-    if opts.gazetteer is None:
+    if not opts.gazetteers:
         parser.print_help()
         raise SystemExit
 
-    gaz = opts.gazetteer
+    batch = len(opts.gazetteers) > 1
 
-    prep_logging(opts.verbose, opts.quiet)
+    if opts.resume and opts.destFile is None:
+        parser.error('--resume needs the --output file of the interrupted '
+                     'render')
 
-    logging.debug('Begin!')
+    if opts.jobs > 1 and (opts.destFile is None or opts.resume):
+        parser.error('--jobs needs an --output file (and can\'t --resume)')
 
-    # get the TEI
-    try:
-        xml_file = os.path.join(opts.teiBase, gaz, '{0}_main.xml'.format(gaz))
-        tei = etree.parse(xml_file)
-    except IOError:
-        logging.error('''
-        file "%s" could not be found!  make sure the tei is available in
-            "%s", or specify the --teiBase option correctly''',
-                xml_file, opts.teiBase)
-        raise SystemExit
+    if opts.threads > 1 and (not batch or opts.jobs > 1 or opts.resume):
+        parser.error('--threads needs more than one gazetteer (and can\'t '
+                     'be used with --jobs or --resume)')
+
+    if opts.jobs > 1 and opts.bulk:
+        parser.error('--bulk is for serial renders (not --jobs)')
 
-    # parse XIncludes
-    tei.xinclude()
-    tei = tei.getroot()
+    if batch and (opts.destFile is None or '{gaz}' not in opts.destFile):
+        parser.error('more than one gazetteer needs an --output file name '
+                     'containing "{gaz}"')
 
-    # strip namespaces for clarity and cleanliness :)
-    tei = stripNamespaces(tei)
+    if batch and opts.pdfFile is not None and '{gaz}' not in opts.pdfFile:
+        parser.error('more than one gazetteer needs a --pdf file name '
+                     'containing "{gaz}"')
 
-    logging.debug('Successfully loaded and parsed XML for %s', gaz)
+    if opts.templateFile is not None and opts.stylesFile is None:
+        parser.error('--template needs a --styles file to start from')
 
-    # Initialize OOWriter class, and connect to OOo
-    writer = OOWriter(headless=opts.headless, keepopen=opts.keepopen)
+    render.BOOKMARK_IDS = opts.bookmarks
 
-    # if a styles template file has been specified, load the styles now
+    prep_logging(opts.verbose, opts.quiet)
+
+    logging.debug('Begin!')
+
+    # (started first, so that preparing the template is measured too)
+    memprofile = None
+    if opts.memprofileFile is not None:
+        memprofile = enable_memprofile(office_pids=lambda: [office_pid()])
+
+    sampler = None
+    if opts.telemetryFile is not None or opts.progress:
+        if proc_available():
+            sampler = Sampler(opts.telemetryFile, opts.sampleInterval,
+                        count=render.elements_rendered,
+                        progress=overall_progress,
+                        progress_interval=opts.progress,
+                        office_pids=lambda: [office_pid()])
+            sampler.start()
+        else:
+            logging.warning('Telemetry needs /proc -- not sampling')
+
+    styles_file_path = None
     if opts.stylesFile:
         styles_file_path = os.path.abspath(
                             os.path.join(os.getcwd(), opts.stylesFile))
-        writer.load_styles_from_file(styles_file_path)
-
-    # get the main TEI body and start work!
-    wrapper = tei.find('.//div[@type="wrapper"]')
-    stack = []
-    for elm in wrapper.iterchildren(tag=etree.Element):
-        render_elm(writer, elm, stack)
 
-    #render_elm(wrapper.find('./div[@id="g008_00.xml"]'))
+    if opts.templateFile is not None:
+        template_file = os.path.abspath(opts.templateFile)
+        with stage('template'):
+            ensure_template(styles_file_path, corpus_styles(opts.teiBase,
+                                opts.gazetteers, opts.cacheDir), template_file)
+        styles_file_path = template_file
+
+    writer_args = {'headless': opts.headless, 'keepopen': opts.keepopen}
+    if batch:
+        writer_args['new_document'] = True
+
+    # in batch/parallel runs, PDFs are exported on a separate OpenOffice,
+    #  in the background, while rendering carries on
+    pdf_options = parse_filter_options(opts.pdfOptions)
+    exporter = None
+    if opts.pdfFile is not None and (batch or opts.jobs > 1):
+        exporter = ExportQueue(headless=opts.headless, keepopen=opts.keepopen,
+                               oo_port=str(EXPORT_PORT),
+                               profile_dir=make_temp_dir(cleanup=True))
+        exporter.start()
+
+    # load (and work out the styles for) the gazetteers in the background,
+    #  with a bounded queue to cap the memory used
+    prepared = Queue.Queue(max(opts.prefetch, opts.threads, 1))
+    preparer = threading.Thread(target=prepare_gazetteers,
+                        args=(opts.teiBase, opts.gazetteers, prepared,
+                              opts.cacheDir))
+    preparer.daemon = True
+    preparer.start()
+
+    if opts.threads > 1:
+        render_threaded(prepared, opts.threads, opts, writer_args,
+                        styles_file_path, exporter, pdf_options)
+
+    while opts.threads <= 1:
+        item = prepared.get()
+        if item is None:
+            break
+        gaz, divs, needed_styles, glyphs = item
+        if divs is None:
+            # the preparer failed -- pass its exception on
+            raise needed_styles
+
+        settings.GLYPHS.clear()
+        settings.GLYPHS.update(glyphs)
+
+        # index files are written per gazetteer in a batch
+        settings.closeup()
+        settings.open_indexes('{0}_'.format(gaz) if batch else '',
+                              resume=opts.resume)
+
+        dest_file = None
+        if opts.destFile is not None:
+            dest_file = os.path.abspath(opts.destFile.replace('{gaz}', gaz))
+
+        with stage('render {0}'.format(gaz)):
+            writer = render_gazetteer(gaz, divs, needed_styles, dest_file,
+                                      opts, writer_args, styles_file_path)
+
+        if opts.pdfFile is not None:
+            pdf_file = os.path.abspath(opts.pdfFile.replace('{gaz}', gaz))
+            if exporter is not None:
+                exporter.add(dest_file, pdf_file, filter_data=pdf_options)
+            else:
+                with stage('pdf export {0}'.format(gaz)):
+                    writer.export_pdf(pdf_file, pdf_options)
+                logging.info('Exported %s', pdf_file)
+
+        if batch and writer is not None:
+            writer.close()
+
+    if memprofile is not None:
+        memprofile.save(opts.memprofileFile)
+        logging.info('Wrote the memory profile to %s', opts.memprofileFile)
+
+    if sampler is not None:
+        summary = sampler.stop()
+        logging.info('Telemetry: %s', ', '.join('{0}={1}'.format(key,
+                            summary[key]) for key in sorted(summary)))
+
+    if exporter is not None:
+        logging.debug('Waiting for the exports to finish...')
+        exporter.finish()
+        if exporter.failures:
+            logging.error('%d export(s) failed: %s', len(exporter.failures),
+                          ', '.join(exporter.failures))
+            raise SystemExit(1)
 
     logging.debug('End!')
 